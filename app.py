@@ -1,24 +1,95 @@
-import uuid
 import json
-import base64
-from concurrent.futures import ThreadPoolExecutor
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import streamlit as st
-import pandas as pd
 from enum import Enum
-from io import BytesIO
 from generator import (
-    gen_image, gen_image_prompt, gen_mm_image_prompt, gen_tags, gen_english
+    gen_image_prompt_stream, gen_mm_image_prompt_stream, gen_tags_batch, gen_english,
+    gen_text_query_embedding, gen_text_embedding,
 )
 from prompt import DEFAULT_STYLE
 from params import ImageParams, ImageSize
-from utils import encode_image_bytes, get_current_time
-from aws.dynamodb import DynamoDB, _decimal_default
+from planner import gen_images
+from image_buffer import ImageBuffer
+from vector_index import VectorIndex
+from gallery import GallerySync, upload_image, index_metadata
+from jobs import JobQueue
+from reuse import GenerationReuse, config_signature
+from utils import timer
+from aws.dynamodb import DynamoDB, UnprocessedItemsError, from_dynamodb, _decimal_default
+from aws.embedding import EmbeddingError
 from aws.s3 import S3
+from aws.client import warm_up
+from metrics import metrics, serve as serve_metrics
 from config import config
 
 
-s3 = S3(bucket_name=config.S3_BUCKET)
-db = DynamoDB(table_name=config.DYNAMODB_TABLE)
+logging.basicConfig(level=config.LOG_LEVEL)
+
+
+@st.cache_resource
+def get_s3():
+    return S3(bucket_name=config.S3_BUCKET)
+
+
+@st.cache_resource
+def get_db():
+    return DynamoDB(table_name=config.DYNAMODB_TABLE, index_name=config.DYNAMODB_GALLERY_INDEX)
+
+
+@st.cache_resource
+def get_job_queue():
+    queue = JobQueue(config.JOB_QUEUE_PATH)
+    metrics.add_gauges(queue.gauges)
+    return queue
+
+
+@st.cache_resource
+def warm_up_clients():
+    warm_up(bucket_name=config.S3_BUCKET, table_name=config.DYNAMODB_TABLE)
+
+
+@st.cache_resource
+def start_metrics_server():
+    serve_metrics(config.METRICS_PORT)
+
+
+@st.cache_resource
+def get_gallery_sync(path: str, attribute: str) -> GallerySync:
+    metadata = index_metadata
+    if attribute == "prompt_embedding":
+        metadata = lambda item: {
+            **index_metadata(item),
+            "signature": config_signature(from_dynamodb(item.get("config", {}))),
+        }
+    return GallerySync(
+        index=VectorIndex(path=path),
+        db=get_db(),
+        attribute=attribute,
+        metadata=metadata,
+        interval=config.INDEX_SYNC_SECONDS,
+    )
+
+
+def load_vector_index():
+    sync = get_gallery_sync(config.VECTOR_INDEX_DIR, "embedding")
+    sync.sync()
+    return sync.index
+
+
+@st.cache_resource
+def _generation_reuse():
+    return GenerationReuse(
+        index=get_gallery_sync(config.PROMPT_INDEX_DIR, "prompt_embedding").index,
+        embed=gen_text_embedding,
+        threshold=config.REUSE_SIMILARITY_THRESHOLD,
+    )
+
+
+def load_generation_reuse():
+    get_gallery_sync(config.PROMPT_INDEX_DIR, "prompt_embedding").sync()
+    return _generation_reuse()
+
 
 class PromptTab(Enum):
     BASIC_PROMPT = "Basic Prompt"
@@ -33,6 +104,16 @@ def initialize_session_state():
         st.session_state.selected_colors = []
     if 'use_colors' not in st.session_state:
         st.session_state.use_colors = False
+    if 'jobs' not in st.session_state:
+        st.session_state.jobs = []
+    if 'gallery_items' not in st.session_state:
+        reset_gallery()
+
+
+def reset_gallery():
+    st.session_state.gallery_items = []
+    st.session_state.gallery_cursor = None
+    st.session_state.gallery_loaded = False
 
 
 def render_prompt_section():
@@ -62,7 +143,7 @@ def render_prompt_section():
         temperature = st.slider(
             "Temperature",
             min_value=0.0, max_value=1.0, value=0.7, step=0.1,
-            help="모델의 창의성을 조절합니다. 값이 높을수록 더 다양하고 예측 불가능한 응답을 생성합니다."
+            help="모델의 창의성을 조절합니다. 값이 높을수록 더 다양하고 예측 불가능한 응답을 생성합니다. LLM_CACHE_MAX_TEMPERATURE(기본 0.7) 이하에서는 같은 요청에 캐시된 응답을 돌려줍니다."
         )
         top_p = st.slider(
             "Top P",
@@ -84,21 +165,35 @@ def render_prompt_section():
             st.session_state.image_prompts.extend([gen_english(request=prompt_text)])
 
         elif selected_option == PromptTab.LLM_PROMPT.value:
-            st.session_state.image_prompts.extend(gen_image_prompt(
+            _show_prompt_stream(gen_image_prompt_stream(
                 request=keyword_text,
                 style=style_text,
                 **llm_config
             ))
 
         elif selected_option == PromptTab.MM_LLM_PROMPT.value:
-            image = encode_image_bytes(reference_image)
-            st.session_state.image_prompts.extend(gen_mm_image_prompt(
+            image = ImageBuffer.from_file(reference_image)
+            _show_prompt_stream(gen_mm_image_prompt_stream(
                 request=multimodal_keyword_text,
                 image=image,
                 **llm_config
             ))
 
 
+def _show_prompt_stream(stream):
+    with st.status("Generating prompts...", expanded=True) as status:
+        for prompt in stream:
+            st.session_state.image_prompts.append(prompt)
+            st.write(prompt)
+        status.update(label="Prompts generated", state="complete", expanded=False)
+
+    st.caption(
+        f"stop reason: {stream.stop_reason} · "
+        f"input tokens: {stream.usage.get('input_tokens')} · "
+        f"output tokens: {stream.usage.get('output_tokens')}"
+    )
+
+
 def render_image_prompt_section():
     st.subheader("Image Prompt")
     selected_prompts = st.multiselect(
@@ -116,12 +211,22 @@ def render_image_prompt_section():
 def render_configuration_section():
     st.subheader("Image Configurations")
     with st.expander("Image Configuration", expanded=True):
-        num_images = st.slider("Number of Images", min_value=1, max_value=5, value=1, step=1)
+        num_images = st.slider("Number of Images", min_value=1, max_value=config.IMAGE_MAX_TOTAL, value=1, step=1)
         cfg_scale = st.slider("CFG Scale", min_value=1.0, max_value=10.0, value=8.0, step=0.5)
         seed = st.number_input("Seed", min_value=0, value=0, max_value=2147483646, step=1)
         size_options = {f"{size.value[0]} X {size.value[1]}": size for size in ImageSize}
         selected_size = st.selectbox("Image Size", options=list(size_options.keys()))
         
+        st.session_state.reuse_enabled = st.checkbox(
+            "Reuse similar generations", value=False,
+            help="비슷한 프롬프트와 같은 설정으로 이미 생성된 이미지가 있으면 새로 생성하지 않고 보여줍니다."
+        )
+        if st.session_state.reuse_enabled:
+            st.session_state.reuse_threshold = st.slider(
+                "Reuse Similarity", min_value=0.5, max_value=1.0,
+                value=config.REUSE_SIMILARITY_THRESHOLD, step=0.01
+            )
+
         st.session_state.use_colors = st.checkbox("Using color references", value=False)
         if st.session_state.use_colors:
             color_picker = st.color_picker("Pick a color")
@@ -148,92 +253,357 @@ def render_configuration_section():
 
 
 def generate_images(selected_prompts, num_images, cfg_scale, seed, selected_size):
-    def _generate_image_task(image_prompt, img_params, cfg, use_colors, selected_colors):
+    def _generate_image_task(image_prompt, img_params, cfg, use_colors, selected_colors, reuse_threshold):
         if use_colors:
-            body = img_params.color_guide(text=image_prompt, colors=selected_colors)
+            build_body = lambda params: params.color_guide(text=image_prompt, colors=selected_colors)
             cfg['colorGuide'] = selected_colors
         else:
-            body = img_params.text_to_image(text=image_prompt)
+            build_body = lambda params: params.text_to_image(text=image_prompt)
         
-        imgs = gen_image(body=body)
+        if reuse_threshold is not None:
+            reused = reuse.find(image_prompt, cfg, k=num_images, threshold=reuse_threshold)
+            if reused:
+                return image_prompt, [], cfg, None, reused
+
+        timings = {}
+        with timer(timings, 'generate'):
+            imgs = gen_images(img_params, num_images, build_body)
 
-        return image_prompt, imgs, cfg
+        return image_prompt, imgs, cfg, timings['generate'], []
     
-    def _show_and_upload_images(results = []):
-        for image_prompt, imgs, cfg in results:
-            st.info(image_prompt)
+    transfer_stats = []
+    vector_index = load_vector_index()
+    reuse_enabled = st.session_state.get('reuse_enabled', False)
+    # the prompt embedding and index sync are only paid for when reuse is on,
+    # unless REUSE_RECORD_PROMPTS keeps recording prompts for later lookups
+    reuse = load_generation_reuse() if reuse_enabled or config.REUSE_RECORD_PROMPTS else None
+    reuse_threshold = st.session_state.reuse_threshold if reuse_enabled else None
+
+    def _tag_task(entries):
+        timings = {}
+        with timer(timings, 'tag'):
+            tags = gen_tags_batch([entry['image'] for entry in entries])
+        return tags, timings
+
+    def _upload_task(entry, tags):
+        timings = {}
+        with timer(timings, 'upload'):
+            item, stats = upload_image(
+                image=entry['image'],
+                prompt=entry['prompt'],
+                cfg=entry['cfg'],
+                tags=tags,
+                s3=get_s3(),
+                index=vector_index,
+                reuse=reuse
+            )
+        transfer_stats.append(stats)
+        entry['item'] = item
+        return timings
+
+    def _write_task(items):
+        timings = {}
+        with timer(timings, 'db_write'):
+            get_db().put_items(items)
+        return timings
+
+    def _show_images(slot, image_prompt, imgs, cfg, reused):
+        '''
+        Render one prompt's images into its placeholder.
+
+        Returns:
+            list: entries to tag and upload; entries of one prompt share a
+                `group` that collects their gallery items for one write
+        '''
+        entries = []
+        group = {'uploads': len(imgs), 'entries': []}
+        with slot.container():
+            if reused:
+                cols = st.columns(len(reused))
+                for idx, (_, score, meta) in enumerate(reused):
+                    with cols[idx]:
+                        st.image(meta.get('thumbnail_url') or meta.get('url'))
+                        st.caption(f"Reused · similarity {score:.3f}")
+                return entries
+
             cols = st.columns(len(imgs))
-            for idx, img in enumerate(imgs):
+            for idx, (img, img_cfg) in enumerate(imgs):
                 with cols[idx]:
-                    image_data = BytesIO(base64.b64decode(img))
+                    st.image(img.data)
+                    placeholder = st.empty()
+                    placeholder.caption("Tagging...")
+                entries.append({'image': img, 'prompt': image_prompt, 'cfg': {**cfg, **img_cfg}, 'placeholder': placeholder, 'group': group})
+        return entries
 
-                    try:
-                        tags = json.loads(gen_tags(img))
-                    except:
-                        tags = []
-
-                    st.image(image_data)
-                    st.write(tags)
-
-                    with st.spinner("Upload..."):
-                        upload_image(
-                            image=image_data,
-                            prompt=image_prompt,
-                            cfg=cfg,
-                            tags=tags
-                        )
-    
     st.divider()
     st.subheader("Image Generation")
-    with st.status("Generating...", expanded=True):
+    with st.status("Generating...", expanded=True) as status:
         img_params = ImageParams(seed=seed)
         img_params.set_configuration(count=num_images, size=selected_size, cfg=cfg_scale)
 
-        results = []
-        with ThreadPoolExecutor() as executor:
-            futures = []
-            for image_prompt in selected_prompts:
+        # one placeholder per prompt, filled in as soon as its images are ready
+        total = len(selected_prompts)
+        progress = st.progress(0.0, text=f"0/{total} prompts")
+        slots = []
+        for image_prompt in selected_prompts:
+            st.info(image_prompt)
+            slots.append(st.empty())
+            slots[-1].caption("Generating...")
+
+        stage_timings = {}
+        finished = 0
+        failed = 0
+        unsaved = 0
+        with ThreadPoolExecutor(max_workers=config.MAX_WORKERS) as generate_executor, \
+                ThreadPoolExecutor(max_workers=config.TAG_UPLOAD_WORKERS) as executor:
+            pending = {}
+            for image_prompt, slot in zip(selected_prompts, slots):
                 cfg = img_params.get_configuration()
-                futures.append(executor.submit(_generate_image_task, image_prompt, img_params, cfg, st.session_state.use_colors, st.session_state.selected_colors))
-            
-            for future in futures:
-                results.append(future.result())
+                future = generate_executor.submit(_generate_image_task, image_prompt, img_params, cfg, st.session_state.use_colors, st.session_state.selected_colors, reuse_threshold)
+                pending[future] = ('generate', slot)
 
-        _show_and_upload_images(results)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, payload = pending.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = e
+
+                    # generation finished: show the images and start tagging
+                    if stage == 'generate':
+                        finished += 1
+                        progress.progress(finished / total, text=f"{finished}/{total} prompts")
+                        if not isinstance(result, Exception) and not (result[1] or result[4]):
+                            result = ValueError("no images returned")
+                        if isinstance(result, Exception):
+                            failed += 1
+                            payload.error(f"Generation failed: {result}")
+                            continue
+                        image_prompt, imgs, cfg, seconds, reused = result
+                        if seconds is not None:
+                            stage_timings.setdefault('generate', []).append(seconds)
+                        entries = _show_images(payload, image_prompt, imgs, cfg, reused)
+                        for start in range(0, len(entries), config.TAG_BATCH_SIZE):
+                            batch = entries[start:start + config.TAG_BATCH_SIZE]
+                            pending[executor.submit(_tag_task, batch)] = ('tag', batch)
+                        continue
+
+                    # tagging finished: show tags and start the uploads
+                    if stage == 'tag':
+                        if isinstance(result, Exception):
+                            result = ([[] for _ in payload], {})
+                        tags, timings = result
+                        for entry, image_tags in zip(payload, tags):
+                            entry['placeholder'].write(image_tags)
+                            pending[executor.submit(_upload_task, entry, image_tags)] = ('upload', entry)
+                    elif stage == 'write':
+                        if isinstance(result, Exception):
+                            # put_items writes the other batches before raising
+                            failed_items = result.items if isinstance(result, UnprocessedItemsError) else [entry['item'] for entry in payload]
+                            unwritten = {item['id'] for item in failed_items}
+                            for entry in payload:
+                                if entry['item']['id'] in unwritten:
+                                    unsaved += 1
+                                    entry['placeholder'].error(f"Saving to the gallery failed: {result}")
+                            continue
+                        timings = result
+                    else:
+                        group = payload['group']
+                        group['uploads'] -= 1
+                        if isinstance(result, Exception):
+                            payload['placeholder'].error(f"Upload failed: {result}")
+                        else:
+                            group['entries'].append(payload)
+                        # once a prompt's uploads are done, write its gallery items together
+                        if group['uploads'] == 0 and group['entries']:
+                            items = [entry['item'] for entry in group['entries']]
+                            pending[executor.submit(_write_task, items)] = ('write', group['entries'])
+                        if isinstance(result, Exception):
+                            continue
+                        timings = result
+
+                    for stage, seconds in timings.items():
+                        stage_timings.setdefault(stage, []).append(seconds)
+
+        st.caption(" · ".join(
+            f"{stage}: avg {sum(seconds) / len(seconds):.2f}s, max {max(seconds):.2f}s"
+            for stage, seconds in stage_timings.items() if seconds
+        ))
+        if transfer_stats:
+            st.caption(
+                f"s3: {sum(t.objects for t in transfer_stats)} objects, "
+                f"{sum(t.bytes for t in transfer_stats) / (1024 * 1024):.1f} MB, "
+                f"avg {sum(t.throughput for t in transfer_stats) / len(transfer_stats):.1f} MB/s per image"
+            )
 
-def upload_image(image: bytes, prompt: str, cfg: dict, tags = []):
-    image_id = f"{uuid.uuid4()}.png"
-    s3.upload_object(key=image_id, bytes=image, extra_args={'ContentType': 'image/png'})
-    db.put_item({
-        "id": image_id,
-        "url": f"{config.CDN_URL}/{image_id}",
-        "prompt": prompt,
-        "config": cfg,
-        "tags": tags,
-        "created": get_current_time()
-    })
+        if failed:
+            status.update(label=f"Generated {total - failed}/{total} prompts", state="error")
+        elif unsaved:
+            status.update(label=f"Generated, {unsaved} images not saved to the gallery", state="error")
+        else:
+            status.update(label="Generated", state="complete")
+
+def submit_generation_job(selected_prompts, num_images, cfg_scale, seed, selected_size):
+    options = {'count': num_images, 'size': selected_size.name, 'cfg': cfg_scale, 'seed': seed}
+    if st.session_state.use_colors:
+        options['colors'] = st.session_state.selected_colors
+    job_id = get_job_queue().submit({'prompts': selected_prompts, 'config': options})
+    st.session_state.jobs.insert(0, job_id)
+
+
+@st.fragment(run_every=config.JOB_POLL_SECONDS)
+def render_jobs():
+    queue = get_job_queue()
+    stats = queue.stats()
+    st.divider()
+    st.subheader("Jobs")
+    st.caption(
+        f"{stats['queued']} queued · {stats['running']} running"
+        + (f" · wait p50 {stats['wait_p50']:.1f}s · run p50 {stats['run_p50']:.1f}s" if stats['run_p50'] is not None else "")
+    )
+
+    for job_id in st.session_state.jobs[:10]:
+        job = queue.get(job_id)
+        if job is None:
+            continue
+        st.info(" / ".join(job['request'].get('prompts', [])))
+        if job['status'] == 'failed':
+            st.error(f"Generation failed: {job['error']}")
+        elif job['status'] != 'done':
+            st.caption(f"{job['status'].capitalize()}...")
+        else:
+            images = job['result']['images']
+            cols = st.columns(max(len(images), 1))
+            for idx, image in enumerate(images):
+                with cols[idx]:
+                    st.image(image['url'])
+                    st.write(image['tags'])
+            st.caption(" · ".join(f"{stage}: {seconds:.2f}s" for stage, seconds in job['result']['timings'].items()))
+
+
+def load_gallery_page():
+    page = get_db().query_page(limit=config.GALLERY_PAGE_SIZE, cursor=st.session_state.gallery_cursor)
+    st.session_state.gallery_items.extend(page["Items"])
+    st.session_state.gallery_cursor = page["cursor"]
+    st.session_state.gallery_loaded = True
+
+
+def render_search_results(results):
+    if not results:
+        st.caption("No matching images.")
+        return
+
+    cols = st.columns(5)
+    for n, (image_id, score, meta) in enumerate(results):
+        meta = meta or {}
+        with cols[n % 5]:
+            st.image(meta.get("thumbnail_url") or meta.get("url"))
+            st.caption(f"{score:.3f} · {meta.get('prompt', '')[:80]}")
+            if st.button("More like this", key=f"similar_{image_id}"):
+                st.session_state.similar_to = image_id
+                st.rerun()
+
+
+def render_gallery_search():
+    index = load_vector_index()
+    query = st.text_input("Search by text", placeholder=f"{len(index)} images indexed")
+
+    similar_to = st.session_state.get("similar_to")
+    if similar_to and similar_to in index:
+        st.caption("More like this image")
+        if st.button("Clear"):
+            st.session_state.similar_to = None
+            st.rerun()
+        render_search_results(index.search(index.get(similar_to), k=config.GALLERY_SEARCH_K, exclude=[similar_to]))
+    elif query:
+        try:
+            vector = gen_text_query_embedding(query)
+        except EmbeddingError as e:
+            st.error(f"Search failed: {e}")
+            return
+        render_search_results(index.search(vector, k=config.GALLERY_SEARCH_K))
 
 
 def render_gallery():
-    items = db.scan_items({}).get("Items")
+    render_gallery_search()
+    st.divider()
+
+    if not st.session_state.gallery_loaded:
+        load_gallery_page()
     
+    import pandas as pd  # only the gallery tab needs it
+
     df = pd.DataFrame(
-        items,
-        columns=["url", "prompt", "tags", "config", "created"],
+        st.session_state.gallery_items,
+        columns=["thumbnail_url", "url", "prompt", "tags", "config", "created"],
     )
+    df["thumbnail_url"] = df["thumbnail_url"].fillna(df["url"])
     df["config"] = df["config"].apply(lambda x: json.dumps(x, default=_decimal_default))
-    df = df.sort_values(by="created", ascending=False)
     
     st.dataframe(
         df, 
         column_config={
-            "url": st.column_config.ImageColumn(label="image"),
+            "thumbnail_url": st.column_config.ImageColumn(label="image"),
+            "url": st.column_config.LinkColumn(label="original", display_text="open"),
             "tags": st.column_config.ListColumn(label="tags")
         },
         hide_index=True,
         use_container_width=True
     ) 
 
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.session_state.gallery_cursor and st.button("Load more", use_container_width=True):
+            load_gallery_page()
+            st.rerun()
+    with col2:
+        if st.button("Refresh", use_container_width=True):
+            reset_gallery()
+            st.rerun()
+
+
+def render_metrics_sidebar():
+    snapshot = metrics.snapshot()
+    with st.sidebar:
+        st.subheader("Metrics")
+        errors = {}
+        for counter in snapshot["counters"]:
+            if counter["name"] == "stage_errors_total":
+                stage = counter["labels"]["stage"]
+                errors[stage] = errors.get(stage, 0) + counter["value"]
+
+        st.dataframe(
+            [
+                {
+                    "stage": histogram["labels"]["stage"],
+                    "count": histogram["count"],
+                    "p50": histogram["p50"],
+                    "p95": histogram["p95"],
+                    "errors": int(errors.get(histogram["labels"]["stage"], 0)),
+                }
+                for histogram in snapshot["histograms"] if histogram["name"] == "stage_seconds"
+            ],
+            hide_index=True,
+            use_container_width=True,
+        )
+
+        tokens = {
+            histogram["name"]: histogram["sum"]
+            for histogram in snapshot["histograms"] if histogram["name"] in ("llm_input_tokens", "llm_output_tokens")
+        }
+        st.caption(
+            f"input tokens: {int(tokens.get('llm_input_tokens', 0))} · "
+            f"output tokens: {int(tokens.get('llm_output_tokens', 0))}"
+        )
+        for gauge in snapshot["gauges"]:
+            if gauge["name"] == "bedrock_limiter_queue_depth" and gauge["value"]:
+                st.caption(f"{gauge['labels']['model']}: {gauge['value']} queued")
+
+        st.download_button("Prometheus", metrics.to_prometheus(), file_name="metrics.prom", use_container_width=True)
+        st.download_button("JSON", metrics.to_json(), file_name="metrics.json", use_container_width=True)
+
 
 def main():
     title = "🚀 MM-LLM Prompt-to-Image Generation"
@@ -241,6 +611,11 @@ def main():
     st.title(title)
 
     initialize_session_state()
+    warm_up_clients()
+    if config.METRICS_PORT:
+        start_metrics_server()
+    if config.METRICS_SIDEBAR:
+        render_metrics_sidebar()
     
     tab1, tab2 = st.tabs(["🎨 Image Generator", "🖼️ Image Gallery"])
     
@@ -256,9 +631,14 @@ def main():
         with col3:
             num_images, cfg_scale, seed, selected_size, generate_images_button = render_configuration_section()
 
-        if generate_images_button:
+        if generate_images_button and config.USE_JOB_QUEUE:
+            submit_generation_job(selected_prompts, num_images, cfg_scale, seed, selected_size)
+        elif generate_images_button:
             generate_images(selected_prompts, num_images, cfg_scale, seed, selected_size)
 
+        if st.session_state.jobs:
+            render_jobs()
+
     with tab2:
         render_gallery()
 
@@ -1,27 +1,31 @@
-import boto3
 import json
-from botocore.config import Config
-
-from langchain_aws.chat_models import ChatBedrock
-from langchain.callbacks import StdOutCallbackHandler
+import time
+import asyncio
+from typing import List, Optional, Union
 
+from aws.client import get_client, get_async_client, model_semaphore
+from aws.hedge import get_router
+from aws.throttle import get_limiter
+from cache import LLMCache, canonical_hash
+from image_buffer import ImageBuffer
+from metrics import metrics
+from singleflight import SingleFlight
 from config import config
 from utils import encode_image_base64
 
 
+llm_flight = SingleFlight('llm')
+
+
 class BedrockClaude():
-    def __init__(self, **model_kwargs):
+    def __init__(self, cache: LLMCache = None, **model_kwargs):
         self.region = config.BEDROCK_REGION
         self.modelId = config.LLM_MODEL_ID
-        self.bedrock = boto3.client(
-            service_name = 'bedrock-runtime',
-            region_name = self.region,
-            config = Config(
-                connect_timeout=120,
-                read_timeout=120,
-                retries={'max_attempts': 5}
-            ),
-        )
+        self.bedrock = get_client('bedrock-runtime', self.region)
+        self.cache = cache
+        self.limiter = get_limiter(self.modelId)
+        self.router = get_router(self.modelId)
+        self.stream_router = get_router(f'{self.modelId}/stream')
 
         # https://docs.aws.amazon.com/ko_kr/bedrock/latest/userguide/model-parameters.html?icmpid=docs_bedrock_help_panel_playgrounds
         self.model_kwargs = {
@@ -38,12 +42,16 @@ class BedrockClaude():
     '''
     Langchain API: get ChatBedrock
     '''
-    def get_chat_model(self, callback=StdOutCallbackHandler(), streaming=True):
+    def get_chat_model(self, callback=None, streaming=True):
+        # langchain is slow to import and only needed here
+        from langchain_aws.chat_models import ChatBedrock
+        from langchain.callbacks import StdOutCallbackHandler
+
         return ChatBedrock(
             model_id = self.modelId,
             client = self.bedrock,
             streaming = streaming,
-            callbacks = [callback],
+            callbacks = [callback or StdOutCallbackHandler()],
             model_kwargs = self.model_kwargs,
         )
     
@@ -51,58 +59,287 @@ class BedrockClaude():
     '''
     Bedrock API: invoke LLM model
     https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-anthropic-claude-messages.html
-    '''    
-    def invoke_llm(self, text: str, image: str = None, imgUrl: str = None, system: str = None):
+    '''
+    def _prepare_request(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, system: str = None, model_kwargs: dict = None):
         '''
+        Args:
+            image: a base64 image, or a list of them sent as labelled
+                   `Image n:` blocks ahead of the text in a single message
+
         Returns:
-            dict: ['id', 'type', 'role', 'content', 'model', 'stop_reason', 'stop_sequence', 'usage']
+            tuple: (request parameter, cache key or None)
         '''
         parameter = self.model_kwargs.copy()
-      
+        parameter.update(model_kwargs or {})
+
+        if isinstance(image, list):
+            image = [_encode_image(data) for data in image]
+        elif image:
+            image = _encode_image(image)
+
         content = []
+        # images
+        if isinstance(image, list):
+            for n, data in enumerate(image, start=1):
+                content.append({
+                    'type': 'text',
+                    'text': f'Image {n}:',
+                })
+                content.append(_image_block(data))
+
         # text
         if text:
             content.append({
                 'type': 'text',
                 'text': text,
             })
-        
+
         # image
-        if imgUrl:
-            image = encode_image_base64(img_url=imgUrl)
-        if image:
-            content.append({
-                'type': 'image',
-                'source': {
-                    'type': 'base64',
-                    'media_type': 'image/jpeg',
-                    'data': image,
-                }
-            })
+        if image and not isinstance(image, list):
+            content.append(_image_block(image))
 
         # system
         if system:
             parameter['system'] = system
-        
+
+        cache_key = None
+        if self.cache is not None and self.cache.cacheable(parameter):
+            cache_key = LLMCache.key(self.modelId, text, image, system, parameter)
+
         parameter.update({
             'messages': [{
                 'role': 'user',
                 'content': content
             }]
         })
+        return parameter, cache_key
+
+    def invoke_llm(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, imgUrl: str = None, system: str = None, **model_kwargs):
+        '''
+        Args:
+            model_kwargs: per-call overrides of the instance model kwargs
 
+        Returns:
+            dict: ['id', 'type', 'role', 'content', 'model', 'stop_reason', 'stop_sequence', 'usage']
+        '''
+        if imgUrl:
+            image = encode_image_base64(img_url=imgUrl)
+
+        parameter, cache_key = self._prepare_request(text, image, system, model_kwargs)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        body = json.dumps(parameter)
         try:
-            response = self.bedrock.invoke_model(
-                body=json.dumps(parameter),
-                modelId=self.modelId,
-                accept='application/json',
-                contentType='application/json'
+            # identical requests already in flight share one response
+            result = llm_flight.do(
+                canonical_hash(self.modelId, parameter), self._invoke_model, body,
+                timeout=config.SINGLEFLIGHT_TIMEOUT
             )
-            return json.loads(response.get('body').read())
         except Exception as e:
             print(e)
+            metrics.error('llm', e, model=self.modelId)
             return None
-        
-    def invoke_llm_response(self, text: str, image: str = None, imgUrl: str = None, system: str = None):
-        return self.invoke_llm(
-            text=text, image=image, imgUrl=imgUrl, system=system).get('content', [])[0].get('text', '')
+
+        if cache_key is not None:
+            self.cache.put(cache_key, result)
+        return result
+
+    def _invoke_model(self, body: str) -> dict:
+        start = time.perf_counter()
+        result = self.router.call(self._invoke_region, body)
+        self._record(body, result.get('usage', {}), time.perf_counter() - start)
+        return result
+
+    def _invoke_region(self, region: str, body: str) -> dict:
+        bedrock = self.bedrock if region == self.region else get_client('bedrock-runtime', region)
+        response = get_limiter(self.modelId, region).call(
+            bedrock.invoke_model,
+            body=body,
+            modelId=self.modelId,
+            accept='application/json',
+            contentType='application/json'
+        )
+        return json.loads(response.get('body').read())
+
+    def invoke_llm_response(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, imgUrl: str = None, system: str = None, **model_kwargs):
+        return _response_text(self.invoke_llm(
+            text=text, image=image, imgUrl=imgUrl, system=system, **model_kwargs))
+
+
+    '''
+    Bedrock API: invoke LLM model with response stream
+    '''
+    def invoke_llm_stream(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, imgUrl: str = None, system: str = None, **model_kwargs):
+        '''
+        Yields:
+            dict: {'type': 'text', 'text': str} for every text delta, then one
+                  {'type': 'stop', 'stop_reason': str, 'usage': dict}; stop_reason
+                  is 'error' when the request or the stream failed
+        '''
+        if imgUrl:
+            image = encode_image_base64(img_url=imgUrl)
+
+        parameter, cache_key = self._prepare_request(text, image, system, model_kwargs)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                yield {'type': 'text', 'text': _response_text(cached)}
+                yield {'type': 'stop', 'stop_reason': cached.get('stop_reason'), 'usage': cached.get('usage', {})}
+                return
+
+        texts = []
+        try:
+            # identical streams already in flight share one response; callers
+            # joining one get its events once it has finished
+            for event in llm_flight.do_stream(
+                canonical_hash(self.modelId, parameter, 'stream'), self._stream, json.dumps(parameter),
+                timeout=config.SINGLEFLIGHT_TIMEOUT
+            ):
+                if event['type'] == 'stop':
+                    stop = event
+                    continue
+                texts.append(event['text'])
+                yield event
+        except Exception as e:
+            # text already yielded stays with the caller
+            print(e)
+            metrics.error('llm', e, model=self.modelId)
+            yield {'type': 'stop', 'stop_reason': 'error', 'usage': {}}
+            return
+
+        if cache_key is not None:
+            self.cache.put(cache_key, {
+                'type': 'message',
+                'role': 'assistant',
+                'content': [{'type': 'text', 'text': ''.join(texts)}],
+                'model': self.modelId,
+                'stop_reason': stop['stop_reason'],
+                'usage': stop['usage'],
+            })
+        yield stop
+
+    def _stream(self, body: str):
+        start = time.perf_counter()
+        # a separate router, since time to the first event is not comparable
+        # with the latency of a whole response
+        events = self.stream_router.call(self._open_stream_region, body)
+
+        stop_reason = None
+        usage = {}
+        for event in events:
+            chunk = json.loads(event['chunk']['bytes']) if 'chunk' in event else {}
+            chunk_type = chunk.get('type')
+
+            if chunk_type == 'message_start':
+                usage.update(chunk['message'].get('usage', {}))
+            elif chunk_type == 'content_block_delta' and chunk['delta'].get('type') == 'text_delta':
+                yield {'type': 'text', 'text': chunk['delta']['text']}
+            elif chunk_type == 'message_delta':
+                stop_reason = chunk['delta'].get('stop_reason')
+                usage.update(chunk.get('usage', {}))
+        self._record(body, usage, time.perf_counter() - start)
+        yield {'type': 'stop', 'stop_reason': stop_reason, 'usage': usage}
+
+    def _open_stream_region(self, region: str, body: str):
+        bedrock = self.bedrock if region == self.region else get_client('bedrock-runtime', region)
+        response = get_limiter(self.modelId, region).call(
+            bedrock.invoke_model_with_response_stream,
+            body=body,
+            modelId=self.modelId,
+            accept='application/json',
+            contentType='application/json'
+        )
+        return response.get('body')
+
+
+    '''
+    Bedrock API: invoke LLM model on the running event loop
+
+    Requests share an aiobotocore client per loop and wait on a per-model
+    semaphore. Cancelling the awaiting task aborts the in-flight HTTP request.
+    '''
+    async def ainvoke_llm(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, imgUrl: str = None, system: str = None, **model_kwargs):
+        if imgUrl:
+            loop = asyncio.get_running_loop()
+            image = await loop.run_in_executor(None, encode_image_base64, imgUrl)
+
+        parameter, cache_key = self._prepare_request(text, image, system, model_kwargs)
+        if cache_key is not None:
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+
+        body = json.dumps(parameter)
+        try:
+            result = await llm_flight.ado(
+                canonical_hash(self.modelId, parameter), self._ainvoke, body,
+                timeout=config.SINGLEFLIGHT_TIMEOUT
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(e)
+            metrics.error('llm', e, model=self.modelId)
+            return None
+
+        if cache_key is not None:
+            self.cache.put(cache_key, result)
+        return result
+
+    async def _ainvoke(self, body: str) -> dict:
+        start = time.perf_counter()
+        result = await self.router.acall(self._ainvoke_region, body)
+        self._record(body, result.get('usage', {}), time.perf_counter() - start)
+        return result
+
+    async def _ainvoke_region(self, region: str, body: str) -> dict:
+        bedrock = await get_async_client('bedrock-runtime', region)
+        async with model_semaphore(self.modelId):
+            return await get_limiter(self.modelId, region).acall(self._ainvoke_model, bedrock, body)
+
+    def _record(self, body: str, usage: dict, seconds: float):
+        metrics.observe('llm_seconds', seconds, model=self.modelId)
+        metrics.observe('llm_request_bytes', len(body), model=self.modelId)
+        metrics.observe('llm_input_tokens', usage.get('input_tokens'), model=self.modelId)
+        metrics.observe('llm_output_tokens', usage.get('output_tokens'), model=self.modelId)
+
+    async def _ainvoke_model(self, bedrock, body: str) -> dict:
+        response = await bedrock.invoke_model(
+            body=body,
+            modelId=self.modelId,
+            accept='application/json',
+            contentType='application/json'
+        )
+        async with response['body'] as stream:
+            return json.loads(await stream.read())
+
+    async def ainvoke_llm_response(self, text: str, image: Union[str, ImageBuffer, List[Union[str, ImageBuffer]]] = None, imgUrl: str = None, system: str = None, **model_kwargs):
+        return _response_text(await self.ainvoke_llm(
+            text=text, image=image, imgUrl=imgUrl, system=system, **model_kwargs))
+
+
+def _encode_image(image: Union[str, ImageBuffer]) -> str:
+    # image blocks are declared as JPEG, so buffers are sent as resized JPEG
+    if isinstance(image, ImageBuffer):
+        return image.jpeg_base64()
+    return image
+
+
+def _image_block(image: str) -> dict:
+    return {
+        'type': 'image',
+        'source': {
+            'type': 'base64',
+            'media_type': 'image/jpeg',
+            'data': image,
+        }
+    }
+
+
+def _response_text(response: Optional[dict]) -> str:
+    # a failed call (None) or an answer without content reads as no text
+    content = (response or {}).get('content') or [{}]
+    return content[0].get('text', '')
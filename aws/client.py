@@ -0,0 +1,197 @@
+import boto3
+import asyncio
+import weakref
+import threading
+from contextlib import AsyncExitStack
+from botocore.config import Config
+
+from config import config
+
+
+_lock = threading.Lock()
+_session = None
+_clients = {}
+_resources = {}
+_async_clients = weakref.WeakKeyDictionary()
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = boto3.session.Session(
+            aws_access_key_id=config.AWS_ACCESS_KEY or None,
+            aws_secret_access_key=config.AWS_SECRET_KEY or None,
+            region_name=config.BEDROCK_REGION,
+        )
+    return _session
+
+
+def _endpoint_url(service_name: str):
+    '''
+    Optional endpoint override, e.g. DynamoDB Local or a local S3 for development.
+    '''
+    return {
+        'dynamodb': config.DYNAMODB_ENDPOINT_URL,
+        's3': config.S3_ENDPOINT_URL,
+    }.get(service_name)
+
+
+def _client_config(service_name: str):
+    if service_name == 'bedrock-runtime':
+        # retries are owned by the shared per-model limiter in aws/throttle.py
+        return Config(
+            connect_timeout=120,
+            read_timeout=120,
+            retries={'max_attempts': 0},
+            max_pool_connections=config.MAX_WORKERS,
+        )
+    if service_name == 's3':
+        # each worker may run an upload_many batch of S3_MAX_CONCURRENCY requests
+        return Config(
+            retries={'max_attempts': 5},
+            max_pool_connections=max(config.MAX_WORKERS, config.S3_MAX_CONCURRENCY * config.TAG_UPLOAD_WORKERS),
+        )
+    return Config(
+        retries={'max_attempts': 5},
+        max_pool_connections=config.MAX_WORKERS,
+    )
+
+
+'''
+Process-wide client registry
+
+boto3 clients are thread-safe, so one client per (service, region) is shared
+by every caller and its connection pool is reused across requests.
+'''
+def get_client(service_name: str, region_name: str = None):
+    region_name = region_name or config.BEDROCK_REGION
+    key = (service_name, region_name)
+
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = _get_session().client(
+                service_name=service_name,
+                region_name=region_name,
+                endpoint_url=_endpoint_url(service_name),
+                config=_client_config(service_name),
+            )
+            _clients[key] = client
+    return client
+
+
+def get_resource(service_name: str, region_name: str = None):
+    region_name = region_name or config.BEDROCK_REGION
+    key = (service_name, region_name)
+
+    resource = _resources.get(key)
+    if resource is not None:
+        return resource
+
+    with _lock:
+        resource = _resources.get(key)
+        if resource is None:
+            resource = _get_session().resource(
+                service_name=service_name,
+                region_name=region_name,
+                endpoint_url=_endpoint_url(service_name),
+                config=_client_config(service_name),
+            )
+            _resources[key] = resource
+    return resource
+
+
+def register_client(service_name: str, client, region_name: str = None):
+    '''
+    Put a client into the registry in place of a boto3 one, e.g. an
+    in-process fake for benchmarks. Must run before callers fetch it.
+    '''
+    with _lock:
+        _clients[(service_name, region_name or config.BEDROCK_REGION)] = client
+
+
+def register_resource(service_name: str, resource, region_name: str = None):
+    with _lock:
+        _resources[(service_name, region_name or config.BEDROCK_REGION)] = resource
+
+
+def warm_up(bucket_name: str = None, table_name: str = None):
+    '''
+    Build the shared clients ahead of the first request so credential
+    resolution and endpoint setup happen at startup. When a bucket or table
+    is given, a cheap metadata call also opens the first pooled connection.
+    '''
+    get_client('bedrock-runtime')
+    s3 = get_client('s3')
+    dynamodb = get_resource('dynamodb')
+
+    try:
+        if bucket_name:
+            s3.head_bucket(Bucket=bucket_name)
+        if table_name:
+            dynamodb.meta.client.describe_table(TableName=table_name)
+    except Exception as e:
+        print(e)
+
+
+'''
+Async client registry
+
+aiobotocore clients are bound to the event loop they were opened on, so the
+async registry keeps one set of clients (and one exit stack) per running loop.
+'''
+async def get_async_client(service_name: str, region_name: str = None):
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session
+
+    region_name = region_name or config.BEDROCK_REGION
+    loop = asyncio.get_running_loop()
+    clients = _async_clients.setdefault(loop, {})
+
+    client = clients.get((service_name, region_name))
+    if client is not None:
+        return client
+
+    lock = clients.setdefault('_lock', asyncio.Lock())
+    async with lock:
+        client = clients.get((service_name, region_name))
+        if client is None:
+            stack = clients.setdefault('_stack', AsyncExitStack())
+            base = _client_config(service_name)
+            client = await stack.enter_async_context(get_session().create_client(
+                service_name,
+                region_name=region_name,
+                endpoint_url=_endpoint_url(service_name),
+                aws_access_key_id=config.AWS_ACCESS_KEY or None,
+                aws_secret_access_key=config.AWS_SECRET_KEY or None,
+                config=AioConfig(
+                    connect_timeout=base.connect_timeout,
+                    read_timeout=base.read_timeout,
+                    retries=base.retries,
+                    max_pool_connections=config.ASYNC_MAX_CONCURRENCY,
+                ),
+            ))
+            clients[(service_name, region_name)] = client
+    return client
+
+
+async def close_async_clients():
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    stack = clients.get('_stack')
+    if stack is not None:
+        await stack.aclose()
+
+
+def model_semaphore(model_id: str) -> asyncio.Semaphore:
+    '''
+    Per-model cap on in-flight async requests for the running loop.
+    '''
+    semaphores = _semaphores.setdefault(asyncio.get_running_loop(), {})
+    if model_id not in semaphores:
+        semaphores[model_id] = asyncio.Semaphore(config.ASYNC_MAX_CONCURRENCY)
+    return semaphores[model_id]
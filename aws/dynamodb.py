@@ -1,29 +1,82 @@
-import boto3
 import json
+import time
+import random
+import base64
+from datetime import datetime
 from decimal import Decimal
-from config import config
+from typing import List, Optional
+from boto3.dynamodb.conditions import Key
+from aws.client import get_resource
+from metrics import metrics, traced
+
+
+GALLERY_PARTITION = 'image'
+GALLERY_ATTRIBUTES = [
+    'id', 'url', 'thumbnail_url', 'preview_url', 'prompt', 'tags', 'config', 'created', 'created_at', 'gallery',
+]
+
+
+class UnprocessedItemsError(RuntimeError):
+    def __init__(self, table_name: str, items: List[dict]):
+        super().__init__(f"{len(items)} items were not written to {table_name}")
+        self.items = items
 
 
 class DynamoDB:
-    def __init__(self, table_name):
-        self.db = boto3.resource('dynamodb',
-                                region_name=config.BEDROCK_REGION,
-                                aws_access_key_id=config.AWS_ACCESS_KEY,
-                                aws_secret_access_key=config.AWS_SECRET_KEY,
-                            )
+    def __init__(self, table_name, index_name: Optional[str] = None):
+        self.db = get_resource('dynamodb')
         self.name = table_name
         self.table = self.db.Table(table_name)
+        self.index_name = index_name
         
     def get_item(self, key):
         response = self.table.get_item(Key={
             'id': key
         })
-        return json.loads(json.dumps(response.get('Item'), default=_decimal_default))
+        return from_dynamodb(response.get('Item'))
     
     
+    @traced('dynamodb_write')
     def put_item(self, item: dict):
         self.table.put_item(
-            Item=json.loads(json.dumps(item), parse_float=Decimal)
+            Item=to_dynamodb(item)
+        )
+
+    @traced('dynamodb_write')
+    def put_items(self, items: List[dict], max_retries: int = 8):
+        '''
+        Write items with BatchWriteItem, 25 per request, retrying unprocessed
+        items with jittered exponential backoff.
+
+        Raises:
+            UnprocessedItemsError: with the items still unprocessed after
+                `max_retries`, once every batch has been tried
+        '''
+        requests = [{'PutRequest': {'Item': to_dynamodb(item)}} for item in items]
+        metrics.observe('dynamodb_write_items', len(requests))
+        unwritten = set()
+        for start in range(0, len(requests), 25):
+            pending = requests[start:start + 25]
+            for attempt in range(max_retries + 1):
+                response = self.db.batch_write_item(RequestItems={self.name: pending})
+                pending = response.get('UnprocessedItems', {}).get(self.name)
+                if not pending:
+                    break
+                metrics.inc('dynamodb_unprocessed_total', len(pending))
+                if attempt < max_retries:
+                    time.sleep(random.uniform(0, min(2.0, 0.05 * 2 ** attempt)))
+            else:
+                unwritten.update(request['PutRequest']['Item']['id'] for request in pending)
+        if unwritten:
+            raise UnprocessedItemsError(self.name, [item for item in items if item['id'] in unwritten])
+
+    def update_item(self, id, values: dict):
+        names = {f'#a{n}': name for n, name in enumerate(values)}
+        self.table.update_item(
+            Key={'id': id},
+            UpdateExpression='SET ' + ', '.join(f'{name} = :v{n}' for n, name in enumerate(names)),
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues={f':v{n}': to_dynamodb(value) for n, value in enumerate(values.values())},
         )
 
     def delete_item(self, id):
@@ -32,8 +85,130 @@ class DynamoDB:
     def scan_items(self, query):
         return self.table.scan(**query)
 
+    '''
+    Gallery index
+
+    Gallery items carry a constant `gallery` partition attribute and a numeric
+    `created_at` (epoch milliseconds) sort attribute, so a global secondary
+    index on (gallery, created_at) returns them in time order.
+    '''
+    def query_page(self,
+                   limit: int = 50,
+                   cursor: Optional[str] = None,
+                   newest_first: bool = True,
+                   attributes: Optional[List[str]] = GALLERY_ATTRIBUTES,
+                   since: Optional[int] = None) -> dict:
+        '''
+        Args:
+            attributes: attributes to read; the default leaves out large ones such as `embedding`
+            since: only items with `created_at` at or after this epoch millisecond
+
+        Returns:
+            dict: {'Items': list, 'cursor': continuation token, or None on the last page}
+        '''
+        condition = Key('gallery').eq(GALLERY_PARTITION)
+        if since is not None:
+            condition = condition & Key('created_at').gte(since)
+        query = {
+            'IndexName': self.index_name,
+            'KeyConditionExpression': condition,
+            'ScanIndexForward': not newest_first,
+            'Limit': limit,
+        }
+        if attributes:
+            query.update(_projection(attributes))
+        if cursor:
+            query['ExclusiveStartKey'] = _decode_cursor(cursor)
+
+        response = self.table.query(**query)
+        last_key = response.get('LastEvaluatedKey')
+        return {
+            'Items': response.get('Items', []),
+            'cursor': _encode_cursor(last_key) if last_key else None,
+        }
+
+    def iter_items(self, attributes: Optional[List[str]] = None, **query):
+        '''
+        Scan every page of the table, yielding items one by one.
+        '''
+        if attributes:
+            query.update(_projection(attributes))
+        while True:
+            response = self.table.scan(**query)
+            yield from response.get('Items', [])
+            if 'LastEvaluatedKey' not in response:
+                return
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def backfill_gallery_keys(self, time_format: str = '%y-%m-%d %H:%M:%S') -> int:
+        '''
+        Add the index attributes to items written before the gallery index
+        existed, deriving `created_at` from their `created` string.
+        '''
+        updated = 0
+        query = {'FilterExpression': 'attribute_not_exists(created_at)'}
+        while True:
+            response = self.table.scan(**query)
+            for item in response.get('Items', []):
+                try:
+                    created_at = int(datetime.strptime(item['created'], time_format).timestamp() * 1000)
+                except (KeyError, ValueError):
+                    created_at = 0
+                self.table.update_item(
+                    Key={'id': item['id']},
+                    UpdateExpression='SET gallery = :gallery, created_at = :created_at',
+                    ExpressionAttributeValues={':gallery': GALLERY_PARTITION, ':created_at': created_at},
+                )
+                updated += 1
+
+            if 'LastEvaluatedKey' not in response:
+                return updated
+            query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+'''
+Type conversion
+
+The boto3 resource layer takes Python values directly except for floats,
+which must be Decimal, and returns every number as Decimal.
+'''
+def to_dynamodb(value):
+    if isinstance(value, float):
+        return Decimal(repr(value))
+    if isinstance(value, dict):
+        return {k: to_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_dynamodb(v) for v in value]
+    return value
+
+
+def from_dynamodb(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, dict):
+        return {k: from_dynamodb(v) for k, v in value.items()}
+    if isinstance(value, (list, set)):
+        return [from_dynamodb(v) for v in value]
+    return value
+
 
 def _decimal_default(obj):
     if isinstance(obj, Decimal):
         return float(obj)
     raise TypeError
+
+
+def _projection(attributes: List[str]) -> dict:
+    # attribute names go through placeholders so reserved words are allowed
+    return {
+        'ProjectionExpression': ', '.join(f'#a{n}' for n in range(len(attributes))),
+        'ExpressionAttributeNames': {f'#a{n}': name for n, name in enumerate(attributes)},
+    }
+
+
+def _encode_cursor(key: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(key, default=_decimal_default).encode('utf8')).decode('ascii')
+
+
+def _decode_cursor(cursor: str) -> dict:
+    return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')), parse_float=Decimal, parse_int=Decimal)
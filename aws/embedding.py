@@ -1,76 +1,195 @@
-import boto3
+import os
+import re
 import json
-from botocore.config import Config
-from langchain_community.embeddings import BedrockEmbeddings
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from typing import List, Optional
 
+from aws.client import get_client
+from aws.throttle import get_limiter
+from cache import canonical_hash
 from config import config
+from image_buffer import ImageBuffer
+from vector_index import VectorIndex
+
+
+class EmbeddingError(Exception):
+    def __init__(self, failures: dict):
+        first = next(iter(failures.values()), None)
+        super().__init__(f"{len(failures)} embedding requests failed" + (f", first: {first}" if first else ""))
+        self.failures = failures
+
+
+class EmbeddingCache:
+    '''
+    Embeddings keyed on a hash of the model id and request body, kept in one
+    append-only, memory-mapped VectorIndex per model under `path`.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_id: str, body: dict) -> str:
+        return canonical_hash(model_id, body)
+
+    def store(self, model_id: str) -> VectorIndex:
+        with self._lock:
+            if model_id not in self._stores:
+                self._stores[model_id] = VectorIndex(
+                    path=os.path.join(self.path, re.sub(r'[^\w.-]', '_', model_id)),
+                    normalize=False,
+                )
+            return self._stores[model_id]
+
+    def get(self, model_id: str, key: str) -> Optional[np.ndarray]:
+        return self.store(model_id).get(key)
+
+    def put(self, model_id: str, key: str, vector):
+        self.store(model_id).add([key], np.asarray(vector, dtype=np.float32)[None, :])
 
 
 class BedrockEmbedding():
-    def __init__(self):
+    def __init__(self, cache: Optional[EmbeddingCache] = None):
         self.region = config.BEDROCK_REGION
-        self.bedrock = boto3.client(
-            service_name = 'bedrock-runtime',
-            region_name = self.region,
-            aws_access_key_id=config.AWS_ACCESS_KEY,
-            aws_secret_access_key=config.AWS_SECRET_KEY,
-            config = Config(
-                connect_timeout=120,
-                read_timeout=120,
-                retries={'max_attempts': 5}
-            ),
-        )
+        self.bedrock = get_client('bedrock-runtime', self.region)
+        self.cache = cache
 
         self.multimodalId = 'amazon.titan-embed-image-v1'
-        self.multimodal = BedrockEmbeddings(
+        self.textmodalId = 'amazon.titan-embed-text-v2:0'
+
+    '''
+    Langchain API: BedrockEmbeddings, imported on first use
+    '''
+    @cached_property
+    def multimodal(self):
+        from langchain_community.embeddings import BedrockEmbeddings
+        return BedrockEmbeddings(
             client=self.bedrock,
             region_name = self.region,
             model_id = self.multimodalId
         )
 
-        self.textmodalId = 'amazon.titan-embed-text-v2:0'
-        self.textmodal = BedrockEmbeddings(
+    @cached_property
+    def textmodal(self):
+        from langchain_community.embeddings import BedrockEmbeddings
+        return BedrockEmbeddings(
             client=self.bedrock,
             region_name = self.region,
             model_id = self.textmodalId
         )
-    
+
     '''
     Multimodal Embedding
     '''
     def embedding_multimodal(self, text=None, image=None):
+        '''
+        Raises:
+            EmbeddingError: if the request failed or returned no embedding
+        '''
         body = dict()
         if text is not None: body['inputText'] = text
-        if image is not None: body['inputImage'] = image
-
-        try:
-            res = self.bedrock.invoke_model(
-                body=json.dumps(body),
-                modelId=self.multimodalId,
-                accept="application/json",
-                contentType="application/json"
-            )
-            return json.loads(res.get("body").read()).get("embedding")
-        except Exception as e:
-            print(e)
-            return []
+        if image is not None: body['inputImage'] = _encode_image(image)
+        return self._embed_one(self.multimodalId, body)
 
 
     '''
     Text Embedding
     '''
     def embedding_text(self, text=None):
+        '''
+        Raises:
+            EmbeddingError: if the request failed or returned no embedding
+        '''
         body = dict()
         if text is not None: body['inputText'] = text
-        
+        return self._embed_one(self.textmodalId, body)
+
+    def _embed_one(self, model_id: str, body: dict) -> List[float]:
+        key = EmbeddingCache.key(model_id, body)
         try:
-            res = self.bedrock.invoke_model(
-                body=json.dumps(body),
-                modelId=self.textmodalId,
-                accept="application/json",
-                contentType="application/json"
-            )
-            return json.loads(res.get("body").read()).get("embedding")
+            return self._embed(model_id, body, key).tolist()
         except Exception as e:
-            print(e)
-            return []
+            raise EmbeddingError({key: e}) from e
+
+
+    '''
+    Batch Embedding
+    '''
+    def embed_many(self, texts: List[str] = None, images: List = None, max_workers: int = None) -> np.ndarray:
+        '''
+        Embed texts with the text model, or images with the multimodal model.
+        Duplicate inputs are embedded once, cached results are reused and the
+        misses fan out over a bounded pool. Every success is cached as soon as
+        it returns, so a failed or interrupted run can simply be repeated.
+
+        Returns:
+            np.ndarray: float32 matrix with one row per input, in input order
+
+        Raises:
+            EmbeddingError: after all requests finish, if any of them failed
+        '''
+        if images is not None:
+            model_id = self.multimodalId
+            bodies = [{'inputImage': _encode_image(image)} for image in images]
+        else:
+            model_id = self.textmodalId
+            bodies = [{'inputText': text} for text in texts or []]
+
+        keys = [EmbeddingCache.key(model_id, body) for body in bodies]
+        unique = dict(zip(keys, bodies))
+        vectors = {}
+
+        if self.cache is not None:
+            cached, found = self.cache.store(model_id).get_many(unique)
+            for key, vector, ok in zip(unique, cached, found):
+                if ok:
+                    vectors[key] = vector
+
+        misses = [key for key in unique if key not in vectors]
+        failures = {}
+        with ThreadPoolExecutor(max_workers=max_workers or config.EMBEDDING_WORKERS) as executor:
+            futures = {key: executor.submit(self._embed, model_id, unique[key], key) for key in misses}
+            for key, future in futures.items():
+                try:
+                    vectors[key] = future.result()
+                except Exception as e:
+                    failures[key] = e
+
+        if failures:
+            raise EmbeddingError(failures)
+        if not keys:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.ascontiguousarray(np.stack([vectors[key] for key in keys]))
+
+    def _embed(self, model_id: str, body: dict, key: str = None) -> np.ndarray:
+        key = key or EmbeddingCache.key(model_id, body)
+        if self.cache is not None:
+            cached = self.cache.get(model_id, key)
+            if cached is not None:
+                return cached
+
+        res = get_limiter(model_id).call(
+            self.bedrock.invoke_model,
+            body=json.dumps(body),
+            modelId=model_id,
+            accept="application/json",
+            contentType="application/json"
+        )
+        embedding = json.loads(res.get("body").read()).get("embedding")
+        if not embedding:
+            raise ValueError(f"{model_id} returned no embedding")
+        vector = np.asarray(embedding, dtype=np.float32)
+
+        if self.cache is not None:
+            self.cache.put(model_id, key, vector)
+        return vector
+
+
+def _encode_image(image):
+    if isinstance(image, ImageBuffer):
+        return image.jpeg_base64()
+    return image
@@ -0,0 +1,315 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Optional
+
+import numpy as np
+
+from aws.throttle import _error_code, is_retryable
+from config import config
+from metrics import metrics
+
+
+# errors that say something about the region rather than the request
+REGIONAL_CODES = {
+    'ResourceNotFoundException',
+    'AccessDeniedException',
+}
+
+
+def is_regional(e: Exception) -> bool:
+    return is_retryable(e) or _error_code(e) in REGIONAL_CODES
+
+
+class RegionHealth:
+    '''
+    Recent latency and error streak of one region. After `failure_threshold`
+    regional errors in a row the region sits out for `cooldown` seconds.
+    '''
+    def __init__(self, region: str, window: int = 200, failure_threshold: int = 3, cooldown: float = 30.0):
+        self.region = region
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.down_until = 0.0
+        self.latencies = deque(maxlen=window)
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.down_until
+
+    def on_success(self, seconds: float):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.latencies.append(seconds)
+
+    def on_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            self.down_until = time.monotonic() + self.cooldown
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        return float(np.percentile(np.fromiter(self.latencies, dtype=np.float64), q))
+
+
+class RegionRouter:
+    '''
+    Runs `fn(region, *args)` against an ordered list of regions, the first
+    being the primary.
+
+    Hedging: if the call has not returned after the primary's
+    `hedge_percentile` latency (never less than `min_delay`), the same call is
+    sent to the next healthy region. The first success wins; the other call is
+    cancelled (async) or abandoned and its result dropped (sync, where an
+    in-flight boto3 request cannot be aborted).
+
+    Failover: a regional error (throttling, 5xx, connection errors, model not
+    available) moves the call on to the next region at once. Any other error
+    is raised, since every region would reject the request the same way.
+
+    With a single region, calls run inline with no overhead, so fn can be a
+    stub taking (region, ...) to simulate slow or failing regions.
+    '''
+    def __init__(self,
+                 name: str,
+                 regions: List[str],
+                 hedge_percentile: float = 95.0,
+                 min_delay: float = 1.0,
+                 min_samples: int = 20,
+                 failure_threshold: int = 3,
+                 cooldown: float = 30.0,
+                 executor: ThreadPoolExecutor = None):
+        self.name = name
+        self.regions = list(dict.fromkeys(regions))
+        self.hedge_percentile = hedge_percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.health = {
+            region: RegionHealth(region, failure_threshold=failure_threshold, cooldown=cooldown)
+            for region in self.regions
+        }
+        self.hedges = 0
+        self.failovers = 0
+        self._executor = executor
+        self._lock = threading.Lock()
+
+    def ordered_regions(self) -> List[str]:
+        '''
+        Healthy regions in preference order, followed by the ones cooling down.
+        '''
+        with self._lock:
+            healthy = [region for region in self.regions if self.health[region].healthy]
+        return healthy + [region for region in self.regions if region not in healthy]
+
+    def hedge_delay(self, region: str) -> float:
+        with self._lock:
+            health = self.health[region]
+            if len(health.latencies) < self.min_samples:
+                return self.min_delay
+            return max(self.min_delay, health.percentile(self.hedge_percentile))
+
+    '''
+    Bookkeeping
+    '''
+    def _on_success(self, region: str, seconds: float):
+        with self._lock:
+            self.health[region].on_success(seconds)
+        metrics.observe('region_seconds', seconds, group=self.name, region=region)
+
+    def _on_failure(self, region: str, e: Exception):
+        if is_regional(e):
+            with self._lock:
+                self.health[region].on_failure()
+        metrics.inc('region_errors_total', group=self.name, region=region, error=_error_code(e) or type(e).__name__)
+
+    def _count(self, counter: str, region: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        metrics.inc(f'region_{counter}_total', group=self.name, region=region)
+
+    def _timed(self, fn, region: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = fn(region, *args, **kwargs)
+        except Exception as e:
+            self._on_failure(region, e)
+            raise
+        self._on_success(region, time.perf_counter() - start)
+        return result
+
+    async def _atimed(self, fn, region: str, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            result = await fn(region, *args, **kwargs)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._on_failure(region, e)
+            raise
+        self._on_success(region, time.perf_counter() - start)
+        return result
+
+    '''
+    Calls
+    '''
+    def call(self, fn, *args, **kwargs):
+        regions = self.ordered_regions()
+        if len(regions) == 1:
+            return self._timed(fn, regions[0], *args, **kwargs)
+
+        executor = self._get_executor()
+        pending = {}
+        error = None
+        next_region = 0
+
+        def _launch(counter: str = None):
+            nonlocal next_region
+            region = regions[next_region]
+            next_region += 1
+            if counter:
+                self._count(counter, region)
+            pending[executor.submit(self._timed, fn, region, *args, **kwargs)] = region
+
+        _launch()
+        while pending:
+            can_hedge = next_region < len(regions)
+            timeout = self.hedge_delay(regions[0]) if can_hedge and len(pending) == 1 and error is None else None
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                _launch('hedges')
+                continue
+
+            for future in done:
+                pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not is_regional(e):
+                        self._abandon(pending)
+                        raise
+                    error = e
+                    continue
+                self._abandon(pending)
+                return result
+
+            if not pending and next_region < len(regions):
+                _launch('failovers')
+        raise error
+
+    async def acall(self, fn, *args, **kwargs):
+        '''
+        Like call, for a coroutine function. Losing calls are cancelled,
+        which aborts their HTTP requests.
+        '''
+        regions = self.ordered_regions()
+        if len(regions) == 1:
+            return await self._atimed(fn, regions[0], *args, **kwargs)
+
+        pending = {}
+        error = None
+        next_region = 0
+
+        def _launch(counter: str = None):
+            nonlocal next_region
+            region = regions[next_region]
+            next_region += 1
+            if counter:
+                self._count(counter, region)
+            pending[asyncio.ensure_future(self._atimed(fn, region, *args, **kwargs))] = region
+
+        _launch()
+        try:
+            while pending:
+                can_hedge = next_region < len(regions)
+                timeout = self.hedge_delay(regions[0]) if can_hedge and len(pending) == 1 and error is None else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    _launch('hedges')
+                    continue
+
+                for task in done:
+                    pending.pop(task)
+                    e = task.exception()
+                    if e is None:
+                        return task.result()
+                    if not is_regional(e):
+                        raise e
+                    error = e
+
+                if not pending and next_region < len(regions):
+                    _launch('failovers')
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _abandon(self, pending: dict):
+        for future in pending:
+            future.cancel()
+        pending.clear()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=config.MAX_WORKERS * 2, thread_name_prefix=f'hedge-{self.name}')
+            return self._executor
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hedges': self.hedges,
+                'failovers': self.failovers,
+                'regions': {
+                    region: {
+                        'healthy': health.healthy,
+                        'successes': health.successes,
+                        'failures': health.failures,
+                        'p50': health.percentile(50),
+                        'p95': health.percentile(95),
+                    }
+                    for region, health in self.health.items()
+                },
+            }
+
+
+_lock = threading.Lock()
+_routers = {}
+
+
+def get_router(model_id: str) -> RegionRouter:
+    '''
+    Process-wide router per model id: BEDROCK_REGION, followed by
+    HEDGE_REGIONS when HEDGE_ENABLED.
+    '''
+    with _lock:
+        if model_id not in _routers:
+            regions = [config.BEDROCK_REGION] + (list(config.HEDGE_REGIONS) if config.HEDGE_ENABLED else [])
+            _routers[model_id] = RegionRouter(
+                name=model_id,
+                regions=regions,
+                hedge_percentile=config.HEDGE_PERCENTILE,
+                min_delay=config.HEDGE_MIN_DELAY,
+                failure_threshold=config.HEDGE_FAILURE_THRESHOLD,
+                cooldown=config.HEDGE_COOLDOWN,
+            )
+        return _routers[model_id]
+
+
+def _router_gauges():
+    with _lock:
+        routers = list(_routers.values())
+    return [
+        ('region_healthy', {'group': router.name, 'region': region}, int(health.healthy))
+        for router in routers if len(router.regions) > 1
+        for region, health in router.health.items()
+    ]
+
+
+metrics.add_gauges(_router_gauges)
@@ -1,23 +1,139 @@
-import boto3
+import time
+import threading
+from io import BytesIO
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional
+from boto3.s3.transfer import TransferConfig
+
+from aws.client import get_client
 from config import config
+from image_buffer import ImageBuffer
+from metrics import metrics
+
+
+@dataclass
+class TransferStats:
+    objects: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+    errors: List[tuple] = field(default_factory=list)
+
+    @property
+    def throughput(self) -> float:
+        '''
+        MB/s over the wall-clock time of the batch
+        '''
+        return self.bytes / self.seconds / (1024 * 1024) if self.seconds else 0.0
 
 
 class S3:
-    def __init__(self, bucket_name):
-        self.storage = boto3.client('s3',                            
-            region_name = config.BEDROCK_REGION,
-            aws_access_key_id=config.AWS_ACCESS_KEY,
-            aws_secret_access_key=config.AWS_SECRET_KEY,
-        )
+    def __init__(self, bucket_name, transfer_config: Optional[TransferConfig] = None, max_workers: Optional[int] = None):
+        '''
+        Args:
+            max_workers: threads shared by every upload_many call on this
+                instance (default: one batch of S3_MAX_CONCURRENCY per upload worker)
+        '''
+        self.storage = get_client('s3')
         self.bucket_name = bucket_name
+        self.transfer_config = transfer_config or TransferConfig(
+            multipart_threshold=config.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=config.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=config.S3_MAX_CONCURRENCY,
+        )
+        self.max_workers = max_workers or config.S3_MAX_CONCURRENCY * config.TAG_UPLOAD_WORKERS
+        self._executor = None
+        self._lock = threading.Lock()
 
-    def upload_object(self, bytes, key, extra_args={}):
+    def _get_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='s3-upload')
+            return self._executor
+
+    def upload_object(self, bytes, key, extra_args=None):
+        if isinstance(bytes, ImageBuffer):
+            bytes = bytes.as_file()
         self.storage.upload_fileobj(
             bytes,
             self.bucket_name,
             key,
-            ExtraArgs=extra_args
+            ExtraArgs=extra_args or {},
+            Config=self.transfer_config,
         )
 
+    def upload_many(self, objects: List[dict]) -> TransferStats:
+        '''
+        Upload many objects concurrently on this instance's thread pool, over
+        the shared connection pool. Objects below the multipart threshold go
+        out as a single PutObject.
+
+        Args:
+            objects: [{'key': str, 'bytes': ImageBuffer | bytes | file-like, 'extra_args': dict}]
+        '''
+        stats = TransferStats()
+        start = time.perf_counter()
+
+        def _upload(obj):
+            body = obj['bytes']
+            if isinstance(body, ImageBuffer):
+                body = body.data
+            if isinstance(body, (bytes, bytearray, memoryview)) and len(body) < self.transfer_config.multipart_threshold:
+                self.storage.put_object(
+                    Bucket=self.bucket_name,
+                    Key=obj['key'],
+                    Body=bytes(body),
+                    **(obj.get('extra_args') or {})
+                )
+                return len(body)
+
+            if isinstance(body, (bytes, bytearray, memoryview)):
+                size = len(body)
+                body = BytesIO(body)
+            else:
+                size = body.getbuffer().nbytes if hasattr(body, 'getbuffer') else 0
+            self.upload_object(body, obj['key'], extra_args=obj.get('extra_args'))
+            return size
+
+        executor = self._get_executor()
+        futures = [(obj['key'], executor.submit(_upload, obj)) for obj in objects]
+        for key, future in futures:
+            try:
+                stats.bytes += future.result()
+                stats.objects += 1
+            except Exception as e:
+                stats.errors.append((key, e))
+
+        stats.seconds = time.perf_counter() - start
+        metrics.observe('stage_seconds', stats.seconds, stage='s3_upload')
+        metrics.observe('s3_upload_bytes', stats.bytes)
+        metrics.observe('s3_upload_objects', stats.objects)
+        for _, e in stats.errors:
+            metrics.error('s3_upload', e)
+        return stats
+
     def get_object(self, key):
-        self.storage.get_object(Bucket=self.bucket_name, Key=key)
+        '''
+        Returns:
+            StreamingBody: read() it, or iterate with iter_chunks()
+        '''
+        response = self.storage.get_object(Bucket=self.bucket_name, Key=key)
+        return response['Body']
+
+    def get_range(self, key, start: int, end: int) -> bytes:
+        '''
+        Bytes `start` to `end` inclusive, as in an HTTP Range header.
+        '''
+        response = self.storage.get_object(
+            Bucket=self.bucket_name,
+            Key=key,
+            Range=f"bytes={start}-{end}"
+        )
+        return response['Body'].read()
+
+    def iter_object(self, key, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+        body = self.get_object(key)
+        try:
+            yield from body.iter_chunks(chunk_size=chunk_size)
+        finally:
+            body.close()
@@ -0,0 +1,292 @@
+import time
+import random
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager
+from botocore.exceptions import ClientError, ConnectionError, ReadTimeoutError
+
+from config import config
+from metrics import metrics
+
+
+THROTTLE_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceQuotaExceededException',
+}
+TRANSIENT_CODES = {
+    'ServiceUnavailableException',
+    'InternalServerException',
+    'ModelNotReadyException',
+    'ModelTimeoutException',
+}
+
+
+def _error_code(e: Exception) -> str:
+    if isinstance(e, ClientError):
+        return e.response.get('Error', {}).get('Code', '')
+    return ''
+
+
+def is_throttle(e: Exception) -> bool:
+    return _error_code(e) in THROTTLE_CODES
+
+
+def is_retryable(e: Exception) -> bool:
+    return is_throttle(e) or _error_code(e) in TRANSIENT_CODES or isinstance(e, (ConnectionError, ReadTimeoutError))
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def take(self) -> float:
+        '''
+        Take a token if one is available.
+
+        Returns:
+            float: 0 on success, otherwise seconds until the next token
+        '''
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+
+class AdaptiveLimiter:
+    '''
+    Shared limiter for one model: a token bucket caps requests per second and
+    an AIMD window caps requests in flight. Each success widens the window by
+    about one request per window; a throttling error halves it (at most once
+    per `cooldown` seconds). The limiter owns retries of throttled and
+    transient errors so that every caller backs off together.
+    '''
+    def __init__(self,
+                 name: str,
+                 rate: float = 10.0,
+                 burst: float = None,
+                 max_limit: int = 16,
+                 min_limit: int = 1,
+                 decrease: float = 0.5,
+                 max_attempts: int = 5,
+                 cooldown: float = 1.0):
+        self.name = name
+        self.bucket = TokenBucket(rate=rate, burst=burst or rate)
+        self.limit = float(max_limit)
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.decrease = decrease
+        self.max_attempts = max_attempts
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.waiting = 0
+        self.successes = 0
+        self.throttles = 0
+        self.retries = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()
+
+    '''
+    Slots
+    '''
+    def _try_enter(self) -> float:
+        # caller holds the condition; returns 0 once a slot is taken
+        if self.in_flight >= int(self.limit):
+            return -1.0
+        wait = self.bucket.take()
+        if wait:
+            return wait
+        self.in_flight += 1
+        return 0.0
+
+    def _notify(self):
+        # caller holds the condition: wake one waiting thread and one waiting coroutine
+        self._cond.notify()
+        if self._async_waiters:
+            waiter = self._async_waiters.popleft()
+            waiter.get_loop().call_soon_threadsafe(_wake, waiter)
+
+    def _leave(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._notify()
+
+    @contextmanager
+    def slot(self):
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    wait = self._try_enter()
+                    if wait == 0:
+                        break
+                    self._cond.wait(timeout=wait if wait > 0 else None)
+            finally:
+                self.waiting -= 1
+        try:
+            yield
+        finally:
+            self._leave()
+
+    async def aslot_enter(self):
+        '''
+        Take a slot from a coroutine; release it with aslot_exit. While the
+        window is full the coroutine waits on its own future, resolved by the
+        next slot release from any thread or event loop.
+        '''
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self.waiting += 1
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_enter()
+                    if wait == 0:
+                        return
+                    if wait < 0:
+                        waiter = loop.create_future()
+                        self._async_waiters.append(waiter)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+                try:
+                    await waiter
+                except asyncio.CancelledError:
+                    with self._cond:
+                        if waiter in self._async_waiters:
+                            self._async_waiters.remove(waiter)
+                        else:
+                            self._notify()  # already woken: pass the wakeup on
+                    raise
+        finally:
+            with self._cond:
+                self.waiting -= 1
+
+    def aslot_exit(self):
+        self._leave()
+
+    '''
+    AIMD
+    '''
+    def on_success(self):
+        with self._cond:
+            self.successes += 1
+            self.limit = min(self.max_limit, self.limit + 1 / max(self.limit, 1))
+            self._notify()
+
+    def on_throttle(self):
+        with self._cond:
+            self.throttles += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.cooldown:
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = now
+
+    def _on_retry(self, e: Exception):
+        if is_throttle(e):
+            self.on_throttle()
+        with self._cond:
+            self.retries += 1
+        metrics.inc('bedrock_retries_total', model=self.name, error=_error_code(e) or type(e).__name__)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(20.0, 0.5 * 2 ** attempt))
+
+    def call(self, fn, *args, **kwargs):
+        for attempt in range(self.max_attempts):
+            try:
+                with self.slot():
+                    result = fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                self._on_retry(e)
+                time.sleep(self._backoff(attempt))
+                continue
+            self.on_success()
+            metrics.observe('bedrock_retries', attempt, model=self.name)
+            return result
+
+    async def acall(self, fn, *args, **kwargs):
+        '''
+        Like call, for a coroutine function.
+        '''
+        for attempt in range(self.max_attempts):
+            await self.aslot_enter()
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_attempts - 1:
+                    raise
+                self._on_retry(e)
+                await asyncio.sleep(self._backoff(attempt))
+                continue
+            finally:
+                self.aslot_exit()
+            self.on_success()
+            metrics.observe('bedrock_retries', attempt, model=self.name)
+            return result
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'queue_depth': self.waiting,
+                'rate': self.bucket.rate,
+                'successes': self.successes,
+                'throttles': self.throttles,
+                'retries': self.retries,
+            }
+
+
+def _wake(waiter: asyncio.Future):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def get_limiter(model_id: str, region_name: str = None) -> AdaptiveLimiter:
+    '''
+    Process-wide limiter per model id, and per region for regions other than
+    BEDROCK_REGION since quotas are regional. BEDROCK_LIMITS can override the
+    defaults per model, e.g. {"amazon.titan-image-generator-v2:0": {"rate": 2, "max_limit": 4}}.
+    '''
+    name = model_id if region_name in (None, config.BEDROCK_REGION) else f'{model_id}@{region_name}'
+    with _lock:
+        if name not in _limiters:
+            options = {
+                'rate': config.BEDROCK_RPS,
+                'max_limit': config.BEDROCK_MAX_IN_FLIGHT,
+                'max_attempts': config.BEDROCK_MAX_ATTEMPTS,
+            }
+            options.update(config.BEDROCK_LIMITS.get(model_id, {}))
+            _limiters[name] = AdaptiveLimiter(name=name, **options)
+        return _limiters[name]
+
+
+def limiter_metrics() -> dict:
+    with _lock:
+        return {model_id: limiter.metrics() for model_id, limiter in _limiters.items()}
+
+
+def _limiter_gauges():
+    return [
+        (f'bedrock_limiter_{name}', {'model': model_id}, value)
+        for model_id, values in limiter_metrics().items()
+        for name, value in values.items() if name in ('limit', 'in_flight', 'queue_depth')
+    ]
+
+
+metrics.add_gauges(_limiter_gauges)
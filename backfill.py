@@ -0,0 +1,81 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from aws.dynamodb import DynamoDB, from_dynamodb
+from aws.embedding import EmbeddingError
+from aws.s3 import S3
+from config import config
+from generator import get_embedding
+from image_buffer import ImageBuffer
+from reuse import config_signature
+from vector_index import VectorIndex
+
+
+'''
+Embedding backfill
+
+Embeds gallery items that were stored without `embedding` or
+`prompt_embedding`, writes the vectors back to DynamoDB and appends them to
+the local search and reuse indexes. Embeddings are cached on disk as they
+arrive, so an interrupted run can be restarted without paying for them again.
+
+    python backfill.py --batch-size 64
+'''
+def backfill(batch_size: int = 64, workers: int = None):
+    s3 = S3(bucket_name=config.S3_BUCKET)
+    db = DynamoDB(table_name=config.DYNAMODB_TABLE)
+    image_index = VectorIndex(path=config.VECTOR_INDEX_DIR)
+    prompt_index = VectorIndex(path=config.PROMPT_INDEX_DIR)
+
+    items = db.iter_items(
+        attributes=["id", "url", "thumbnail_url", "prompt", "config"],
+        FilterExpression='attribute_not_exists(embedding) OR attribute_not_exists(prompt_embedding)',
+    )
+
+    done = 0
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            done += _backfill_batch(batch, s3, db, image_index, prompt_index, workers)
+            print(f"{done} items backfilled")
+            batch = []
+    if batch:
+        done += _backfill_batch(batch, s3, db, image_index, prompt_index, workers)
+    print(f"{done} items backfilled")
+
+
+def _backfill_batch(items, s3, db, image_index, prompt_index, workers):
+    with ThreadPoolExecutor(max_workers=workers or config.EMBEDDING_WORKERS) as executor:
+        images = list(executor.map(lambda item: ImageBuffer(s3.get_object(item["id"]).read()), items))
+
+    embedding = get_embedding()
+    try:
+        image_vectors = embedding.embed_many(images=images, max_workers=workers)
+        prompt_vectors = embedding.embed_many(texts=[item.get("prompt", "") for item in items], max_workers=workers)
+    except EmbeddingError as e:
+        print(f"{e}; successful embeddings are cached, rerun to resume")
+        raise
+
+    for item, image_vector, prompt_vector in zip(items, image_vectors, prompt_vectors):
+        db.update_item(item["id"], {
+            "embedding": image_vector.tobytes(),
+            "prompt_embedding": prompt_vector.tobytes(),
+        })
+
+    metadata = [{key: item.get(key) for key in ("url", "thumbnail_url", "prompt")} for item in items]
+    ids = [item["id"] for item in items]
+    image_index.add(ids, image_vectors, metadata)
+    prompt_index.add(ids, prompt_vectors, [
+        {**meta, "signature": config_signature(from_dynamodb(item.get("config", {})))}
+        for meta, item in zip(metadata, items)
+    ])
+    return len(items)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill gallery embeddings")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+    backfill(batch_size=args.batch_size, workers=args.workers)
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List
+
+from aws.dynamodb import DynamoDB
+from aws.s3 import S3
+from cache import canonical_hash
+from config import config
+from gallery import upload_image
+from generator import gen_english, gen_image_prompt, gen_mm_image_prompt, gen_tags_batch
+from image_buffer import ImageBuffer
+from metrics import serve as serve_metrics
+from params import ImageParams, ImageSize
+from planner import gen_images
+from prompt import DEFAULT_STYLE
+from utils import timer
+
+
+'''
+Batch generation
+
+Streams a JSONL file of requests through prompt generation, image
+generation, tagging and upload without the Streamlit UI. One request per
+line; every field except one of `prompt`, `prompts` or `keyword` is
+optional:
+
+    {"id": "spring-01", "prompt": "벚꽃이 핀 공원", "translate": true}
+    {"id": "spring-02", "keyword": "cherry blossom", "style": "watercolor",
+     "image": "data/food.png", "llm": {"temperature": 0.7},
+     "config": {"count": 8, "policy": "latency", "size": "SIZE_1024x1024", "cfg": 8.0, "seed": 42, "colors": ["#ffc0cb"]}}
+
+`prompt` is translated to English (unless `translate` is false), `prompts`
+are English prompts used as they are, and `keyword` is expanded by the LLM,
+with `image` as a reference image if given (paths are relative to the
+requests file). `count` images per prompt are split into parallel
+requests by planner.py under `policy` (default IMAGE_SHARD_POLICY).
+Requests without an `id` are keyed on a hash of their content. The whole
+file is validated before the first request starts.
+
+Finished requests are appended to a checkpoint log and skipped on the next
+run. Expanded prompts are checkpointed as well and the image seed is fixed
+per request, so a resumed request regenerates the same bodies and is served
+from the image cache. One manifest line with per-stage timings is written
+per finished or failed request.
+
+    python batch.py campaign.jsonl --manifest campaign.results.jsonl
+'''
+class Checkpoint:
+    '''
+    Append-only JSONL log of `{"id", "stage", ...}` records. The latest
+    record per request wins; a torn last line from a killed run is ignored.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.records = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records.setdefault(record['id'], {}).update(record)
+
+    def get(self, request_id: str) -> dict:
+        with self._lock:
+            return dict(self.records.get(request_id, {}))
+
+    def done(self, request_id: str) -> bool:
+        return self.get(request_id).get('stage') == 'done'
+
+    def record(self, request_id: str, stage: str, **data):
+        record = {'id': request_id, 'stage': stage, **data}
+        with self._lock:
+            self.records.setdefault(request_id, {}).update(record)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+
+class BatchRunner:
+    def __init__(self,
+                 checkpoint: Checkpoint,
+                 manifest: str,
+                 base_dir: str = '.',
+                 prompt_workers: int = 4,
+                 generate_workers: int = 4,
+                 tag_workers: int = 4,
+                 upload_workers: int = 8,
+                 max_in_flight: int = 16):
+        self.checkpoint = checkpoint
+        self.manifest = manifest
+        self.base_dir = base_dir
+        self.max_in_flight = max_in_flight
+        self.s3 = S3(bucket_name=config.S3_BUCKET)
+        self.db = DynamoDB(table_name=config.DYNAMODB_TABLE)
+
+        self.stages = {
+            'prompt': ThreadPoolExecutor(max_workers=prompt_workers, thread_name_prefix='prompt'),
+            'generate': ThreadPoolExecutor(max_workers=generate_workers, thread_name_prefix='generate'),
+            'tag': ThreadPoolExecutor(max_workers=tag_workers, thread_name_prefix='tag'),
+            'upload': ThreadPoolExecutor(max_workers=upload_workers, thread_name_prefix='upload'),
+        }
+        self.counts = {'done': 0, 'failed': 0, 'skipped': 0}
+        self._lock = threading.Lock()
+
+    def run(self, requests: Iterable[dict]) -> dict:
+        '''
+        Process requests with at most `max_in_flight` of them between stages
+        at once. Each request runs on a driver thread that hands its work to
+        the per-stage pools, so each stage is bounded by its own worker count.
+
+        Returns:
+            dict: number of requests done, failed and skipped
+        '''
+        slots = threading.BoundedSemaphore(self.max_in_flight)
+
+        def _drive(request):
+            try:
+                self.process(request)
+            finally:
+                slots.release()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix='request') as drivers:
+            for request in requests:
+                if self.checkpoint.done(request['id']):
+                    self._count('skipped')
+                    continue
+                slots.acquire()
+                drivers.submit(_drive, request)
+
+        self.close()
+        print(f"{self.counts['done']} done, {self.counts['failed']} failed, "
+              f"{self.counts['skipped']} skipped in {time.perf_counter() - start:.1f}s")
+        return self.counts
+
+    def close(self):
+        for executor in self.stages.values():
+            executor.shutdown()
+
+    def process(self, request: dict):
+        request_id = request['id']
+        timings = {}
+        result = {'id': request_id}
+        try:
+            with timer(timings, 'total'):
+                state = self.checkpoint.get(request_id)
+                if 'prompts' in state:
+                    prompts = state['prompts']
+                else:
+                    with timer(timings, 'prompt'):
+                        prompts = self._submit('prompt', self.expand_prompts, request).result()
+                    self.checkpoint.record(request_id, 'prompts', prompts=prompts)
+                result['prompts'] = prompts
+                images = self.execute(request, prompts, timings)
+
+            self.checkpoint.record(request_id, 'done', images=[image['id'] for image in images])
+            result.update({'status': 'done', 'images': images})
+            self._count('done')
+        except Exception as e:
+            print(f"{request_id}: {e}")
+            result.update({'status': 'failed', 'error': str(e)})
+            self._count('failed')
+
+        result['timings'] = {stage: round(seconds, 3) for stage, seconds in timings.items()}
+        self._write_manifest(result)
+
+    def execute(self, request: dict, prompts: List[str], timings: dict) -> List[dict]:
+        '''
+        Generate, tag and upload the images for a request's prompts and write
+        their gallery items.
+
+        Returns:
+            list: {'id', 'url', 'tags'} per uploaded image
+        '''
+        request_id = request['id']
+        with timer(timings, 'generate'):
+            futures = [
+                self._submit('generate', self.generate, request, prompt)
+                for prompt in prompts
+            ]
+            generated = [(prompt, *future.result()) for prompt, future in zip(prompts, futures)]
+
+        entries = [
+            {'prompt': prompt, 'cfg': {**cfg, **image_cfg}, 'image': image, 'key': (n, m)}
+            for n, (prompt, images, cfg) in enumerate(generated)
+            for m, (image, image_cfg) in enumerate(images)
+        ]
+
+        with timer(timings, 'tag'):
+            futures = [
+                self._submit('tag', gen_tags_batch, [entry['image'] for entry in entries[start:start + config.TAG_BATCH_SIZE]])
+                for start in range(0, len(entries), config.TAG_BATCH_SIZE)
+            ]
+            tags = [image_tags for future in futures for image_tags in future.result()]
+
+        with timer(timings, 'upload'):
+            futures = [
+                self._submit('upload', self.upload, request_id, entry, image_tags)
+                for entry, image_tags in zip(entries, tags)
+            ]
+            items = [future.result() for future in futures]
+
+        with timer(timings, 'db_write'):
+            self.db.put_items(items)
+        return [{'id': item['id'], 'url': item['url'], 'tags': item['tags']} for item in items]
+
+    '''
+    Stages
+    '''
+    def expand_prompts(self, request: dict) -> List[str]:
+        llm = request.get('llm', {})
+        if 'prompts' in request:
+            prompts = [prompt for prompt in request['prompts'] if prompt]
+        elif 'prompt' in request:
+            prompt = request['prompt']
+            if request.get('translate', True):
+                prompt = gen_english(request=prompt)
+            prompts = [prompt] if prompt else []
+        elif request.get('image'):
+            image = ImageBuffer.from_file(os.path.join(self.base_dir, request['image']))
+            prompts = gen_mm_image_prompt(request=request['keyword'], image=image, **llm)
+        else:
+            prompts = gen_image_prompt(request=request['keyword'], style=request.get('style', DEFAULT_STYLE), **llm)
+
+        if not prompts:
+            raise ValueError("no prompts generated")
+        return prompts
+
+    def generate(self, request: dict, prompt: str) -> tuple:
+        options = request.get('config', {})
+        img_params = ImageParams(seed=options.get('seed', _request_seed(request['id'])))
+        img_params.set_configuration(
+            count=options.get('count', 1),
+            size=_image_size(options.get('size')),
+            cfg=options.get('cfg', 8.0),
+        )
+        cfg = img_params.get_configuration()
+
+        if options.get('colors'):
+            build_body = lambda params: params.color_guide(text=prompt, colors=options['colors'])
+            cfg['colorGuide'] = options['colors']
+        else:
+            build_body = lambda params: params.text_to_image(text=prompt)
+
+        return gen_images(img_params, options.get('count', 1), build_body, policy=options.get('policy')), cfg
+
+    def upload(self, request_id: str, entry: dict, tags: List[str]) -> dict:
+        item, _ = upload_image(
+            image=entry['image'],
+            prompt=entry['prompt'],
+            cfg=entry['cfg'],
+            tags=tags,
+            s3=self.s3,
+            image_uuid=canonical_hash(request_id, *entry['key'])[:32],
+        )
+        return item
+
+    def _submit(self, stage: str, fn, *args):
+        return self.stages[stage].submit(fn, *args)
+
+    def _count(self, status: str):
+        with self._lock:
+            self.counts[status] += 1
+
+    def _write_manifest(self, result: dict):
+        with self._lock:
+            with open(self.manifest, 'a') as f:
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+
+def read_requests(path: str) -> List[dict]:
+    '''
+    Read and validate the whole file, so a bad line stops the run before any
+    request has started rather than partway through it.
+
+    Raises:
+        ValueError: listing every invalid line
+    '''
+    requests = []
+    errors = []
+    with open(path) as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                errors.append(f"{path}:{n}: invalid JSON: {e}")
+                continue
+            if not isinstance(request, dict) or not {'prompt', 'prompts', 'keyword'} & request.keys():
+                errors.append(f"{path}:{n}: request needs a prompt, prompts or keyword")
+                continue
+            request.setdefault('id', canonical_hash(request)[:16])
+            requests.append(request)
+
+    if errors:
+        raise ValueError('\n'.join(errors))
+    return requests
+
+
+def _request_seed(request_id: str) -> int:
+    return int(canonical_hash(request_id), 16) % 2147483647
+
+
+def _image_size(size) -> ImageSize:
+    if size is None:
+        return ImageSize.SIZE_512x512
+    if isinstance(size, str):
+        return ImageSize[size]
+    return ImageSize(tuple(size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and upload images for a JSONL file of requests")
+    parser.add_argument("requests")
+    parser.add_argument("--manifest", default=None, help="results manifest (default: <requests>.results.jsonl)")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint log (default: <requests>.checkpoint.jsonl)")
+    parser.add_argument("--prompt-workers", type=int, default=4)
+    parser.add_argument("--generate-workers", type=int, default=4)
+    parser.add_argument("--tag-workers", type=int, default=4)
+    parser.add_argument("--upload-workers", type=int, default=8)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    parser.add_argument("--metrics-port", type=int, default=config.METRICS_PORT, help="serve /metrics while running")
+    args = parser.parse_args()
+
+    try:
+        requests = read_requests(args.requests)
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    stem = os.path.splitext(args.requests)[0]
+    runner = BatchRunner(
+        checkpoint=Checkpoint(args.checkpoint or f"{stem}.checkpoint.jsonl"),
+        manifest=args.manifest or f"{stem}.results.jsonl",
+        base_dir=os.path.dirname(os.path.abspath(args.requests)),
+        prompt_workers=args.prompt_workers,
+        generate_workers=args.generate_workers,
+        tag_workers=args.tag_workers,
+        upload_workers=args.upload_workers,
+        max_in_flight=args.max_in_flight,
+    )
+    runner.run(requests)
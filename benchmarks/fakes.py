@@ -0,0 +1,409 @@
+import io
+import re
+import json
+import time
+import zlib
+import base64
+import random
+import threading
+from decimal import Decimal
+from functools import lru_cache
+from types import SimpleNamespace
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+from botocore.exceptions import ClientError
+
+
+'''
+In-process fakes
+
+Stand-ins for the bedrock-runtime and S3 clients and the DynamoDB resource,
+registered with aws.client.register_client/register_resource so the app code
+runs unchanged against them. Each call sleeps for a latency drawn from a
+configurable distribution; bedrock-runtime can also throttle.
+'''
+class Latency:
+    '''
+    Seconds per call.
+
+    Args:
+        distribution: 'fixed', 'uniform' (between `median` and `high`) or
+            'lognormal' (with `median` and shape `sigma`)
+    '''
+    def __init__(self, median: float = 0.0, distribution: str = 'lognormal', sigma: float = 0.3,
+                 high: Optional[float] = None, seed: int = 0):
+        self.median = median
+        self.distribution = distribution
+        self.sigma = sigma
+        self.high = high if high is not None else median * 2
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        with self._lock:
+            if self.distribution == 'fixed':
+                return self.median
+            if self.distribution == 'uniform':
+                return self._random.uniform(self.median, self.high)
+            return self._random.lognormvariate(np.log(self.median), self.sigma)
+
+    def wait(self):
+        seconds = self.sample()
+        if seconds:
+            time.sleep(seconds)
+
+
+def _client_error(code: str, operation: str) -> ClientError:
+    return ClientError({'Error': {'Code': code, 'Message': 'fake'}}, operation)
+
+
+@lru_cache(maxsize=32)
+def fake_png(width: int, height: int, seed: int = 0) -> str:
+    '''
+    Base64 PNG of random noise, about as large as a real generated image.
+    '''
+    pixels = np.random.default_rng(seed).integers(0, 256, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf8')
+
+
+class FakeBedrockRuntime:
+    '''
+    invoke_model for Titan image, Titan embedding and Claude messages models.
+
+    Args:
+        latency: per-model-family Latency, keyed 'image', 'embedding' and 'llm'
+        throttle_rate: probability that a call fails with ThrottlingException
+        max_concurrency: calls beyond this many in flight are throttled
+        error_rate: probability that a call fails with `error_code`, e.g. to
+            simulate a regional outage
+        per_image: extra image latency per additional image in a request, as
+            a fraction of the sampled latency
+    '''
+    def __init__(self, latency: dict = None, throttle_rate: float = 0.0,
+                 max_concurrency: Optional[int] = None, embedding_dim: int = 1024, seed: int = 0,
+                 error_rate: float = 0.0, error_code: str = 'ServiceUnavailableException', per_image: float = 0.0):
+        self.latency = {'image': Latency(), 'embedding': Latency(), 'llm': Latency(), **(latency or {})}
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.per_image = per_image
+        self.max_concurrency = max_concurrency
+        self.embedding_dim = embedding_dim
+        self.calls = 0
+        self.throttles = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def invoke_model(self, body, modelId: str, accept: str = None, contentType: str = None):
+        request = json.loads(body)
+        family = _model_family(modelId)
+
+        with self._lock:
+            self.calls += 1
+            throttled = (
+                self._random.random() < self.throttle_rate
+                or (self.max_concurrency is not None and self.in_flight >= self.max_concurrency)
+            )
+            if throttled:
+                self.throttles += 1
+            else:
+                self.in_flight += 1
+                self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        if throttled:
+            raise _client_error('ThrottlingException', 'InvokeModel')
+
+        try:
+            seconds = self.latency[family].sample()
+            if family == 'image' and self.per_image:
+                count = request.get('imageGenerationConfig', {}).get('numberOfImages', 1)
+                seconds *= 1 + self.per_image * (count - 1)
+            if seconds:
+                time.sleep(seconds)
+            if self.error_rate and self._random.random() < self.error_rate:
+                raise _client_error(self.error_code, 'InvokeModel')
+            response = getattr(self, f'_{family}')(request)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+        return {'body': io.BytesIO(json.dumps(response).encode('utf8'))}
+
+    def _image(self, request: dict) -> dict:
+        image_config = request.get('imageGenerationConfig', {})
+        image = fake_png(image_config.get('width', 512), image_config.get('height', 512))
+        return {'images': [image] * image_config.get('numberOfImages', 1)}
+
+    def _embedding(self, request: dict) -> dict:
+        rng = np.random.default_rng(zlib.crc32(json.dumps(request, sort_keys=True).encode('utf8')))
+        return {'embedding': rng.standard_normal(self.embedding_dim).astype(np.float32).tolist()}
+
+    def _llm(self, request: dict) -> dict:
+        content = request['messages'][-1]['content']
+        images = sum(1 for block in content if block.get('type') == 'image')
+        if images > 1:
+            text = json.dumps({str(n): ['fake', f'tag{n}'] for n in range(1, images + 1)})
+        elif images == 1:
+            text = json.dumps(['fake', 'tag'])
+        else:
+            text = ''.join(f'<prompt>fake image prompt {n}</prompt>' for n in range(1, 4))
+        return {
+            'content': [{'type': 'text', 'text': text}],
+            'stop_reason': 'end_turn',
+            'usage': {'input_tokens': 100 + 1500 * images, 'output_tokens': len(text) // 4},
+        }
+
+
+def _model_family(model_id: str) -> str:
+    if 'embed' in model_id:
+        return 'embedding'
+    if 'image' in model_id:
+        return 'image'
+    return 'llm'
+
+
+class FakeS3:
+    def __init__(self, latency: Latency = None):
+        self.latency = latency or Latency()
+        self.objects = {}
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs):
+        self.latency.wait()
+        data = Body if isinstance(Body, bytes) else Body.read()
+        with self._lock:
+            self.objects[(Bucket, Key)] = bytes(data)
+        return {}
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs=None, Config=None, **kwargs):
+        self.put_object(Bucket=Bucket, Key=Key, Body=Fileobj.read())
+
+    def get_object(self, Bucket: str, Key: str, Range: str = None):
+        self.latency.wait()
+        with self._lock:
+            data = self.objects.get((Bucket, Key))
+        if data is None:
+            raise _client_error('NoSuchKey', 'GetObject')
+        if Range:
+            start, end = Range.split('=')[1].split('-')
+            data = data[int(start):int(end) + 1]
+        return {'Body': _StreamingBody(data)}
+
+    def head_bucket(self, Bucket: str):
+        return {}
+
+
+class _StreamingBody(io.BytesIO):
+    def iter_chunks(self, chunk_size: int = 1024):
+        while True:
+            chunk = self.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+class FakeTable:
+    '''
+    The subset of a DynamoDB Table used by aws/dynamodb.py. Query walks every
+    item ordered by `created_at`, which is what the gallery index returns for
+    its single partition, keeping those that match the key condition.
+    '''
+    def __init__(self, name: str, latency: Latency):
+        self.name = name
+        self.latency = latency
+        self.items = {}
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def load(self, items):
+        '''
+        Insert items directly, without latency, to seed a benchmark.
+        '''
+        with self._lock:
+            for item in items:
+                self.items[item['id']] = _stored(item)
+            self._views.clear()
+
+    def put_item(self, Item: dict):
+        self.latency.wait()
+        with self._lock:
+            self.items[Item['id']] = _stored(Item)
+            self._views.clear()
+
+    def get_item(self, Key: dict):
+        self.latency.wait()
+        with self._lock:
+            item = self.items.get(Key['id'])
+        return {'Item': item} if item is not None else {}
+
+    def update_item(self, Key: dict, UpdateExpression: str, ExpressionAttributeValues: dict,
+                    ExpressionAttributeNames: dict = None, **kwargs):
+        '''
+        Applies `SET a = :v, ...` expressions.
+        '''
+        self.latency.wait()
+        names = ExpressionAttributeNames or {}
+        assignments = UpdateExpression.split('SET', 1)[1].split(',')
+        with self._lock:
+            item = self.items.setdefault(Key['id'], dict(Key))
+            for assignment in assignments:
+                name, value = (part.strip() for part in assignment.split('='))
+                item[names.get(name, name)] = _stored(ExpressionAttributeValues[value])
+            self._views.clear()
+
+    def delete_item(self, Key: dict):
+        self.latency.wait()
+        with self._lock:
+            self.items.pop(Key['id'], None)
+            self._views.clear()
+
+    def query(self, Limit: int = None, ExclusiveStartKey: dict = None, ScanIndexForward: bool = True,
+              ProjectionExpression: str = None, ExpressionAttributeNames: dict = None,
+              KeyConditionExpression=None, **kwargs):
+        self.latency.wait()
+        view = self._view('newest' if not ScanIndexForward else 'oldest', KeyConditionExpression)
+        return self._page(view, Limit, ExclusiveStartKey, ProjectionExpression, ExpressionAttributeNames)
+
+    def scan(self, Limit: int = None, ExclusiveStartKey: dict = None,
+             ProjectionExpression: str = None, ExpressionAttributeNames: dict = None,
+             FilterExpression: str = None, **kwargs):
+        '''
+        FilterExpression supports `attribute_not_exists(name)` terms joined by
+        OR, applied to each page after it is read, as DynamoDB does.
+        '''
+        self.latency.wait()
+        view = self._view('scan')
+        response = self._page(view, Limit or 1000, ExclusiveStartKey, ProjectionExpression, ExpressionAttributeNames)
+        if FilterExpression:
+            missing = re.findall(r'attribute_not_exists\((\w+)\)', FilterExpression)
+            response['Items'] = [item for item in response['Items'] if any(name not in item for name in missing)]
+            response['Count'] = len(response['Items'])
+        return response
+
+    def _view(self, order: str, condition=None) -> tuple:
+        # (items in order, id -> position) per order and key condition, rebuilt after writes
+        key = (order, _condition_key(condition))
+        with self._lock:
+            if key not in self._views:
+                items = list(self.items.values())
+                if order != 'scan':
+                    items.sort(key=lambda item: (item.get('created_at', 0), item['id']), reverse=order == 'newest')
+                if condition is not None:
+                    matches = _condition(condition)
+                    items = [item for item in items if matches(item)]
+                self._views[key] = (items, {item['id']: n for n, item in enumerate(items)})
+            return self._views[key]
+
+    def _page(self, view, limit, start_key, projection, names):
+        items, positions = view
+        start = positions[start_key['id']] + 1 if start_key else 0
+        page = items[start:start + limit] if limit else items[start:]
+
+        if projection:
+            attributes = [names.get(name.strip(), name.strip()) for name in projection.split(',')]
+            page = [{key: item[key] for key in attributes if key in item} for item in page]
+
+        response = {'Items': page, 'Count': len(page)}
+        if limit and start + limit < len(items):
+            last = items[start + limit - 1]
+            response['LastEvaluatedKey'] = {
+                key: last[key] for key in ('id', 'gallery', 'created_at') if key in last
+            }
+        return response
+
+
+def _condition_key(condition):
+    if condition is None:
+        return None
+    expression = condition.get_expression()
+    return (expression['operator'],) + tuple(
+        _condition_key(value) if hasattr(value, 'get_expression')
+        else getattr(value, 'name', value)
+        for value in expression['values']
+    )
+
+
+def _condition(condition):
+    '''
+    Predicate for a boto3 key condition built from eq/lt/lte/gt/gte/between and &.
+    '''
+    expression = condition.get_expression()
+    operator, values = expression['operator'], expression['values']
+    if operator == 'AND':
+        left, right = _condition(values[0]), _condition(values[1])
+        return lambda item: left(item) and right(item)
+
+    name = values[0].name
+    compare = {
+        '=': lambda value: value == values[1],
+        '<': lambda value: value < values[1],
+        '<=': lambda value: value <= values[1],
+        '>': lambda value: value > values[1],
+        '>=': lambda value: value >= values[1],
+        'BETWEEN': lambda value: values[1] <= value <= values[2],
+    }[operator]
+    return lambda item: name in item and compare(item[name])
+
+
+class FakeDynamoDB:
+    '''
+    Resource-level fake: Table(), batch_write_item() and meta.client.
+
+    Args:
+        unprocessed_rate: probability that each item of a batch_write_item
+            call is returned in UnprocessedItems instead of written
+    '''
+    def __init__(self, latency: Latency = None, unprocessed_rate: float = 0.0, seed: int = 0):
+        self.latency = latency or Latency()
+        self.unprocessed_rate = unprocessed_rate
+        self.batch_writes = 0
+        self.tables = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.meta = SimpleNamespace(client=SimpleNamespace(describe_table=lambda TableName: {}))
+
+    def Table(self, name: str) -> FakeTable:
+        with self._lock:
+            if name not in self.tables:
+                self.tables[name] = FakeTable(name, self.latency)
+            return self.tables[name]
+
+    def batch_write_item(self, RequestItems: dict):
+        self.latency.wait()
+        unprocessed = {}
+        for name, requests in RequestItems.items():
+            table = self.Table(name)
+            with self._lock:
+                self.batch_writes += 1
+                skip = [self._random.random() < self.unprocessed_rate for _ in requests]
+            skipped = [request for request, skip_request in zip(requests, skip) if skip_request]
+            with table._lock:
+                for request, skip_request in zip(requests, skip):
+                    if not skip_request:
+                        item = request['PutRequest']['Item']
+                        table.items[item['id']] = _stored(item)
+                table._views.clear()
+            if skipped:
+                unprocessed[name] = skipped
+        return {'UnprocessedItems': unprocessed}
+
+
+def _stored(item: dict) -> dict:
+    # numbers come back as Decimal, like the real resource layer
+    def convert(value):
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, (int, float)):
+            return Decimal(repr(value))
+        if isinstance(value, dict):
+            return {k: convert(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [convert(v) for v in value]
+        return value
+    return convert(item)
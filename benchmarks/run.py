@@ -0,0 +1,488 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# read settings from the environment / .env only and measure uncached calls
+for _name, _value in {
+    'USE_SECRETS_MANAGER': 'false',
+    'IMAGE_CACHE_ENABLED': 'false',
+    'LLM_CACHE_ENABLED': 'false',
+    'EMBEDDING_CACHE_ENABLED': 'false',
+}.items():
+    os.environ.setdefault(_name, _value)
+
+from benchmarks.fakes import FakeBedrockRuntime, FakeDynamoDB, FakeS3, Latency
+
+
+'''
+Benchmarks
+
+Runs the hot paths against in-process fakes of bedrock-runtime, S3 and
+DynamoDB and prints one JSON document, so results can be saved per commit
+and compared:
+
+    python benchmarks/run.py --output bench-$(git rev-parse --short HEAD).json
+    python benchmarks/run.py --only gallery_load --latency-scale 0
+
+Fake latencies are typical service latencies multiplied by --latency-scale.
+'''
+LATENCY = {
+    'image': 6.0,
+    'llm': 3.0,
+    'embedding': 0.2,
+    's3': 0.05,
+    'dynamodb': 0.01,
+}
+
+
+def summarize(samples: List[float]) -> dict:
+    samples = np.asarray(samples, dtype=np.float64)
+    return {
+        'runs': int(len(samples)),
+        'mean': float(samples.mean()),
+        'p50': float(np.percentile(samples, 50)),
+        'p95': float(np.percentile(samples, 95)),
+        'min': float(samples.min()),
+        'max': float(samples.max()),
+    }
+
+
+def measure(fn: Callable, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def install_fakes(args) -> dict:
+    '''
+    Register the fakes before any app module builds its clients.
+    '''
+    from aws.client import register_client, register_resource
+
+    def latency(name):
+        return Latency(LATENCY[name] * args.latency_scale, distribution=args.distribution, sigma=args.sigma)
+
+    fakes = {
+        'bedrock': FakeBedrockRuntime(latency={name: latency(name) for name in ('image', 'llm', 'embedding')}),
+        's3': FakeS3(latency('s3')),
+        'dynamodb': FakeDynamoDB(latency('dynamodb')),
+    }
+    register_client('bedrock-runtime', fakes['bedrock'])
+    register_client('s3', fakes['s3'])
+    register_resource('dynamodb', fakes['dynamodb'])
+    return fakes
+
+
+'''
+Benchmarks
+'''
+def bench_encode_image_bytes(args, fakes) -> dict:
+    from image_buffer import ImageBuffer
+    from utils import encode_image_bytes
+
+    data_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+    results = {}
+    for name in sorted(os.listdir(data_dir)):
+        with open(os.path.join(data_dir, name), 'rb') as f:
+            data = f.read()
+        # a fresh buffer per run, so the memoized JPEG is not reused
+        results[name] = {
+            'bytes': len(data),
+            **measure(lambda: encode_image_bytes(ImageBuffer(data)), args.repeat),
+        }
+    return results
+
+
+def bench_image_params(args, fakes) -> dict:
+    from params import ImageParams, ImageSize
+
+    img_params = ImageParams(seed=0)
+    img_params.set_configuration(count=5, size=ImageSize.SIZE_1024x1024, cfg=8.0)
+    prompt = 'a watercolor illustration of cherry blossoms along a river at dawn'
+    colors = ['#ffc0cb', '#ffffff', '#87ceeb']
+    ops = 10000
+
+    def _run(fn):
+        return lambda: [fn() for _ in range(ops)]
+
+    return {
+        'ops': ops,
+        'text_to_image': measure(_run(lambda: img_params.text_to_image(text=prompt)), args.repeat),
+        'color_guide': measure(_run(lambda: img_params.color_guide(text=prompt, colors=colors)), args.repeat),
+    }
+
+
+def _runner():
+    '''
+    A batch runner with the stage pools of one Image Generator session.
+    '''
+    from batch import BatchRunner
+    from config import config
+
+    return BatchRunner(
+        checkpoint=None,
+        manifest=None,
+        generate_workers=config.MAX_WORKERS,
+        tag_workers=config.TAG_UPLOAD_WORKERS,
+        upload_workers=config.TAG_UPLOAD_WORKERS,
+    )
+
+
+def _generate_and_upload(runner, request_id: str, prompts: List[str], count: int) -> int:
+    '''
+    Generate, tag and upload `count` images per prompt and write their
+    gallery items, through the pipeline that also runs batch files and
+    queued jobs.
+    '''
+    request = {'id': request_id, 'prompts': prompts, 'config': {'count': count}}
+    return len(runner.execute(request, prompts, {}))
+
+
+def bench_generate_images(args, fakes) -> dict:
+    runner = _runner()
+    results = {}
+    try:
+        for prompts, count in [(1, 1), (3, 5), (10, 5)]:
+            calls = fakes['bedrock'].calls
+            samples = []
+            for n in range(args.repeat):
+                start = time.perf_counter()
+                images = _generate_and_upload(
+                    runner, f'generate-{prompts}x{count}-{n}', [f'prompt {m}' for m in range(prompts)], count
+                )
+                samples.append(time.perf_counter() - start)
+            results[f'{prompts}x{count}'] = {
+                'images': images,
+                'images_per_second': images / float(np.mean(samples)),
+                'bedrock_calls': (fakes['bedrock'].calls - calls) // args.repeat,
+                **summarize(samples),
+            }
+    finally:
+        runner.close()
+    return results
+
+
+def bench_gallery_load(args, fakes) -> dict:
+    from aws.dynamodb import DynamoDB, GALLERY_PARTITION
+    from config import config
+
+    results = {}
+    for size in (1000, 10000, 100000):
+        table_name = f'bench-gallery-{size}'
+        fakes['dynamodb'].Table(table_name).load({
+            'id': f'{n:08d}.png',
+            'url': f'{config.CDN_URL}/{n:08d}.png',
+            'thumbnail_url': f'{config.CDN_URL}/thumbnails/{n:08d}.webp',
+            'prompt': f'fake image prompt {n}',
+            'tags': ['fake', 'tag'],
+            'config': {'imageGenerationConfig': {'numberOfImages': 1, 'width': 512, 'height': 512, 'cfgScale': 8.0, 'seed': n}},
+            'created': '24-01-01 00:00:00',
+            'created_at': 1704067200000 + n,
+            'gallery': GALLERY_PARTITION,
+            'embedding': np.zeros(1024, dtype=np.float32).tobytes(),
+        } for n in range(size))
+        db = DynamoDB(table_name=table_name, index_name=config.DYNAMODB_GALLERY_INDEX)
+
+        def _load_all():
+            cursor, pages = None, 0
+            while True:
+                page = db.query_page(limit=config.GALLERY_PAGE_SIZE, cursor=cursor)
+                pages += 1
+                cursor = page['cursor']
+                if cursor is None:
+                    return pages
+
+        results[str(size)] = {
+            'first_page': measure(lambda: db.query_page(limit=config.GALLERY_PAGE_SIZE), args.repeat),
+            'all_pages': measure(_load_all, 1),
+            'pages': _load_all(),
+        }
+    return results
+
+
+def bench_concurrent_users(args, fakes) -> dict:
+    from aws.throttle import limiter_metrics
+
+    bedrock = fakes['bedrock']
+    bedrock.throttle_rate = args.throttle_rate
+    bedrock.max_concurrency = args.max_concurrency
+
+    results = {}
+    for users in (1, 8, 32):
+        calls, throttles = bedrock.calls, bedrock.throttles
+        bedrock.peak_in_flight = 0
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def _user(user):
+            # each session has its own pools; the Bedrock limiters are process-wide
+            runner = _runner()
+            try:
+                for n in range(args.rounds):
+                    start = time.perf_counter()
+                    try:
+                        _generate_and_upload(runner, f'users-{users}-{user}-{n}', [f"user {user} prompt {n}"], 1)
+                    except Exception as e:
+                        with lock:
+                            errors.append(repr(e))
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - start)
+            finally:
+                runner.close()
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=_user, args=(user,)) for user in range(users)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        results[str(users)] = {
+            'requests': len(latencies),
+            'errors': len(errors),
+            'requests_per_second': len(latencies) / elapsed,
+            'latency': summarize(latencies) if latencies else None,
+            'bedrock_calls': bedrock.calls - calls,
+            'throttles': bedrock.throttles - throttles,
+            'peak_in_flight': bedrock.peak_in_flight,
+            'limiters': limiter_metrics(),
+        }
+    return results
+
+
+def bench_sharding(args, fakes) -> dict:
+    '''
+    Latency and request count of each planner policy, with image latency
+    growing by 80% of a single image per extra image in a request.
+    '''
+    from planner import POLICIES, gen_images
+    from params import ImageParams
+
+    bedrock = fakes['bedrock']
+    bedrock.per_image = 0.8
+    results = {}
+    try:
+        for total in (5, 10):
+            for policy in POLICIES:
+                calls = bedrock.calls
+                samples = []
+                for n in range(args.repeat):
+                    # a new seed per run, so the in-memory image cache never answers
+                    img_params = ImageParams(seed=total * 1000 + n)
+                    start = time.perf_counter()
+                    gen_images(img_params, total, lambda params: params.text_to_image(text='sharding'), policy=policy)
+                    samples.append(time.perf_counter() - start)
+                results[f'{total}/{policy}'] = {
+                    'bedrock_calls': (bedrock.calls - calls) // args.repeat,
+                    **summarize(samples),
+                }
+    finally:
+        bedrock.per_image = 0.0
+    return results
+
+
+def bench_hedging(args, fakes) -> dict:
+    '''
+    Single image latency against a long-tailed primary region alone, hedged
+    to a second region, and with the primary failing every call.
+    '''
+    from aws.client import register_client
+    from aws.hedge import RegionRouter
+    from generator import _invoke_image_region
+    from params import ImageParams
+
+    median = LATENCY['image'] * args.latency_scale
+    regions = {
+        'fake-primary-1': FakeBedrockRuntime(latency={'image': Latency(median, sigma=1.0, seed=1)}),
+        'fake-secondary-1': FakeBedrockRuntime(latency={'image': Latency(median, sigma=1.0, seed=2)}),
+        'fake-down-1': FakeBedrockRuntime(latency={'image': Latency(median / 10, seed=3)},
+                                          error_rate=1.0, error_code='ResourceNotFoundException'),
+    }
+    for region, client in regions.items():
+        register_client('bedrock-runtime', client, region)
+
+    scenarios = {
+        'single_region': ['fake-primary-1'],
+        'hedged': ['fake-primary-1', 'fake-secondary-1'],
+        'primary_down': ['fake-down-1', 'fake-secondary-1'],
+    }
+    results = {}
+    for name, route in scenarios.items():
+        router = RegionRouter(name, route, hedge_percentile=args.hedge_percentile, min_delay=median, min_samples=10)
+        calls = {region: regions[region].calls for region in route}
+
+        def _request(n):
+            body = ImageParams(seed=n).text_to_image(text=f'hedging {n}')
+            start = time.perf_counter()
+            router.call(_invoke_image_region, body)
+            return time.perf_counter() - start
+
+        # few enough users that the limiters' request rate is not the bottleneck
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            latencies = list(executor.map(_request, range(args.repeat * 8)))
+
+        stats = router.stats()
+        results[name] = {
+            'latency': summarize(latencies),
+            'bedrock_calls': {region: regions[region].calls - calls[region] for region in route},
+            'hedges': stats['hedges'],
+            'failovers': stats['failovers'],
+        }
+    return results
+
+
+IMPORT_PROBE = '''
+import json, socket, sys, time
+connects = []
+_connect = socket.socket.connect
+def connect(self, address):
+    connects.append(str(address))
+    return _connect(self, address)
+socket.socket.connect = connect
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "connects": connects, "modules": len(sys.modules)}}))
+'''
+
+
+def bench_import_time(args, fakes) -> dict:
+    '''
+    Import each entry module in a fresh interpreter, recording wall time,
+    socket connects made during import (there should be none), the number
+    of loaded modules and the slowest imports from `-X importtime`.
+
+    A module fails when it does not import, connects anywhere, or its median
+    import time is over --import-budget seconds; failures make the run exit
+    with status 1.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = {**os.environ, 'USE_SECRETS_MANAGER': 'true'}
+
+    results, failures = {}, []
+    for module in ('config', 'generator', 'app', 'batch'):
+        samples, probe, slowest = [], None, []
+        for n in range(args.repeat):
+            proc = subprocess.run(
+                [sys.executable, '-X', 'importtime', '-c', IMPORT_PROBE.format(module=module)],
+                cwd=root, env=env, capture_output=True, text=True,
+            )
+            if proc.returncode != 0:
+                probe = {'error': proc.stderr.strip().splitlines()[-1]}
+                break
+            probe = json.loads(proc.stdout.strip().splitlines()[-1])
+            samples.append(probe['seconds'])
+            if n == 0:
+                slowest = _slowest_imports(proc.stderr)
+
+        if not samples:
+            results[module] = probe
+            failures.append(f"{module}: {probe['error']}")
+            continue
+        results[module] = {
+            **summarize(samples),
+            'connects': len(probe['connects']),
+            'modules': probe['modules'],
+            'slowest': slowest,
+        }
+        if results[module]['p50'] > args.import_budget:
+            failures.append(f"{module}: imports in {results[module]['p50']:.2f}s, over the {args.import_budget:.2f}s budget")
+        if probe['connects']:
+            failures.append(f"{module}: connects to {', '.join(probe['connects'])} on import")
+
+    results['budget'] = args.import_budget
+    results['failures'] = failures
+    return results
+
+
+def _slowest_imports(importtime: str, top: int = 10) -> list:
+    # lines look like "import time:  self [us] | cumulative | imported package"
+    rows = []
+    for line in importtime.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative), name.strip()))
+    return [{'module': name, 'cumulative': us / 1e6} for us, name in sorted(rows, reverse=True)[:top]]
+
+
+BENCHMARKS = {
+    'import_time': bench_import_time,
+    'encode_image_bytes': bench_encode_image_bytes,
+    'image_params': bench_image_params,
+    'generate_images': bench_generate_images,
+    'gallery_load': bench_gallery_load,
+    'sharding': bench_sharding,
+    'hedging': bench_hedging,
+    # last: throttling here lowers the shared limiters for the rest of the process
+    'concurrent_users': bench_concurrent_users,
+}
+
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hot paths against in-process AWS fakes")
+    parser.add_argument("--only", nargs="*", choices=list(BENCHMARKS), default=None)
+    parser.add_argument("--output", default=None, help="write JSON here instead of stdout")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=3, help="requests per user in concurrent_users")
+    parser.add_argument("--latency-scale", type=float, default=0.05)
+    parser.add_argument("--distribution", choices=["fixed", "uniform", "lognormal"], default="lognormal")
+    parser.add_argument("--sigma", type=float, default=0.3, help="lognormal shape")
+    parser.add_argument("--throttle-rate", type=float, default=0.05, help="fake throttling probability in concurrent_users")
+    parser.add_argument("--max-concurrency", type=int, default=8, help="fake in-flight quota in concurrent_users")
+    parser.add_argument("--hedge-percentile", type=float, default=95.0, help="hedge delay percentile in hedging")
+    parser.add_argument("--import-budget", type=float, default=1.5, help="median seconds each entry module may take to import")
+    args = parser.parse_args()
+
+    fakes = install_fakes(args)
+    report = {
+        'commit': _commit(),
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': vars(args),
+        'results': {},
+    }
+    for name, bench in BENCHMARKS.items():
+        if args.only and name not in args.only:
+            continue
+        print(f"running {name}...", file=sys.stderr)
+        report['results'][name] = bench(args, fakes)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    failures = [
+        f"{name}: {failure}"
+        for name, result in report['results'].items()
+        for failure in result.get('failures', [])
+    ]
+    for failure in failures:
+        print(f"FAILED {failure}", file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,376 @@
+import os
+import json
+import time
+import hashlib
+import fcntl
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, List, Optional, Union
+
+
+def canonical_hash(*parts) -> str:
+    '''
+    Stable sha256 over JSON-serializable parts. Dict keys are sorted, so key
+    order does not change the hash; strings are hashed verbatim, so parse a
+    JSON request body before passing it.
+    '''
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, separators=(',', ':')).encode('utf8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+@contextmanager
+def file_lock(path: str):
+    '''
+    Exclusive advisory lock on `path` (created if missing), held across
+    processes sharing a cache directory.
+    '''
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class LRUCache:
+    '''
+    Thread-safe LRU with an optional TTL. With `max_bytes`, entries are also
+    evicted once the sum of `sizeof(value)` grows past it.
+    '''
+    def __init__(self,
+                 max_items: int = 256,
+                 ttl: Optional[float] = None,
+                 max_bytes: Optional[int] = None,
+                 sizeof: Callable = len):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            value, expires, _ = self._items[key]
+            if expires is not None and expires < time.time():
+                self._remove(key)
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        expires = time.time() + self.ttl if self.ttl else None
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        with self._lock:
+            self._remove(key)
+            self._items[key] = (value, expires, size)
+            self.bytes += size
+            while self._items and (
+                len(self._items) > self.max_items
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                self._remove(next(iter(self._items)))
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[2]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class ImageCache:
+    '''
+    Two-tier cache of generated images keyed on the request body and model id.
+
+    The memory tier is an LRU of raw PNG bytes bounded by both `max_items`
+    and `memory_max_bytes`. The disk tier is a directory of `<key>-<n>.png`
+    files plus `index.json`, evicted least-recently-used first once the
+    directory grows past `max_bytes`. The directory can be shared by
+    several processes: writes re-read and merge the index under a file lock,
+    and a miss re-reads it only when index.json changed since it was last seen.
+    '''
+    INDEX_FILE = 'index.json'
+    LOCK_FILE = 'index.lock'
+
+    def __init__(self,
+                 cache_dir: Optional[str],
+                 max_items: int = 64,
+                 max_bytes: int = 512 * 1024 * 1024,
+                 memory_max_bytes: int = 64 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.memory = LRUCache(
+            max_items=max_items,
+            max_bytes=memory_max_bytes,
+            sizeof=lambda images: sum(len(image) for image in images),
+        )
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._index_stamp = None
+        self._index = self._load_index()
+
+    @staticmethod
+    def key(body: str, model_id: str) -> str:
+        return canonical_hash(model_id, json.loads(body))
+
+    def get(self, key: str) -> Optional[List[bytes]]:
+        images = self.memory.get(key)
+        if images is not None:
+            with self._lock:
+                self.hits += 1
+            return images
+
+        images = self._read_disk(key)
+        with self._lock:
+            if images is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+
+        self.memory.put(key, images)
+        return images
+
+    def put(self, key: str, images: List[bytes]):
+        self.memory.put(key, images)
+        self._write_disk(key, images)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'memory_items': len(self.memory),
+                'memory_bytes': self.memory.bytes,
+                'disk_items': len(self._index),
+                'disk_bytes': sum(entry['size'] for entry in self._index.values()),
+            }
+
+    '''
+    Disk tier
+    '''
+    def _path(self, key: str, n: int) -> str:
+        return os.path.join(self.cache_dir, f"{key}-{n}.png")
+
+    def _index_path(self) -> str:
+        return os.path.join(self.cache_dir, self.INDEX_FILE)
+
+    def _stat_index(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self._index_path())
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _load_index(self) -> dict:
+        if not self.cache_dir:
+            return {}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # stat before reading: a write that lands in between makes the next
+        # miss reload again rather than be missed
+        self._index_stamp = self._stat_index()
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_index(self):
+        path = self._index_path()
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self._index, f)
+        os.replace(tmp, path)
+        self._index_stamp = self._stat_index()
+
+    def _read_disk(self, key: str) -> Optional[List[bytes]]:
+        if not self.cache_dir:
+            return None
+        with self._lock:
+            if key not in self._index and self._stat_index() != self._index_stamp:
+                # another process has written the index since
+                self._index = self._merge_index(self._load_index())
+            entry = self._index.get(key)
+            if entry is None:
+                return None
+            entry['atime'] = time.time()
+
+        try:
+            images = []
+            for n in range(entry['count']):
+                with open(self._path(key, n), 'rb') as f:
+                    images.append(f.read())
+            return images
+        except OSError:
+            with self._lock:
+                self._index.pop(key, None)
+            return None
+
+    def _write_disk(self, key: str, images: List[bytes]):
+        if not self.cache_dir:
+            return
+        if sum(len(image) for image in images) > self.max_bytes:
+            # would only evict every other entry and then itself
+            return
+        try:
+            for n, image in enumerate(images):
+                with open(self._path(key, n), 'wb') as f:
+                    f.write(image)
+
+            with self._lock, file_lock(os.path.join(self.cache_dir, self.LOCK_FILE)):
+                self._index = self._merge_index(self._load_index())
+                self._index[key] = {
+                    'count': len(images),
+                    'size': sum(len(image) for image in images),
+                    'atime': time.time(),
+                }
+                self._evict()
+                self._save_index()
+        except OSError as e:
+            print(e)
+
+    def _merge_index(self, stored: dict) -> dict:
+        # the stored index is authoritative for which entries exist; keep
+        # the later access time of the two for entries read in this process
+        for key, entry in stored.items():
+            local = self._index.get(key)
+            if local is not None and local['atime'] > entry['atime']:
+                entry['atime'] = local['atime']
+        return stored
+
+    def _evict(self):
+        total = sum(entry['size'] for entry in self._index.values())
+        for key, entry in sorted(self._index.items(), key=lambda kv: kv[1]['atime']):
+            if total <= self.max_bytes:
+                break
+            for n in range(entry['count']):
+                try:
+                    os.remove(self._path(key, n))
+                except OSError:
+                    pass
+            total -= entry['size']
+            del self._index[key]
+
+
+class SQLiteBackend:
+    '''
+    Persistent key/value backend for LLMCache. Any object with the same
+    get/put/delete methods can be used instead.
+    '''
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT, expires REAL)'
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, expires FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires = row
+        if expires is not None and expires < time.time():
+            self.delete(key)
+            return None
+        return json.loads(value)
+
+    def put(self, key: str, value, ttl: Optional[float] = None):
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                (key, json.dumps(value), expires)
+            )
+            self._conn.commit()
+
+    def delete(self, key: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._conn.commit()
+
+
+class LLMCache:
+    '''
+    Memoizes Claude responses keyed on model id, the rendered prompt and
+    system text, the image content hash and the model kwargs. Requests above
+    `max_temperature` are sampled on purpose and are never cached.
+    '''
+    def __init__(self,
+                 max_items: int = 1024,
+                 ttl: Optional[float] = 24 * 60 * 60,
+                 max_temperature: float = 0.7,
+                 backend=None):
+        self.ttl = ttl
+        self.max_temperature = max_temperature
+        self.memory = LRUCache(max_items=max_items, ttl=ttl)
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model_id: str, text: str, image: Union[str, List[str], None], system: Optional[str], model_kwargs: dict) -> str:
+        if isinstance(image, list):
+            image_hash = [hashlib.sha256(data.encode('utf8')).hexdigest() for data in image]
+        else:
+            image_hash = hashlib.sha256(image.encode('utf8')).hexdigest() if image else None
+        return canonical_hash(model_id, text, image_hash, system, model_kwargs)
+
+    def cacheable(self, model_kwargs: dict) -> bool:
+        return model_kwargs.get('temperature', 0) <= self.max_temperature
+
+    def get(self, key: str):
+        value = self.memory.get(key)
+        if value is None and self.backend is not None:
+            value = self.backend.get(key)
+            if value is not None:
+                self.memory.put(key, value)
+
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        self.memory.put(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.put(key, value, ttl=self.ttl)
+            except Exception as e:
+                print(e)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'memory_items': len(self.memory),
+            }
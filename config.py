@@ -1,5 +1,7 @@
-import boto3
+import time
 import json
+import threading
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 from pydantic_settings import BaseSettings
 
@@ -15,34 +17,177 @@ class Settings(BaseSettings):
     CDN_URL: str
     S3_BUCKET: str
     DYNAMODB_TABLE: str
+    USE_SECRETS_MANAGER: bool = True
+    SECRETS_ID: str = 'image-gen'
+    SECRETS_REGION: str = 'us-west-2'
+    SECRETS_TTL: int = 60 * 60
+    S3_ENDPOINT_URL: Optional[str] = None
+    S3_MULTIPART_THRESHOLD: int = 8 * 1024 * 1024
+    S3_MULTIPART_CHUNKSIZE: int = 8 * 1024 * 1024
+    S3_MAX_CONCURRENCY: int = 10
+    DYNAMODB_GALLERY_INDEX: str = 'gallery-created-index'
+    DYNAMODB_ENDPOINT_URL: Optional[str] = None
+    GALLERY_PAGE_SIZE: int = 50
+    GALLERY_SEARCH_K: int = 20
+    VECTOR_INDEX_DIR: str = '.cache/vector-index'
+    PROMPT_INDEX_DIR: str = '.cache/prompt-index'
+    INDEX_SYNC_SECONDS: float = 60.0
+    EMBEDDING_CACHE_ENABLED: bool = True
+    EMBEDDING_CACHE_DIR: str = '.cache/embeddings'
+    EMBEDDING_WORKERS: int = 8
+    REUSE_SIMILARITY_THRESHOLD: float = 0.92
+    REUSE_RECORD_PROMPTS: bool = False
+    LOG_LEVEL: str = 'INFO'
+    METRICS_SIDEBAR: bool = False
+    METRICS_PORT: Optional[int] = None
+    MAX_WORKERS: int = 16
+    ASYNC_MAX_CONCURRENCY: int = 64
+    SINGLEFLIGHT_TIMEOUT: float = 300.0
+    BEDROCK_RPS: float = 10.0
+    BEDROCK_MAX_IN_FLIGHT: int = 16
+    BEDROCK_MAX_ATTEMPTS: int = 5
+    BEDROCK_LIMITS: Dict[str, dict] = {}
+    HEDGE_ENABLED: bool = False
+    HEDGE_REGIONS: List[str] = []
+    HEDGE_PERCENTILE: float = 95.0
+    HEDGE_MIN_DELAY: float = 1.0
+    HEDGE_FAILURE_THRESHOLD: int = 3
+    HEDGE_COOLDOWN: float = 30.0
+    IMAGE_SHARD_POLICY: str = 'requests'
+    IMAGE_MAX_TOTAL: int = 10
+    TAG_UPLOAD_WORKERS: int = 8
+    USE_JOB_QUEUE: bool = False
+    JOB_QUEUE_PATH: str = '.cache/jobs.sqlite3'
+    JOB_POLL_SECONDS: float = 2.0
+    JOB_LEASE_SECONDS: float = 60.0
+    TAG_BATCH_SIZE: int = 5
+    IMAGE_CACHE_ENABLED: bool = True
+    IMAGE_CACHE_DIR: str = '.cache/images'
+    IMAGE_CACHE_MAX_ITEMS: int = 64
+    IMAGE_CACHE_MAX_BYTES: int = 512 * 1024 * 1024
+    IMAGE_CACHE_MEMORY_MAX_BYTES: int = 64 * 1024 * 1024
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_PATH: str = '.cache/llm.sqlite3'
+    LLM_CACHE_MAX_ITEMS: int = 1024
+    LLM_CACHE_TTL: int = 24 * 60 * 60
+    LLM_CACHE_MAX_TEMPERATURE: float = 0.7
 
 
-def get_secrets():
-    settings = Settings()
+SECRET_FIELDS = (
+    'BEDROCK_REGION',
+    'AWS_ACCESS_KEY',
+    'AWS_SECRET_KEY',
+    'LLM_MODEL_ID',
+    'IMAGE_GEN_MODEL_ID',
+    'CDN_URL',
+    'S3_BUCKET',
+    'DYNAMODB_TABLE',
+)
+
+
+def fetch_secrets(settings: Settings) -> Optional[dict]:
+    '''
+    Returns:
+        dict: the secret's fields, or None if Secrets Manager is disabled or unavailable
+    '''
+    if not settings.USE_SECRETS_MANAGER:
+        return None
 
     try:
+        import boto3
+
         session = boto3.session.Session()
         client = session.client(
             service_name='secretsmanager',
-            region_name="us-west-2"
+            region_name=settings.SECRETS_REGION
         )
         get_secret_value_response = client.get_secret_value(
-            SecretId="image-gen"
+            SecretId=settings.SECRETS_ID
         )
-
-        secrets = json.loads(get_secret_value_response['SecretString'])
-        settings.BEDROCK_REGION = secrets.get('BEDROCK_REGION')
-        settings.AWS_ACCESS_KEY = secrets.get('AWS_ACCESS_KEY')
-        settings.AWS_SECRET_KEY = secrets.get('AWS_SECRET_KEY')
-        settings.LLM_MODEL_ID = secrets.get('LLM_MODEL_ID')
-        settings.IMAGE_GEN_MODEL_ID = secrets.get('IMAGE_GEN_MODEL_ID')
-        settings.CDN_URL = secrets.get('CDN_URL')
-        settings.S3_BUCKET = secrets.get('S3_BUCKET')
-        settings.DYNAMODB_TABLE = secrets.get('DYNAMODB_TABLE')
+        return json.loads(get_secret_value_response['SecretString'])
     except Exception as e:
-        return dict()
-    
+        print(e)
+        return None
+
+
+def get_secrets() -> Settings:
+    '''
+    Settings from the environment, overridden by Secrets Manager when it is
+    reachable. On failure the environment values are kept.
+    '''
+    settings = Settings()
+    return _apply_secrets(settings, fetch_secrets(settings))
+
+
+def _apply_secrets(settings: Settings, secrets: Optional[dict]) -> Settings:
+    for name in SECRET_FIELDS:
+        if secrets and secrets.get(name) is not None:
+            setattr(settings, name, secrets[name])
     return settings
 
 
-config = get_secrets()
+class LazyConfig:
+    '''
+    Resolves settings on first use instead of at import. Plain settings are
+    read from the environment; the first read of a SECRET_FIELDS value
+    fetches Secrets Manager. Once SECRETS_TTL has passed the secrets are
+    refreshed on a background thread while the cached values keep serving.
+    '''
+    RETRY_SECONDS = 60
+
+    def __init__(self):
+        self._env = None
+        self._settings = None
+        self._expires = 0.0
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name in SECRET_FIELDS or self._settings is not None:
+            return getattr(self._resolved(), name)
+        return getattr(self._environment(), name)
+
+    def _environment(self) -> Settings:
+        if self._env is None:
+            with self._lock:
+                if self._env is None:
+                    self._env = Settings()
+        return self._env
+
+    def _resolved(self) -> Settings:
+        if self._settings is None:
+            with self._lock:
+                if self._settings is None:
+                    self._settings, self._expires = self._load()
+        elif time.monotonic() >= self._expires:
+            self._refresh_in_background()
+        return self._settings
+
+    def _load(self):
+        settings = Settings()
+        secrets = fetch_secrets(settings)
+        if settings.USE_SECRETS_MANAGER and secrets is None:
+            # keep serving the last good values (or the environment) and retry soon
+            return self._settings or settings, time.monotonic() + self.RETRY_SECONDS
+        return _apply_secrets(settings, secrets), time.monotonic() + settings.SECRETS_TTL
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name='config-refresh', daemon=True).start()
+
+    def refresh(self):
+        try:
+            settings, expires = self._load()
+            with self._lock:
+                self._settings, self._expires = settings, expires
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+config = LazyConfig()
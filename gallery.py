@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import uuid
+import threading
+import numpy as np
+from typing import Callable, Optional
+
+from aws.dynamodb import DynamoDB, GALLERY_ATTRIBUTES, GALLERY_PARTITION
+from aws.embedding import EmbeddingError
+from aws.s3 import S3
+from config import config
+from generator import gen_image_embedding
+from image_buffer import ImageBuffer
+from reuse import GenerationReuse
+from utils import get_current_time, get_current_timestamp, make_renditions
+from vector_index import VectorIndex
+
+
+def index_metadata(item: dict) -> dict:
+    return {key: item.get(key) for key in ("url", "thumbnail_url", "prompt")}
+
+
+class GallerySync:
+    '''
+    Keeps a local VectorIndex in step with the gallery table. Each sync
+    queries the gallery index for items created at or after a watermark
+    (kept next to the index), so a fresh container reads the gallery once
+    through the index rather than scanning the table, and items written by
+    batch.py, job workers or other replicas show up within `interval` seconds.
+    '''
+    WATERMARK_FILE = 'sync.json'
+
+    def __init__(self,
+                 index: VectorIndex,
+                 db: DynamoDB,
+                 attribute: str,
+                 metadata: Callable[[dict], dict] = index_metadata,
+                 interval: float = 60.0,
+                 page_size: int = 200):
+        self.index = index
+        self.db = db
+        self.attribute = attribute
+        self.metadata = metadata
+        self.interval = interval
+        self.page_size = page_size
+        self.watermark = self._load_watermark()
+        self._synced = 0.0
+        self._lock = threading.Lock()
+
+    def sync(self, force: bool = False) -> int:
+        '''
+        Returns:
+            int: number of items added; 0 when skipped or another sync is running
+        '''
+        if not force and time.monotonic() - self._synced < self.interval:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0
+        try:
+            added = 0
+            cursor = None
+            # `since` is inclusive: items sharing the watermark millisecond are
+            # read again and skipped by the index
+            while True:
+                page = self.db.query_page(
+                    limit=self.page_size,
+                    cursor=cursor,
+                    newest_first=False,
+                    attributes=GALLERY_ATTRIBUTES + [self.attribute],
+                    since=self.watermark,
+                )
+                added += self._add(page['Items'])
+                cursor = page['cursor']
+                if cursor is None:
+                    break
+            self._synced = time.monotonic()
+            self._save_watermark()
+            return added
+        finally:
+            self._lock.release()
+
+    def _add(self, items) -> int:
+        ids, vectors, metadata = [], [], []
+        for item in items:
+            if item.get('created_at') is not None:
+                self.watermark = max(self.watermark or 0, int(item['created_at']))
+            if self.attribute not in item or item['id'] in self.index:
+                continue
+            ids.append(item['id'])
+            value = item[self.attribute]
+            vectors.append(np.frombuffer(getattr(value, 'value', value), dtype=np.float32))
+            metadata.append(self.metadata(item))
+        if ids:
+            self.index.add(ids, np.vstack(vectors), metadata)
+        return len(ids)
+
+    def _load_watermark(self) -> Optional[int]:
+        if not self.index.path:
+            return None
+        try:
+            with open(os.path.join(self.index.path, self.WATERMARK_FILE)) as f:
+                return json.load(f)['created_at']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def _save_watermark(self):
+        if not self.index.path or self.watermark is None:
+            return
+        path = os.path.join(self.index.path, self.WATERMARK_FILE)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump({'created_at': self.watermark}, f)
+        os.replace(tmp, path)
+
+
+def upload_image(image: ImageBuffer,
+                 prompt: str,
+                 cfg: dict,
+                 tags = [],
+                 s3: S3 = None,
+                 db: Optional[DynamoDB] = None,
+                 index: VectorIndex = None,
+                 reuse: GenerationReuse = None,
+                 image_uuid: Optional[str] = None):
+    '''
+    Upload the image and its renditions to S3 and embed it for similarity
+    search. The gallery item is written when `db` is given; otherwise the
+    caller batches it.
+
+    Args:
+        reuse: records the prompt embedding for reuse lookups; None skips
+            the extra embedding call
+        image_uuid: fixed object name, so that a retried upload overwrites
+            the same keys instead of leaving orphans (default: random)
+
+    Returns:
+        tuple: (gallery item, TransferStats)
+    '''
+    image_uuid = image_uuid or uuid.uuid4()
+    image_id = f"{image_uuid}.png"
+    objects = [{'key': image_id, 'bytes': image, 'extra_args': {'ContentType': 'image/png'}}]
+
+    rendition_urls = {}
+    for name, data in make_renditions(image).items():
+        key = f"{name}s/{image_uuid}.webp"
+        objects.append({'key': key, 'bytes': data, 'extra_args': {'ContentType': 'image/webp'}})
+        rendition_urls[f"{name}_url"] = f"{config.CDN_URL}/{key}"
+
+    stats = s3.upload_many(objects)
+    if stats.errors:
+        raise stats.errors[0][1]
+
+    try:
+        vector = np.asarray(gen_image_embedding(image), dtype=np.float32)
+    except EmbeddingError as e:
+        # the image is stored without an embedding; backfill.py adds it later
+        print(e)
+        vector = np.zeros(0, dtype=np.float32)
+
+    item = {
+        "id": image_id,
+        "url": f"{config.CDN_URL}/{image_id}",
+        **rendition_urls,
+        "prompt": prompt,
+        "config": cfg,
+        "tags": tags,
+        "created": get_current_time(),
+        "gallery": GALLERY_PARTITION,
+        "created_at": get_current_timestamp(),
+    }
+    if len(vector):
+        item["embedding"] = vector.tobytes()
+        if index is not None:
+            index.add([image_id], vector[None, :], [index_metadata(item)])
+
+    if reuse is not None:
+        prompt_vector = reuse.embed(prompt)
+        if prompt_vector is not None:
+            item["prompt_embedding"] = prompt_vector.tobytes()
+            reuse.record(image_id, prompt, cfg, index_metadata(item), vector=prompt_vector)
+
+    if db is not None:
+        db.put_item(item)
+    return item, stats
@@ -1,51 +1,356 @@
-import boto3
 import re
 import json
+import threading
 
-from typing import List, Optional
+from typing import List, Optional, Union
 from aws.claude import BedrockClaude
+from aws.embedding import BedrockEmbedding, EmbeddingCache
+from aws.client import get_client, get_async_client, model_semaphore
+from aws.hedge import get_router
+from aws.throttle import get_limiter
+from cache import ImageCache, LLMCache, SQLiteBackend
+from image_buffer import ImageBuffer
+from metrics import metrics, traced
+from singleflight import SingleFlight
 from prompt import (
     get_llm_image_prompt,
     get_mm_llm_image_prompt,
     get_image_tags_prompt,
+    get_batch_image_tags_prompt,
     get_translate_llm_prompt,
 )
 from utils import display_image
 from config import config
 
 
+'''
+Shared model clients
+
+Built on first use rather than at import, so importing this module makes no
+AWS calls and opens no cache files.
+'''
+_lock = threading.Lock()
+_instances = {}
+
+
+def _shared(name: str, factory):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = _instances[name] = factory()
+    return instance
+
+
+def get_claude() -> BedrockClaude:
+    return _shared('claude', lambda: BedrockClaude(
+        cache=LLMCache(
+            max_items=config.LLM_CACHE_MAX_ITEMS,
+            ttl=config.LLM_CACHE_TTL,
+            max_temperature=config.LLM_CACHE_MAX_TEMPERATURE,
+            backend=SQLiteBackend(config.LLM_CACHE_PATH),
+        ) if config.LLM_CACHE_ENABLED else None
+    ))
+
+
+def get_embedding() -> BedrockEmbedding:
+    return _shared('embedding', lambda: BedrockEmbedding(
+        cache=EmbeddingCache(config.EMBEDDING_CACHE_DIR) if config.EMBEDDING_CACHE_ENABLED else None
+    ))
+
+
+def get_image_cache() -> ImageCache:
+    return _shared('image_cache', lambda: ImageCache(
+        cache_dir=config.IMAGE_CACHE_DIR if config.IMAGE_CACHE_ENABLED else None,
+        max_items=config.IMAGE_CACHE_MAX_ITEMS,
+        max_bytes=config.IMAGE_CACHE_MAX_BYTES,
+        memory_max_bytes=config.IMAGE_CACHE_MEMORY_MAX_BYTES,
+    ))
+
+
+image_flight = SingleFlight('image')
+
+
+def __getattr__(name: str):
+    # `from generator import claude` etc. keep working
+    getters = {'claude': get_claude, 'embedding': get_embedding, 'image_cache': get_image_cache}
+    if name in getters:
+        return getters[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@traced('translate')
 def gen_english(request: str):
     prompt = get_translate_llm_prompt(request=request)
-    claude = BedrockClaude()
-    return claude.invoke_llm_response(prompt)
+    return get_claude().invoke_llm_response(prompt)
 
+@traced('prompt')
 def gen_image_prompt(request: str,
                      style: str,
                      temperature: Optional[float] = None,
                      top_p: Optional[float] = None,
                      top_k: Optional[int] = None) -> List[str]:
     prompt = get_llm_image_prompt(request=request, style=style)
-
-    model_kwargs = {}
-    if temperature is not None:
-        model_kwargs['temperature'] = temperature
-    if top_p is not None:
-        model_kwargs['top_p'] = top_p
-    if top_k is not None:
-        model_kwargs['top_k'] = top_k
-
-    claude = BedrockClaude(**model_kwargs)
-    res = claude.invoke_llm_response(prompt)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    res = get_claude().invoke_llm_response(prompt, **model_kwargs)
     return _extract_format(res)
 
 
+@traced('prompt')
 def gen_mm_image_prompt(request: str,
-                        image: str,
+                        image: Union[str, ImageBuffer],
                         temperature: Optional[float] = None,
                         top_p: Optional[float] = None,
                         top_k: Optional[int] = None) -> List[str]:
     prompt = get_mm_llm_image_prompt(request=request)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    res = get_claude().invoke_llm_response(text=prompt, image=image, **model_kwargs)
+    return _extract_format(res)
+
+
+class PromptStream:
+    '''
+    Iterates over `<prompt>...</prompt>` blocks as soon as each closing tag
+    arrives on a streamed Claude response. `stop_reason` and `usage` are
+    filled in once the stream is exhausted.
+    '''
+    def __init__(self, events):
+        self._events = events
+        self._buffer = ''
+        self._offset = 0
+        self.text = ''
+        self.stop_reason = None
+        self.usage = {}
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        prompts = []
+        while True:
+            start = self._buffer.find('<prompt>', self._offset)
+            if start < 0:
+                break
+            end = self._buffer.find('</prompt>', start)
+            if end < 0:
+                break
+            prompts.append(self._buffer[start + len('<prompt>'):end])
+            self._offset = end + len('</prompt>')
+        return prompts
+
+    def __iter__(self):
+        for event in self._events:
+            if event['type'] == 'text':
+                yield from self.feed(event['text'])
+            elif event['type'] == 'stop':
+                self.stop_reason = event['stop_reason']
+                self.usage = event['usage']
+        self.text = self._buffer
+
+
+def gen_image_prompt_stream(request: str,
+                            style: str,
+                            temperature: Optional[float] = None,
+                            top_p: Optional[float] = None,
+                            top_k: Optional[int] = None) -> PromptStream:
+    prompt = get_llm_image_prompt(request=request, style=style)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    return PromptStream(get_claude().invoke_llm_stream(prompt, **model_kwargs))
+
+
+def gen_mm_image_prompt_stream(request: str,
+                               image: Union[str, ImageBuffer],
+                               temperature: Optional[float] = None,
+                               top_p: Optional[float] = None,
+                               top_k: Optional[int] = None) -> PromptStream:
+    prompt = get_mm_llm_image_prompt(request=request)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    return PromptStream(get_claude().invoke_llm_stream(text=prompt, image=image, **model_kwargs))
+
+
+@traced('generate')
+def gen_image(body: str, debug: bool = True, use_cache: bool = True) -> List[ImageBuffer]:
+    cache_key, image = _cached_image(body, use_cache)
+
+    if image is None:
+        # identical bodies already in flight share one request
+        image = image_flight.do(
+            cache_key, _invoke_image_model, body, cache_key, use_cache,
+            timeout=config.SINGLEFLIGHT_TIMEOUT
+        )
+
+    if debug:
+        display_image(image)
+    return image
+
+
+def _invoke_image_model(body: str, cache_key: str, use_cache: bool) -> List[ImageBuffer]:
+    # hedged across regions when HEDGE_ENABLED, otherwise BEDROCK_REGION only
+    response_body = get_router(config.IMAGE_GEN_MODEL_ID).call(_invoke_image_region, body)
+    image = _store_image(cache_key, response_body.get("images"), use_cache)
+    _record_images(image)
+    return image
+
+
+def _invoke_image_region(region: str, body: str) -> dict:
+    bedrock = get_client('bedrock-runtime', region)
+    response = get_limiter(config.IMAGE_GEN_MODEL_ID, region).call(
+        bedrock.invoke_model,
+        body=body,
+        modelId=config.IMAGE_GEN_MODEL_ID,
+        accept="application/json",
+        contentType="application/json"
+    )
+    return json.loads(response.get("body").read())
+
+
+def gen_tags(image: Union[str, ImageBuffer]):
+    prompt = get_image_tags_prompt()
+    res = get_claude().invoke_llm_response(text=prompt, image=image)
+    return res
+
+
+@traced('tag')
+def gen_tags_batch(images: List[Union[str, ImageBuffer]], batch_size: int = None) -> List[List[str]]:
+    '''
+    Tag up to `batch_size` images per Claude request. Images whose tags are
+    missing from a batch answer are retried one at a time with gen_tags.
+
+    Returns:
+        list: tag list per input image, in input order
+    '''
+    batch_size = batch_size or config.TAG_BATCH_SIZE
+    tags = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        if len(batch) == 1:
+            tags.append(_gen_image_tags(batch[0]))
+            continue
+
+        try:
+            res = get_claude().invoke_llm_response(
+                text=get_batch_image_tags_prompt(count=len(batch)), image=batch)
+            parsed = _parse_batch_tags(res, len(batch))
+        except Exception as e:
+            print(e)
+            parsed = [None] * len(batch)
+
+        for image, image_tags in zip(batch, parsed):
+            if image_tags is None:
+                image_tags = _gen_image_tags(image)
+            tags.append(image_tags)
+    return tags
 
+
+def _gen_image_tags(image: Union[str, ImageBuffer]) -> List[str]:
+    # one image's failure leaves its tags empty instead of failing the batch
+    try:
+        return _parse_tags(gen_tags(image))
+    except Exception as e:
+        print(e)
+        return []
+
+
+def gen_image_embedding(image: Union[str, ImageBuffer]) -> List[float]:
+    '''
+    Titan multimodal embedding of an image, comparable with gen_text_query_embedding.
+    '''
+    if isinstance(image, ImageBuffer):
+        image = image.jpeg_base64()
+    return get_embedding().embedding_multimodal(image=image)
+
+
+def gen_text_query_embedding(text: str) -> List[float]:
+    return get_embedding().embedding_multimodal(text=text)
+
+
+def gen_text_embedding(text: str) -> List[float]:
+    '''
+    Titan text embedding, used to compare image prompts with each other.
+    '''
+    return get_embedding().embedding_text(text=text)
+
+
+'''
+Async API
+
+Coroutine counterparts of the functions above for callers that run their own
+event loop. Each call can be cancelled or wrapped in `asyncio.wait_for`.
+'''
+@traced('translate')
+async def agen_english(request: str):
+    prompt = get_translate_llm_prompt(request=request)
+    return await get_claude().ainvoke_llm_response(prompt)
+
+
+@traced('prompt')
+async def agen_image_prompt(request: str,
+                            style: str,
+                            temperature: Optional[float] = None,
+                            top_p: Optional[float] = None,
+                            top_k: Optional[int] = None) -> List[str]:
+    prompt = get_llm_image_prompt(request=request, style=style)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    res = await get_claude().ainvoke_llm_response(prompt, **model_kwargs)
+    return _extract_format(res)
+
+
+@traced('prompt')
+async def agen_mm_image_prompt(request: str,
+                               image: Union[str, ImageBuffer],
+                               temperature: Optional[float] = None,
+                               top_p: Optional[float] = None,
+                               top_k: Optional[int] = None) -> List[str]:
+    prompt = get_mm_llm_image_prompt(request=request)
+    model_kwargs = _model_kwargs(temperature, top_p, top_k)
+    res = await get_claude().ainvoke_llm_response(text=prompt, image=image, **model_kwargs)
+    return _extract_format(res)
+
+
+@traced('generate')
+async def agen_image(body: str, use_cache: bool = True) -> List[ImageBuffer]:
+    cache_key, image = _cached_image(body, use_cache)
+    if image is not None:
+        return image
+
+    return await image_flight.ado(
+        cache_key, _agen_image, body, cache_key, use_cache,
+        timeout=config.SINGLEFLIGHT_TIMEOUT
+    )
+
+
+async def _agen_image(body: str, cache_key: str, use_cache: bool) -> List[ImageBuffer]:
+    response_body = await get_router(config.IMAGE_GEN_MODEL_ID).acall(_agen_image_region, body)
+    image = _store_image(cache_key, response_body.get("images"), use_cache)
+    _record_images(image)
+    return image
+
+
+async def _agen_image_region(region: str, body: str) -> dict:
+    bedrock = await get_async_client('bedrock-runtime', region)
+    async with model_semaphore(config.IMAGE_GEN_MODEL_ID):
+        return await get_limiter(config.IMAGE_GEN_MODEL_ID, region).acall(_ainvoke_image_model, bedrock, body)
+
+
+async def _ainvoke_image_model(bedrock, body: str) -> dict:
+    response = await bedrock.invoke_model(
+        body=body,
+        modelId=config.IMAGE_GEN_MODEL_ID,
+        accept="application/json",
+        contentType="application/json"
+    )
+    async with response["body"] as stream:
+        return json.loads(await stream.read())
+
+
+@traced('tag')
+async def agen_tags(image: Union[str, ImageBuffer]):
+    prompt = get_image_tags_prompt()
+    return await get_claude().ainvoke_llm_response(text=prompt, image=image)
+
+
+def _model_kwargs(temperature: Optional[float] = None,
+                  top_p: Optional[float] = None,
+                  top_k: Optional[int] = None) -> dict:
     model_kwargs = {}
     if temperature is not None:
         model_kwargs['temperature'] = temperature
@@ -53,36 +358,74 @@ def gen_mm_image_prompt(request: str,
         model_kwargs['top_p'] = top_p
     if top_k is not None:
         model_kwargs['top_k'] = top_k
+    return model_kwargs
 
-    claude = BedrockClaude(**model_kwargs)
-    res = claude.invoke_llm_response(text=prompt, image=image)
-    return _extract_format(res)
 
+def _cached_image(body: str, use_cache: bool):
+    cache_key = ImageCache.key(body, config.IMAGE_GEN_MODEL_ID)
+    if not (use_cache and config.IMAGE_CACHE_ENABLED):
+        return cache_key, None
 
-def gen_image(body: str, debug: bool = True):
-    bedrock = boto3.client(service_name='bedrock-runtime',
-                           region_name = config.BEDROCK_REGION)
-    response = bedrock.invoke_model(
-        body=body,
-        modelId=config.IMAGE_GEN_MODEL_ID,
-        accept="application/json",
-        contentType="application/json"
-    )
-    response_body = json.loads(response.get("body").read())
-    image = response_body.get("images")
+    cached = get_image_cache().get(cache_key)
+    if cached is None:
+        return cache_key, None
+    return cache_key, [ImageBuffer(img) for img in cached]
 
-    if debug:
-        display_image(image)
+
+def _store_image(cache_key: str, image: List[str], use_cache: bool) -> List[ImageBuffer]:
+    image = [ImageBuffer.from_base64(img) for img in image or []]
+    if use_cache and config.IMAGE_CACHE_ENABLED and image:
+        get_image_cache().put(cache_key, [img.data for img in image])
     return image
 
 
-def gen_tags(image: str):
-    prompt = get_image_tags_prompt()
-    claude = BedrockClaude()
-    res = claude.invoke_llm_response(text=prompt, image=image)
-    return res
+def _record_images(image: List[ImageBuffer]):
+    metrics.observe('images_per_request', len(image), model=config.IMAGE_GEN_MODEL_ID)
+    metrics.observe('image_response_bytes', sum(len(img.raw) for img in image), model=config.IMAGE_GEN_MODEL_ID)
+
+
+BATCH_TAG_KEY = re.compile(r'^(?:image\s*)?(\d+)$', re.IGNORECASE)
+
+
+def _parse_tags(result_string) -> List[str]:
+    try:
+        tags = json.loads(result_string)
+    except (TypeError, ValueError):
+        return []
+    return tags if isinstance(tags, list) else []
+
+
+def _parse_batch_tags(result_string: str, count: int) -> List[Optional[List[str]]]:
+    '''
+    Map a `{"1": [...], "2": [...]}` answer back to its inputs. Entries that
+    are missing or malformed come back as None.
+    '''
+    parsed = [None] * count
+    answer = _first_json_object(result_string or '')
+    if answer is None:
+        return parsed
+
+    for key, tags in answer.items():
+        match = BATCH_TAG_KEY.match(str(key).strip())
+        if match is None or not isinstance(tags, list):
+            continue
+        index = int(match.group(1)) - 1
+        if 0 <= index < count:
+            parsed[index] = [str(tag) for tag in tags]
+    return parsed
+
+
+def _first_json_object(text: str) -> Optional[dict]:
+    # the first `{` that starts a complete JSON object, ignoring any prose around it
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r'\{', text):
+        try:
+            return decoder.raw_decode(text, match.start())[0]
+        except ValueError:
+            continue
+    return None
 
 
 def _extract_format(result_string):
     pattern = r'<prompt>(.*?)</prompt>'
-    return re.findall(pattern, result_string)
\ No newline at end of file
+    return re.findall(pattern, result_string)
@@ -0,0 +1,85 @@
+import base64
+import threading
+from io import BytesIO
+from functools import cached_property
+from typing import Tuple, Union
+from PIL import Image
+
+
+class ImageBuffer:
+    '''
+    Encoded image bytes (PNG/JPEG/...) held once, with every derived form
+    (base64 text, decoded PIL image, dimensions, resized JPEG) computed lazily
+    and memoized on first use.
+    '''
+    def __init__(self, data: Union[bytes, bytearray, memoryview], encoded: str = None):
+        self._data = bytes(data) if not isinstance(data, bytes) else data
+        self._jpeg = {}
+        self._lock = threading.Lock()
+        if encoded is not None:
+            self.__dict__['base64'] = encoded
+
+    @classmethod
+    def from_base64(cls, encoded: str) -> 'ImageBuffer':
+        return cls(base64.b64decode(encoded), encoded=encoded)
+
+    @classmethod
+    def from_file(cls, file) -> 'ImageBuffer':
+        '''
+        Args:
+            file: a path, or a file-like object such as a Streamlit upload
+        '''
+        if isinstance(file, str):
+            with open(file, 'rb') as f:
+                return cls(f.read())
+        if hasattr(file, 'getbuffer'):
+            return cls(file.getbuffer())
+        return cls(file.read())
+
+    @property
+    def raw(self) -> memoryview:
+        return memoryview(self._data)
+
+    @property
+    def data(self) -> bytes:
+        return self._data
+
+    def as_file(self) -> BytesIO:
+        return BytesIO(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    @cached_property
+    def base64(self) -> str:
+        return base64.b64encode(self.raw).decode('utf8')
+
+    @cached_property
+    def pil(self) -> Image.Image:
+        image = Image.open(self.as_file())
+        image.load()
+        return image
+
+    @cached_property
+    def size(self) -> Tuple[int, int]:
+        # The header is enough for the dimensions, so avoid a full decode.
+        if 'pil' in self.__dict__:
+            return self.pil.size
+        return Image.open(self.as_file()).size
+
+    def jpeg_base64(self, max_size: Tuple[int, int] = (1000, 1000)) -> str:
+        '''
+        Base64 JPEG no larger than `max_size`, as sent to Claude.
+        '''
+        with self._lock:
+            if max_size not in self._jpeg:
+                image = self.pil.copy()
+                image.thumbnail(max_size, Image.Resampling.LANCZOS)
+                buffer = BytesIO()
+                image.convert("RGB").save(buffer, format="JPEG")
+                self._jpeg[max_size] = base64.b64encode(buffer.getbuffer()).decode('utf8')
+            return self._jpeg[max_size]
+
+
+def to_base64(image: Union[str, ImageBuffer]) -> str:
+    return image.base64 if isinstance(image, ImageBuffer) else image
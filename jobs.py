@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import uuid
+import signal
+import socket
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from config import config
+from metrics import metrics, serve as serve_metrics
+
+
+'''
+Job queue
+
+Generation jobs persisted in SQLite and run by worker processes, so work
+submitted from the UI survives a browser refresh, a script rerun or a
+restart of the Streamlit server, and does not tie up its threads. A job is
+a batch.py request, e.g. `{"prompts": [...], "config": {"count": 2}}`.
+
+    python jobs.py --workers 4
+
+Workers claim the oldest queued job in an IMMEDIATE transaction, so a job is
+handed to exactly one worker, and renew the claim's heartbeat while it runs.
+A job left `running` by a worker that died, or whose heartbeat is older than
+JOB_LEASE_SECONDS on any host, is marked `failed` rather than queued again:
+every job runs at most once.
+'''
+STATUSES = ('queued', 'running', 'done', 'failed')
+
+
+class JobQueue:
+    def __init__(self, path: str, timeout: float = 30.0):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # autocommit; claim() opens its own transaction
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS jobs ('
+            'id TEXT PRIMARY KEY, status TEXT, request TEXT, result TEXT, error TEXT, worker TEXT, '
+            'created_at REAL, started_at REAL, finished_at REAL, heartbeat_at REAL)'
+        )
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')]
+        if 'heartbeat_at' not in columns:
+            # queues created before claims had a heartbeat
+            try:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN heartbeat_at REAL')
+            except sqlite3.OperationalError:
+                pass  # added by another process in the meantime
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)')
+        self._lock = threading.Lock()
+
+    def submit(self, request: dict) -> str:
+        '''
+        Returns:
+            str: job id, also used as the request id
+        '''
+        job_id = uuid.uuid4().hex
+        request = {**request, 'id': request.get('id', job_id)}
+        with self._lock:
+            self._conn.execute(
+                'INSERT INTO jobs (id, status, request, created_at) VALUES (?, ?, ?, ?)',
+                (job_id, 'queued', json.dumps(request, ensure_ascii=False), time.time())
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            cursor = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,))
+            row = cursor.fetchone()
+        return _job(dict(zip([column[0] for column in cursor.description], row))) if row else None
+
+    def claim(self, worker: str) -> Optional[dict]:
+        '''
+        Mark the oldest queued job as running on `worker` and return it.
+        '''
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is not None:
+                    now = time.time()
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                        (worker, now, now, row[0])
+                    )
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return self.get(row[0]) if row else None
+
+    def heartbeat(self, job_id: str, worker: str) -> bool:
+        '''
+        Renew `worker`'s claim on a running job.
+
+        Returns:
+            bool: False if the job is no longer running on `worker`, e.g.
+                recover() expired the claim
+        '''
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time(), job_id, worker)
+            )
+        return cursor.rowcount > 0
+
+    def finish(self, job_id: str, result: dict = None, error: str = None, worker: Optional[str] = None):
+        '''
+        Record a job's result or error. With `worker`, only while the job is
+        still running on it, so a claim that recover() expired stays failed.
+
+        Returns:
+            bool: whether the job was updated
+        '''
+        query = 'UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ? WHERE id = ?'
+        args = ('failed' if error else 'done', json.dumps(result, ensure_ascii=False) if result else None,
+                error, time.time(), job_id)
+        if worker is not None:
+            query += " AND worker = ? AND status = 'running'"
+            args += (worker,)
+        with self._lock:
+            cursor = self._conn.execute(query, args)
+        return cursor.rowcount > 0
+
+    def recover(self, lease: Optional[float] = None) -> int:
+        '''
+        Fail the running jobs whose heartbeat is older than `lease` seconds,
+        on any host, and those of this host's workers that are no longer alive.
+
+        Args:
+            lease: defaults to JOB_LEASE_SECONDS
+
+        Returns:
+            int: number of jobs failed
+        '''
+        lease = config.JOB_LEASE_SECONDS if lease is None else lease
+        host = socket.gethostname()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, worker, COALESCE(heartbeat_at, started_at) FROM jobs WHERE status = 'running'"
+            ).fetchall()
+
+        expired = time.time() - lease
+        failed = 0
+        for job_id, worker, heartbeat_at in rows:
+            worker_host, _, pid = worker.rpartition(':')
+            if heartbeat_at is None or heartbeat_at < expired:
+                error = f'interrupted: no heartbeat from {worker} for {lease:g}s'
+            elif worker_host == host and not _alive(int(pid)):
+                error = 'interrupted: worker exited while running the job'
+            else:
+                continue
+            with self._lock:
+                # skip claims renewed or finished since they were read
+                cursor = self._conn.execute(
+                    "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ? AND status = 'running' "
+                    "AND worker = ? AND COALESCE(heartbeat_at, started_at) IS ?",
+                    (error, time.time(), job_id, worker, heartbeat_at)
+                )
+            failed += cursor.rowcount
+        return failed
+
+    def stats(self, window: int = 500) -> dict:
+        '''
+        Job counts per status, and p50/p95 of the time jobs waited in the
+        queue and ran for, over the last `window` finished jobs.
+        '''
+        with self._lock:
+            counts = dict(self._conn.execute('SELECT status, COUNT(*) FROM jobs GROUP BY status').fetchall())
+            rows = self._conn.execute(
+                'SELECT started_at - created_at, finished_at - started_at FROM jobs '
+                'WHERE finished_at IS NOT NULL AND started_at IS NOT NULL ORDER BY finished_at DESC LIMIT ?',
+                (window,)
+            ).fetchall()
+
+        stats = {status: counts.get(status, 0) for status in STATUSES}
+        for n, name in enumerate(('wait', 'run')):
+            values = np.array([row[n] for row in rows], dtype=np.float64)
+            for q in (50, 95):
+                stats[f'{name}_p{q}'] = float(np.percentile(values, q)) if len(values) else None
+        return stats
+
+    def gauges(self) -> List[Tuple[str, dict, float]]:
+        '''
+        Gauge source for metrics.add_gauges.
+        '''
+        stats = self.stats()
+        gauges = [('jobs', {'status': status}, stats[status]) for status in STATUSES]
+        gauges += [
+            (f'job_{name}_seconds', {'quantile': quantile}, stats[f'{name}_p{q}'])
+            for name in ('wait', 'run')
+            for q, quantile in ((50, '0.5'), (95, '0.95'))
+            if stats[f'{name}_p{q}'] is not None
+        ]
+        return gauges
+
+
+def _job(row: dict) -> dict:
+    row['request'] = json.loads(row['request'])
+    row['result'] = json.loads(row['result']) if row['result'] else None
+    return row
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+'''
+Workers
+
+Each worker process runs one job at a time through batch.BatchRunner, whose
+stage pools still parallelize the prompts and images within the job.
+'''
+def work(path: str, stop=None, poll_interval: float = 1.0, max_jobs: Optional[int] = None):
+    from batch import BatchRunner  # the generator stack loads in the worker only
+    from utils import timer
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the supervisor stops workers between jobs
+    queue = JobQueue(path)
+    runner = BatchRunner(checkpoint=None, manifest=None)
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+
+    done = 0
+    while not (stop is not None and stop.is_set()) and (max_jobs is None or done < max_jobs):
+        job = queue.claim(worker)
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+
+        request = job['request']
+        timings = {}
+        try:
+            with _heartbeat(queue, job['id'], worker), timer(timings, 'total'):
+                with timer(timings, 'prompt'):
+                    prompts = runner.expand_prompts(request)
+                images = runner.execute(request, prompts, timings)
+        except Exception as e:
+            print(f"{job['id']}: {e}")
+            queue.finish(job['id'], error=str(e), worker=worker)
+        else:
+            queue.finish(job['id'], worker=worker, result={
+                'prompts': prompts,
+                'images': images,
+                'timings': {stage: round(seconds, 3) for stage, seconds in timings.items()},
+            })
+        done += 1
+
+
+@contextmanager
+def _heartbeat(queue: JobQueue, job_id: str, worker: str, interval: Optional[float] = None):
+    '''
+    Renew the claim on `job_id` every `interval` seconds (a third of the
+    lease by default) until the block exits.
+    '''
+    interval = config.JOB_LEASE_SECONDS / 3 if interval is None else interval
+    stop = threading.Event()
+
+    def _beat():
+        while not stop.wait(interval):
+            if not queue.heartbeat(job_id, worker):
+                print(f"{job_id}: claim expired, the result will not be saved")
+                return
+
+    thread = threading.Thread(target=_beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def supervise(path: str, workers: int, poll_interval: float = 1.0):
+    '''
+    Run `workers` worker processes until interrupted, replacing any that
+    exit. On SIGINT or SIGTERM, workers finish their current job and stop.
+    '''
+    context = multiprocessing.get_context('spawn')
+    stop = context.Event()
+    queue = JobQueue(path)
+
+    def _stop(signum, frame):
+        stop.set()
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
+
+    def _start():
+        process = context.Process(target=work, args=(path, stop, poll_interval), daemon=True)
+        process.start()
+        return process
+
+    recovered = queue.recover()
+    if recovered:
+        print(f"{recovered} interrupted jobs marked failed")
+    processes = [_start() for _ in range(workers)]
+    print(f"{workers} workers on {path}")
+
+    while not stop.is_set():
+        stop.wait(poll_interval)
+        for n, process in enumerate(processes):
+            if not process.is_alive() and not stop.is_set():
+                print(f"worker {process.pid} exited with {process.exitcode}, restarting")
+                processes[n] = _start()
+        # also expires claims held by workers on other hosts
+        recovered = queue.recover()
+        if recovered:
+            print(f"{recovered} interrupted jobs marked failed")
+
+    for process in processes:
+        process.join()
+    queue.recover()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run generation job workers")
+    parser.add_argument("--queue", default=config.JOB_QUEUE_PATH)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--poll-interval", type=float, default=1.0)
+    parser.add_argument("--metrics-port", type=int, default=config.METRICS_PORT, help="serve queue depth and job latency")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.add_gauges(JobQueue(args.queue).gauges)
+        serve_metrics(args.metrics_port)
+
+    supervise(args.queue, args.workers, args.poll_interval)
@@ -0,0 +1,266 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BYTES_BUCKETS = tuple(1024 * 4 ** n for n in range(9))  # 1 KB .. 64 MB
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def _default_buckets(name: str) -> tuple:
+    if name.endswith('_seconds'):
+        return SECONDS_BUCKETS
+    if name.endswith('_bytes'):
+        return BYTES_BUCKETS
+    return COUNT_BUCKETS
+
+
+class Histogram:
+    '''
+    Cumulative buckets for export, plus the most recent `window` samples for
+    percentiles.
+    '''
+    def __init__(self, buckets: tuple, window: int = 2048):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.samples = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.samples.append(value)
+
+    def percentiles(self, qs=(50, 95, 99)) -> dict:
+        if not self.samples:
+            return {f'p{q}': None for q in qs}
+        values = np.percentile(np.fromiter(self.samples, dtype=np.float64), qs)
+        return {f'p{q}': float(value) for q, value in zip(qs, values)}
+
+
+class Metrics:
+    '''
+    Process-wide histograms and counters keyed on (name, labels), exported
+    as Prometheus text or JSON.
+    '''
+    def __init__(self, prefix: str = 'imagegen'):
+        self.prefix = prefix
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._gauges: List[Callable[[], List[Tuple[str, dict, float]]]] = []
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels):
+        if value is None:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(_default_buckets(name))
+            histogram.observe(float(value))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauges(self, source: Callable[[], List[Tuple[str, dict, float]]]):
+        '''
+        Register a callback read at export time, returning (name, labels, value)
+        for current values such as queue depth.
+        '''
+        with self._lock:
+            self._gauges.append(source)
+
+    def gauges(self) -> List[Tuple[str, dict, float]]:
+        with self._lock:
+            sources = list(self._gauges)
+        return [gauge for source in sources for gauge in source()]
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        '''
+        Time a pipeline stage into `stage_seconds{stage=...}`. An exception
+        escaping the block is counted in `stage_errors_total` and re-raised.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.error(stage, e, **labels)
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('stage_seconds', seconds, stage=stage, **labels)
+            logger.debug("span stage=%s seconds=%.3f %s", stage, seconds, labels)
+
+    def error(self, stage: str, e: Exception, **labels):
+        self.inc('stage_errors_total', stage=stage, error=type(e).__name__, **labels)
+
+    '''
+    Export
+    '''
+    def snapshot(self) -> dict:
+        with self._lock:
+            histograms = [
+                {
+                    'name': name,
+                    'labels': dict(labels),
+                    'count': histogram.count,
+                    'sum': histogram.sum,
+                    **histogram.percentiles(),
+                }
+                for (name, labels), histogram in sorted(self._histograms.items())
+            ]
+            counters = [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self._counters.items())
+            ]
+        gauges = [{'name': name, 'labels': labels, 'value': value} for name, labels, value in self.gauges()]
+        return {'histograms': histograms, 'counters': counters, 'gauges': gauges}
+
+    def to_json(self) -> str:
+        return json.dumps(self.snapshot(), indent=2)
+
+    def export(self, format: str) -> Tuple[str, str]:
+        '''
+        Args:
+            format: 'prometheus' or 'json'
+
+        Returns:
+            Tuple[str, str]: body and content type
+        '''
+        if format == 'prometheus':
+            return self.to_prometheus(), 'text/plain; version=0.0.4'
+        if format == 'json':
+            return self.to_json(), 'application/json'
+        raise ValueError(f"unknown metrics format {format!r}")
+
+    def to_prometheus(self) -> str:
+        lines = []
+        gauges = self.gauges()
+        for name in sorted({name for name, _, _ in gauges}):
+            metric = f'{self.prefix}_{name}'
+            lines.append(f'# TYPE {metric} gauge')
+            for other, labels, value in gauges:
+                if other == name:
+                    lines.append(f'{metric}{_labels(tuple(sorted(labels.items())))} {value}')
+
+        with self._lock:
+            for name in sorted({name for name, _ in self._histograms}):
+                metric = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {metric} histogram')
+                for (other, labels), histogram in sorted(self._histograms.items()):
+                    if other != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append(f'{metric}_bucket{_labels(labels + (("le", le),))} {cumulative}')
+                    lines.append(f'{metric}_sum{_labels(labels)} {histogram.sum}')
+                    lines.append(f'{metric}_count{_labels(labels)} {histogram.count}')
+
+            for name in sorted({name for name, _ in self._counters}):
+                metric = f'{self.prefix}_{name}'
+                lines.append(f'# TYPE {metric} counter')
+                for (other, labels), value in sorted(self._counters.items()):
+                    if other == name:
+                        lines.append(f'{metric}{_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in labels
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+metrics = Metrics()
+
+
+def traced(stage: str):
+    '''
+    Decorator form of metrics.span.
+    '''
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with metrics.span(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with metrics.span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+'''
+HTTP export
+
+GET /metrics returns Prometheus text and GET /metrics.json the snapshot,
+from a daemon thread so any process (the app, batch.py) can be scraped.
+'''
+_server = None
+_server_lock = threading.Lock()
+_formats = {'/metrics': 'prometheus', '/metrics.json': 'json'}
+
+
+def serve(port: int, host: str = '0.0.0.0') -> Optional[ThreadingHTTPServer]:
+    global _server
+    with _server_lock:
+        if _server is not None:
+            return _server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in _formats:
+                    self.send_error(404)
+                    return
+                body, content_type = metrics.export(_formats[self.path])
+                data = body.encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            _server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(e)
+            return None
+        threading.Thread(target=_server.serve_forever, name='metrics', daemon=True).start()
+        return _server
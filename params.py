@@ -66,6 +66,20 @@ class ImageParams:
     def set_configuration(self, count: int = 1, size: ImageSize = ImageSize.SIZE_512x512, cfg: float = 8.0):
         self._config = self._default_configuration(count, size, cfg)
 
+    def shard(self, count: int, seed: int) -> 'ImageParams':
+        '''
+        Copy of these parameters for one sub-request of `count` images with its own seed.
+        '''
+        params = ImageParams(seed=seed)
+        params._config = {
+            "imageGenerationConfig": {
+                **self._config["imageGenerationConfig"],
+                "numberOfImages": count,
+                "seed": seed
+            }
+        }
+        return params
+
     def _prepare_body(self, task_type: str, params: dict) -> str:
         body = {
             "taskType": task_type,
@@ -0,0 +1,127 @@
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+
+from aws.throttle import get_limiter
+from cache import canonical_hash
+from config import config
+from generator import gen_image
+from image_buffer import ImageBuffer
+from metrics import metrics
+from params import ImageParams
+
+
+'''
+Generation planning
+
+Titan returns at most 5 images per request, and one request for 5 images
+takes much longer than 5 parallel requests for one. A plan splits a total
+of N images into sub-requests ("shards") that run in parallel:
+
+    latency   1 image per request: lowest latency, N requests
+    balanced  2 images per request
+    requests  5 images per request: fewest requests
+
+A plan never has more shards than the image model's limiter allows in
+flight, so a large N falls back to bigger shards rather than queueing
+behind the limiter. Each shard's seed is derived from the base seed and the
+index of its first image; the first shard keeps the base seed, so N <= 5
+under the `requests` policy is exactly the single request made before.
+The same seed, N and policy give the same images, merged in shard order,
+each paired with the configuration of the sub-request that made it.
+'''
+MAX_IMAGES_PER_REQUEST = 5
+POLICIES = {
+    'latency': 1,
+    'balanced': 2,
+    'requests': MAX_IMAGES_PER_REQUEST,
+}
+MAX_SEED = 2147483646
+
+
+@dataclass
+class Shard:
+    offset: int  # position of its first image in the merged result
+    count: int
+    seed: int
+
+
+def derive_seed(seed: int, offset: int) -> int:
+    if offset == 0:
+        return seed
+    return int(canonical_hash(seed, offset), 16) % (MAX_SEED + 1)
+
+
+def plan(total: int, seed: int, policy: Optional[str] = None, max_shards: Optional[int] = None) -> List[Shard]:
+    '''
+    Args:
+        policy: 'latency', 'balanced' or 'requests' (default: IMAGE_SHARD_POLICY)
+        max_shards: cap on parallel sub-requests (default: the image model's max in flight)
+
+    Returns:
+        list: shards in merge order
+    '''
+    policy = policy or config.IMAGE_SHARD_POLICY
+    if policy not in POLICIES:
+        raise ValueError(f"unknown shard policy {policy!r}, expected one of {list(POLICIES)}")
+    if max_shards is None:
+        max_shards = get_limiter(config.IMAGE_GEN_MODEL_ID).max_limit
+
+    per_request = max(POLICIES[policy], math.ceil(total / max(max_shards, 1)))
+    per_request = min(per_request, MAX_IMAGES_PER_REQUEST)
+
+    shards = []
+    for offset in range(0, total, per_request):
+        shards.append(Shard(offset=offset, count=min(per_request, total - offset), seed=derive_seed(seed, offset)))
+    return shards
+
+
+_lock = threading.Lock()
+_executor = None
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=config.MAX_WORKERS, thread_name_prefix='shard')
+        return _executor
+
+
+def gen_images(img_params: ImageParams,
+               total: int,
+               build_body: Callable[[ImageParams], str],
+               policy: Optional[str] = None) -> List[Tuple[ImageBuffer, dict]]:
+    '''
+    Generate `total` images with the size and cfg scale of `img_params`,
+    sharded by `plan` from its seed.
+
+    Args:
+        build_body: makes the request body from a shard's params, e.g.
+            `lambda params: params.text_to_image(text=prompt)`
+
+    Returns:
+        list: (image, configuration) in shard order. The configuration is the
+            one of the sub-request that made the image, with its own seed and
+            numberOfImages, plus `imageIndex`, the image's position in that
+            request's output, so a stored configuration reproduces its image.
+    '''
+    shards = plan(total, img_params.seed, policy)
+    metrics.observe('plan_shards', len(shards), policy=policy or config.IMAGE_SHARD_POLICY)
+    shard_params = [img_params.shard(shard.count, shard.seed) for shard in shards]
+    bodies = [build_body(params) for params in shard_params]
+
+    if len(bodies) == 1:
+        results = [gen_image(body=bodies[0], debug=False)]
+    else:
+        # requests go through gen_image, so they share the model's limiter
+        futures = [_get_executor().submit(gen_image, body=body, debug=False) for body in bodies]
+        results = [future.result() for future in futures]
+
+    return [
+        (image, {**params.get_configuration(), 'imageIndex': n})
+        for params, images in zip(shard_params, results)
+        for n, image in enumerate(images)
+    ]
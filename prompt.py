@@ -1,7 +1,14 @@
-from langchain.prompts import PromptTemplate
+DEFAULT_STYLE = "minimalist, simple, clean and abstract background image, and do not contain many patterns, logos, or letters."
 
 
-DEFAULT_STYLE = "minimalist, simple, clean and abstract background image, and do not contain many patterns, logos, or letters."
+def _format(template: str, **kwargs) -> str:
+    # langchain is slow to import, so it is loaded with the first prompt
+    from langchain.prompts import PromptTemplate
+
+    return PromptTemplate(
+                template=template,
+                input_variables=list(kwargs)
+            ).format(**kwargs)
 
 
 def get_translate_llm_prompt(request: str):
@@ -12,10 +19,7 @@ def get_translate_llm_prompt(request: str):
                 </request>
                 """
 
-    return PromptTemplate(
-                template=PROMPT,
-                input_variables=["request"]
-            ).format(request=request)
+    return _format(PROMPT, request=request)
 
 
 def get_llm_image_prompt(request: str, style: str):
@@ -32,11 +36,7 @@ def get_llm_image_prompt(request: str, style: str):
                 </style>
                 """
 
-    return PromptTemplate(
-                template=PROMPT,
-                input_variables=["style", "request"]
-            ).format(style=style,
-                     request=request)
+    return _format(PROMPT, style=style, request=request)
 
 
 def get_mm_llm_image_prompt(request: str):
@@ -49,11 +49,17 @@ def get_mm_llm_image_prompt(request: str):
                 </request>
                 """
 
-    return PromptTemplate(
-                template=PROMPT,
-                input_variables=["request"]
-            ).format(request=request)
+    return _format(PROMPT, request=request)
 
 
 def get_image_tags_prompt():
-    return """Look at this image and create an image tag. Answer only a list of strings"""
\ No newline at end of file
+    return """Look at this image and create an image tag. Answer only a list of strings"""
+
+
+def get_batch_image_tags_prompt(count: int):
+    PROMPT = """Look at the {count} images above, labelled Image 1 to Image {count}, and create image tags for each one.
+                Answer only a JSON object that maps each image number to its list of tag strings, without further explanation:
+                {{"1": ["tag", "tag"], "2": ["tag", "tag"]}}
+                """
+
+    return PROMPT.format(count=count)
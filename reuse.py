@@ -0,0 +1,97 @@
+import logging
+import threading
+import numpy as np
+from typing import Callable, List, Optional, Tuple
+
+from aws.embedding import EmbeddingError
+from cache import LRUCache
+from vector_index import VectorIndex
+
+
+logger = logging.getLogger(__name__)
+
+
+def config_signature(cfg: dict) -> dict:
+    '''
+    The parts of an image configuration that must match for a prior image to
+    stand in for a new one. Seed and image count are deliberately left out.
+    '''
+    image_config = cfg.get('imageGenerationConfig', {})
+    return {
+        'width': image_config.get('width'),
+        'height': image_config.get('height'),
+        'cfgScale': image_config.get('cfgScale'),
+        'colorGuide': sorted(cfg.get('colorGuide') or []),
+    }
+
+
+class GenerationReuse:
+    '''
+    Looks up previously generated images whose prompt embedding is within
+    `threshold` cosine similarity of a new prompt and whose configuration
+    matches, so they can be returned instead of calling the image model.
+    '''
+    def __init__(self, index: VectorIndex, embed: Callable[[str], List[float]], threshold: float = 0.92):
+        self.index = index
+        self.embed_fn = embed
+        self.threshold = threshold
+        self.lookups = 0
+        self.hits = 0
+        self._vectors = LRUCache(max_items=256)
+        self._lock = threading.Lock()
+
+    def embed(self, prompt: str) -> Optional[np.ndarray]:
+        vector = self._vectors.get(prompt)
+        if vector is None:
+            try:
+                vector = np.asarray(self.embed_fn(prompt) or [], dtype=np.float32)
+            except EmbeddingError as e:
+                print(e)
+                return None
+            if not len(vector):
+                return None
+            self._vectors.put(prompt, vector)
+        return vector
+
+    def find(self, prompt: str, cfg: dict, k: int = 5, threshold: Optional[float] = None) -> List[Tuple[str, float, dict]]:
+        '''
+        Returns:
+            list: (image id, similarity, metadata) of reusable images, best first
+        '''
+        threshold = self.threshold if threshold is None else threshold
+        vector = self.embed(prompt)
+        candidates = self.index.search(vector, k=k * 4) if vector is not None else []
+
+        signature = config_signature(cfg)
+        matches = [
+            (image_id, score, meta) for image_id, score, meta in candidates
+            if score >= threshold and meta and meta.get('signature') == signature
+        ][:k]
+
+        with self._lock:
+            self.lookups += 1
+            self.hits += bool(matches)
+            hit_rate = self.hits / self.lookups
+
+        logger.info(
+            "reuse lookup: threshold=%.3f best=%s matches=%d hit_rate=%.3f (%d/%d) prompt=%r",
+            threshold,
+            f"{candidates[0][1]:.3f}" if candidates else None,
+            len(matches), hit_rate, self.hits, self.lookups, prompt[:80]
+        )
+        return matches
+
+    def record(self, image_id: str, prompt: str, cfg: dict, meta: dict, vector: Optional[np.ndarray] = None):
+        vector = vector if vector is not None else self.embed(prompt)
+        if vector is None:
+            return
+        self.index.add([image_id], vector[None, :], [{**meta, 'signature': config_signature(cfg)}])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': self.hits / self.lookups if self.lookups else 0.0,
+                'threshold': self.threshold,
+            }
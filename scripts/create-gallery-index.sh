@@ -0,0 +1,8 @@
+TABLE=${DYNAMODB_TABLE:-image-gen-gallery}
+INDEX=${DYNAMODB_GALLERY_INDEX:-gallery-created-index}
+
+aws dynamodb update-table \
+    --table-name "$TABLE" \
+    --attribute-definitions AttributeName=gallery,AttributeType=S AttributeName=created_at,AttributeType=N \
+    --global-secondary-index-updates \
+    "[{\"Create\":{\"IndexName\":\"$INDEX\",\"KeySchema\":[{\"AttributeName\":\"gallery\",\"KeyType\":\"HASH\"},{\"AttributeName\":\"created_at\",\"KeyType\":\"RANGE\"}],\"Projection\":{\"ProjectionType\":\"ALL\"}}}]"
@@ -0,0 +1,148 @@
+import asyncio
+import weakref
+import threading
+from typing import Optional
+
+from metrics import metrics
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class _AsyncCall:
+    def __init__(self, task: asyncio.Future):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    '''
+    Coalesces identical in-flight calls: the first caller for a key runs the
+    call and every caller that arrives before it finishes gets the same
+    result, or the same exception. Only in-flight calls are shared; a call
+    that has returned is never replayed (that is what the caches are for).
+
+    Waiters give up after `timeout` seconds with TimeoutError; the call they
+    were waiting on keeps running for its other callers.
+    '''
+    def __init__(self, name: str, timeout: Optional[float] = None):
+        self.name = name
+        self.timeout = timeout
+        self.calls = 0
+        self.saved = 0
+        self.timeouts = 0
+        self._calls = {}
+        self._async_calls = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn, *args, timeout: Optional[float] = None, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if leader:
+            self._count('calls')
+            try:
+                call.result = fn(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    self._calls.pop(key, None)
+                call.done.set()
+            return call.result
+
+        self._count('saved')
+        return self._wait(call, timeout)
+
+    def do_stream(self, key: str, fn, *args, timeout: Optional[float] = None, **kwargs):
+        '''
+        Like do, for a generator function. The leader's caller gets the items
+        as they are produced; callers that arrive while it runs get all of them
+        once it has finished.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            self._count('saved')
+            yield from self._wait(call, timeout)
+            return
+
+        self._count('calls')
+        items = []
+        try:
+            for item in fn(*args, **kwargs):
+                items.append(item)
+                yield item
+            call.result = items
+        except GeneratorExit:
+            call.error = RuntimeError(f"{self.name}: the shared stream was closed by its caller")
+            raise
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+    def _wait(self, call: _Call, timeout: Optional[float]):
+        if not call.done.wait(timeout if timeout is not None else self.timeout):
+            self._count('timeouts')
+            raise TimeoutError(f"{self.name}: timed out waiting for an identical in-flight call")
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    async def ado(self, key: str, fn, *args, timeout: Optional[float] = None, **kwargs):
+        '''
+        Like do, for a coroutine function, coalescing calls on the running
+        loop. The shared call is cancelled once every caller awaiting it has
+        been cancelled or has timed out.
+        '''
+        calls = self._async_calls.setdefault(asyncio.get_running_loop(), {})
+        call = calls.get(key)
+        leader = call is None
+        if leader:
+            call = calls[key] = _AsyncCall(asyncio.ensure_future(fn(*args, **kwargs)))
+            call.task.add_done_callback(lambda _: calls.pop(key, None) if calls.get(key) is call else None)
+        self._count('calls' if leader else 'saved')
+
+        call.waiters += 1
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(call.task),
+                None if leader else (timeout if timeout is not None else self.timeout)
+            )
+        except asyncio.TimeoutError:
+            self._count('timeouts')
+            raise
+        finally:
+            call.waiters -= 1
+            if call.waiters == 0 and not call.task.done():
+                call.task.cancel()
+
+    def _count(self, counter: str):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+        metrics.inc(f'singleflight_{counter}_total', group=self.name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'saved': self.saved,
+                'timeouts': self.timeouts,
+                'in_flight': len(self._calls),
+            }
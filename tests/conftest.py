@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# settings come from the environment only; AWS services are in-process fakes
+for _name, _value in {
+    'USE_SECRETS_MANAGER': 'false',
+    'BEDROCK_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY': '',
+    'AWS_SECRET_KEY': '',
+    'LLM_MODEL_ID': 'anthropic.claude-3-haiku-20240307-v1:0',
+    'IMAGE_GEN_MODEL_ID': 'amazon.titan-image-generator-v2:0',
+    'CDN_URL': 'https://cdn.example.com',
+    'S3_BUCKET': 'test-bucket',
+    'DYNAMODB_TABLE': 'test-table',
+    'IMAGE_CACHE_ENABLED': 'false',
+    'LLM_CACHE_ENABLED': 'false',
+    'EMBEDDING_CACHE_ENABLED': 'false',
+}.items():
+    os.environ.setdefault(_name, _value)
@@ -0,0 +1,42 @@
+import json
+
+import pytest
+
+from batch import read_requests
+
+
+def _write(path, lines) -> str:
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_read_requests(tmp_path):
+    path = _write(tmp_path / 'requests.jsonl', [
+        json.dumps({'id': 'spring-01', 'prompt': '벚꽃이 핀 공원'}, ensure_ascii=False),
+        '',
+        json.dumps({'keyword': 'cherry blossom'}),
+    ])
+
+    requests = read_requests(path)
+
+    assert requests[0]['id'] == 'spring-01'
+    assert len(requests[1]['id']) == 16
+    assert read_requests(path)[1]['id'] == requests[1]['id']
+
+
+def test_read_requests_reports_every_bad_line(tmp_path):
+    path = _write(tmp_path / 'requests.jsonl', [
+        json.dumps({'prompt': 'a'}),
+        'not json',
+        json.dumps({'config': {'count': 2}}),
+        json.dumps(['prompt']),
+    ])
+
+    with pytest.raises(ValueError) as error:
+        read_requests(path)
+
+    assert str(error.value).splitlines() == [
+        f'{path}:2: invalid JSON: Expecting value: line 1 column 1 (char 0)',
+        f'{path}:3: request needs a prompt, prompts or keyword',
+        f'{path}:4: request needs a prompt, prompts or keyword',
+    ]
@@ -0,0 +1,179 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import cache
+from cache import ImageCache, LLMCache, LRUCache, canonical_hash
+from config import config
+
+
+MODEL_ID = 'amazon.titan-image-generator-v2:0'
+
+
+def test_canonical_hash_ignores_key_order():
+    assert canonical_hash(MODEL_ID, {'a': 1, 'b': [1, 2]}) == canonical_hash(MODEL_ID, {'b': [1, 2], 'a': 1})
+
+
+def test_canonical_hash_keeps_strings_verbatim():
+    assert canonical_hash('"foo"') != canonical_hash('foo')
+    assert canonical_hash('1') != canonical_hash(1)
+    assert canonical_hash('1') != canonical_hash('1.0')
+    assert canonical_hash('a', 'b') != canonical_hash('ab')
+
+
+def test_image_cache_key_parses_the_request_body():
+    body = {'taskType': 'TEXT_IMAGE', 'textToImageParams': {'text': 'a red bicycle'}}
+
+    key = ImageCache.key(json.dumps(body), MODEL_ID)
+
+    assert key == ImageCache.key(json.dumps(body, indent=2, sort_keys=True), MODEL_ID)
+    assert key == canonical_hash(MODEL_ID, body)
+    assert key != ImageCache.key(json.dumps(body), 'amazon.titan-image-generator-v1')
+
+
+'''
+Image cache
+'''
+@pytest.fixture
+def clock(monkeypatch):
+    # distinct, increasing access times without sleeping
+    now = SimpleNamespace(value=1000.0)
+
+    def tick() -> float:
+        now.value += 1.0
+        return now.value
+
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(time=tick))
+    return now
+
+
+def _images(key: str, size: int = 100) -> list:
+    return [key.encode('utf8') * size]
+
+
+def _files(cache_dir) -> set:
+    return {name for name in os.listdir(cache_dir) if name.endswith('.png')}
+
+
+def test_lru_cache_byte_bound():
+    lru = LRUCache(max_items=10, max_bytes=10)
+
+    lru.put('a', b'aaaa')
+    lru.put('b', b'bbbb')
+    assert lru.get('a') == b'aaaa'
+    lru.put('c', b'cccc')
+
+    assert lru.get('b') is None
+    assert (lru.get('a'), lru.get('c')) == (b'aaaa', b'cccc')
+    assert lru.bytes == 8
+
+    lru.put('a', b'a')
+    lru.delete('c')
+    assert lru.bytes == 1
+
+    # a value larger than the bound is not kept
+    lru.put('d', b'd' * 11)
+    assert lru.get('d') is None
+
+
+def test_image_cache_memory_tier_is_bounded_by_bytes():
+    images = ImageCache(None, max_items=10, memory_max_bytes=250)
+
+    for key in 'abc':
+        images.put(key, _images(key))
+
+    assert images.get('a') is None
+    assert images.get('b') == _images('b')
+    assert images.stats()['memory_bytes'] == 200
+
+
+def test_disk_tier_evicts_least_recently_used(tmp_path, clock):
+    writer = ImageCache(str(tmp_path), max_bytes=250)
+    writer.put('a', _images('a'))
+    writer.put('b', _images('b'))
+
+    # a disk hit in another instance makes `a` the more recent entry
+    reader = ImageCache(str(tmp_path), max_bytes=250)
+    assert reader.get('a') == _images('a')
+    reader.put('c', _images('c'))
+
+    assert _files(tmp_path) == {'a-0.png', 'c-0.png'}
+    assert ImageCache(str(tmp_path)).stats()['disk_bytes'] == 200
+
+
+def test_disk_tier_drops_an_entry_larger_than_max_bytes(tmp_path, clock):
+    images = ImageCache(str(tmp_path), max_bytes=150)
+
+    images.put('a', _images('a'))
+    images.put('b', _images('b', 200))
+
+    assert _files(tmp_path) == {'a-0.png'}
+    assert ImageCache(str(tmp_path)).get('b') is None
+
+
+def test_processes_sharing_a_directory_merge_their_indexes(tmp_path, clock):
+    first = ImageCache(str(tmp_path))
+    second = ImageCache(str(tmp_path))
+
+    first.put('a', _images('a'))
+    second.put('b', _images('b'))
+    first.put('c', _images('c'))
+
+    with open(tmp_path / ImageCache.INDEX_FILE) as f:
+        assert set(json.load(f)) == {'a', 'b', 'c'}
+    # each instance finds the other's entries on disk
+    assert second.get('a') == _images('a')
+    assert first.get('b') == _images('b')
+    assert first.stats()['disk_hits'] == 1
+
+
+def test_miss_reloads_the_index_only_after_it_changed(tmp_path, monkeypatch, clock):
+    images = ImageCache(str(tmp_path))
+    images.put('a', _images('a'))
+    loads = []
+    load_index = images._load_index
+    monkeypatch.setattr(images, '_load_index', lambda: loads.append(1) or load_index())
+
+    assert images.get('missing') is None
+    assert images.get('missing') is None
+    assert loads == []
+
+    ImageCache(str(tmp_path)).put('b', _images('b'))
+
+    assert images.get('b') == _images('b')
+    assert loads == [1]
+
+
+'''
+LLM cache
+'''
+def test_llm_cache_covers_the_default_temperature():
+    cache = LLMCache(max_temperature=config.LLM_CACHE_MAX_TEMPERATURE)
+
+    # the app's temperature slider defaults to 0.7
+    assert cache.cacheable({'temperature': 0.7})
+    assert not cache.cacheable({'temperature': 1.0})
+    assert cache.cacheable({})
+
+
+def test_llm_cache_key_depends_on_every_part():
+    kwargs = {'temperature': 0.0, 'max_tokens': 512}
+    key = LLMCache.key('claude', 'a red bicycle', None, None, kwargs)
+
+    assert key == LLMCache.key('claude', 'a red bicycle', None, None, dict(reversed(kwargs.items())))
+    assert key != LLMCache.key('claude', 'a red bicycle', None, 'system', kwargs)
+    assert key != LLMCache.key('claude', 'a red bicycle', 'aW1hZ2U=', None, kwargs)
+    assert key != LLMCache.key('claude', '"a red bicycle"', None, None, kwargs)
+
+
+def test_llm_cache_counts_hits_and_misses():
+    cache = LLMCache()
+
+    assert cache.get('key') is None
+    cache.put('key', 'response')
+
+    assert cache.get('key') == 'response'
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
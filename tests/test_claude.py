@@ -0,0 +1,128 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError, EventStreamError
+
+from aws.claude import BedrockClaude
+from aws.client import register_client
+from aws.throttle import get_limiter
+from config import config
+from generator import PromptStream
+
+
+RESPONSE = 'Here you go.\n<prompt>a red bicycle</prompt>\n<prompt>a blue whale</prompt>'
+
+
+def _events(text: str, size: int = 7) -> list:
+    events = [{'type': 'message_start', 'message': {'usage': {'input_tokens': 12}}}]
+    events += [
+        {'type': 'content_block_delta', 'delta': {'type': 'text_delta', 'text': text[start:start + size]}}
+        for start in range(0, len(text), size)
+    ]
+    events.append({'type': 'message_delta', 'delta': {'stop_reason': 'end_turn'}, 'usage': {'output_tokens': 34}})
+    return [{'chunk': {'bytes': json.dumps(event).encode('utf8')}} for event in events]
+
+
+class StreamingRuntime:
+    '''
+    invoke_model_with_response_stream for Claude: streams RESPONSE in small
+    deltas, raises `error` instead of returning a stream, or raises
+    `stream_error` after `fail_after` events.
+    '''
+    def __init__(self, error: Exception = None, stream_error: Exception = None, fail_after: int = 3):
+        self.error = error
+        self.stream_error = stream_error
+        self.fail_after = fail_after
+        self.calls = 0
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return {'body': self._body()}
+
+    def _body(self):
+        for n, event in enumerate(_events(RESPONSE)):
+            if self.stream_error is not None and n == self.fail_after:
+                raise self.stream_error
+            yield event
+
+
+@pytest.fixture
+def runtime(monkeypatch):
+    def register(**options) -> StreamingRuntime:
+        runtime = StreamingRuntime(**options)
+        register_client('bedrock-runtime', runtime)
+        return runtime
+
+    monkeypatch.setattr(get_limiter(config.LLM_MODEL_ID), '_backoff', lambda attempt: 0.0)
+    return register
+
+
+def test_stream_yields_text_deltas_then_stop(runtime):
+    runtime()
+
+    events = list(BedrockClaude().invoke_llm_stream('draw'))
+
+    assert ''.join(event['text'] for event in events[:-1]) == RESPONSE
+    assert events[-1] == {'type': 'stop', 'stop_reason': 'end_turn', 'usage': {'input_tokens': 12, 'output_tokens': 34}}
+
+
+def test_stream_throttled_past_retries_ends_with_an_error(runtime):
+    throttled = ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'Rate exceeded'}}, 'InvokeModelWithResponseStream')
+    fake = runtime(error=throttled)
+
+    events = list(BedrockClaude().invoke_llm_stream('draw'))
+
+    assert events == [{'type': 'stop', 'stop_reason': 'error', 'usage': {}}]
+    assert fake.calls == config.BEDROCK_MAX_ATTEMPTS
+
+
+def test_stream_error_keeps_the_text_already_streamed(runtime):
+    error = EventStreamError({'Error': {'Code': 'ModelStreamErrorException', 'Message': 'stream broke'}}, 'InvokeModelWithResponseStream')
+    runtime(stream_error=error, fail_after=3)
+
+    events = list(BedrockClaude().invoke_llm_stream('draw'))
+
+    assert ''.join(event['text'] for event in events[:-1]) == RESPONSE[:14]
+    assert events[-1]['stop_reason'] == 'error'
+
+
+'''
+PromptStream
+'''
+def _text_events(*texts) -> list:
+    return [{'type': 'text', 'text': text} for text in texts] + [
+        {'type': 'stop', 'stop_reason': 'end_turn', 'usage': {'output_tokens': 5}}
+    ]
+
+
+def test_prompts_split_across_chunks():
+    stream = PromptStream(_text_events('intro <pro', 'mpt>a red', ' bicycle</pr', 'ompt><prompt>a whale<', '/prompt>'))
+
+    assert list(stream) == ['a red bicycle', 'a whale']
+    assert stream.stop_reason == 'end_turn'
+    assert stream.usage == {'output_tokens': 5}
+
+
+def test_prompts_fed_one_character_at_a_time():
+    stream = PromptStream(_text_events(*RESPONSE))
+
+    assert list(stream) == ['a red bicycle', 'a blue whale']
+    assert stream.text == RESPONSE
+
+
+def test_each_prompt_is_yielded_as_soon_as_it_closes():
+    stream = PromptStream([])
+
+    assert stream.feed('<prompt>a red') == []
+    assert stream.feed(' bicycle</prompt> and <prompt>a wh') == ['a red bicycle']
+    assert stream.feed('ale</prompt><prompt>unfinished') == ['a whale']
+    assert stream.feed('') == []
+
+
+def test_unclosed_prompt_is_not_yielded():
+    stream = PromptStream(_text_events('<prompt>a red bicycle</prompt><prompt>cut off by max_tokens'))
+
+    assert list(stream) == ['a red bicycle']
+    assert stream.text.endswith('cut off by max_tokens')
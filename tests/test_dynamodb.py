@@ -0,0 +1,183 @@
+from decimal import Decimal
+
+import pytest
+from boto3.dynamodb.types import Binary
+
+from aws.client import register_resource
+from aws.dynamodb import (
+    DynamoDB, GALLERY_PARTITION, UnprocessedItemsError, from_dynamodb, to_dynamodb, _decode_cursor, _encode_cursor,
+)
+from benchmarks.fakes import FakeDynamoDB
+
+
+def _item(n: int, **extra) -> dict:
+    return {
+        'id': f'image-{n:03d}',
+        'url': f'https://cdn.example.com/{n}.png',
+        'prompt': f'prompt {n}',
+        'gallery': GALLERY_PARTITION,
+        'created_at': 1_700_000_000_000 + n * 1000,
+        'embedding': b'\0' * 16,
+        **extra,
+    }
+
+
+@pytest.fixture
+def fake():
+    fake = FakeDynamoDB()
+    register_resource('dynamodb', fake)
+    return fake
+
+
+@pytest.fixture
+def db(fake):
+    return DynamoDB('gallery', index_name='gallery-created-index')
+
+
+def test_query_page_newest_first(fake, db):
+    fake.Table('gallery').load([_item(n) for n in range(10)])
+
+    page = db.query_page(limit=3)
+
+    assert [item['id'] for item in page['Items']] == ['image-009', 'image-008', 'image-007']
+    assert page['cursor'] is not None
+    assert 'embedding' not in page['Items'][0]
+
+
+def test_query_page_cursor_walks_every_item_once(fake, db):
+    fake.Table('gallery').load([_item(n) for n in range(23)])
+
+    ids = []
+    cursor = None
+    while True:
+        page = db.query_page(limit=5, cursor=cursor, newest_first=False)
+        ids += [item['id'] for item in page['Items']]
+        cursor = page['cursor']
+        if cursor is None:
+            break
+
+    assert ids == [f'image-{n:03d}' for n in range(23)]
+
+
+def test_query_page_since(fake, db):
+    fake.Table('gallery').load([_item(n) for n in range(10)])
+
+    page = db.query_page(limit=50, newest_first=False, since=_item(7)['created_at'])
+
+    assert [item['id'] for item in page['Items']] == ['image-007', 'image-008', 'image-009']
+    assert page['cursor'] is None
+
+
+def test_query_page_skips_items_outside_the_gallery(fake, db):
+    fake.Table('gallery').load([_item(0), {'id': 'legacy', 'created': '24-01-02 03:04:05'}])
+
+    page = db.query_page()
+
+    assert [item['id'] for item in page['Items']] == ['image-000']
+    assert page['cursor'] is None
+
+
+def test_cursor_round_trip():
+    key = {'id': 'image-001', 'gallery': GALLERY_PARTITION, 'created_at': Decimal(1700000001000)}
+
+    cursor = _encode_cursor(key)
+
+    assert isinstance(cursor, str)
+    assert _decode_cursor(cursor) == key
+
+
+def test_put_items_retries_unprocessed_items():
+    fake = FakeDynamoDB(unprocessed_rate=0.5, seed=1)
+    register_resource('dynamodb', fake)
+    db = DynamoDB('gallery')
+    items = [_item(n) for n in range(60)]
+
+    db.put_items(items)
+
+    assert sorted(fake.Table('gallery').items) == [item['id'] for item in items]
+    assert fake.batch_writes > 3  # 3 batches of at most 25, plus retries
+
+
+def test_put_items_gives_up_after_max_retries():
+    fake = FakeDynamoDB(unprocessed_rate=1.0)
+    register_resource('dynamodb', fake)
+    db = DynamoDB('gallery')
+
+    with pytest.raises(UnprocessedItemsError) as e:
+        db.put_items([_item(0)], max_retries=2)
+    assert fake.batch_writes == 3
+    assert [item['id'] for item in e.value.items] == ['image-000']
+
+
+def test_put_items_tries_every_batch_before_raising():
+    fake = FakeDynamoDB(unprocessed_rate=0.1, seed=3)
+    register_resource('dynamodb', fake)
+    db = DynamoDB('gallery')
+    items = [_item(n) for n in range(60)]
+
+    with pytest.raises(UnprocessedItemsError) as e:
+        db.put_items(items, max_retries=0)
+
+    written = set(fake.Table('gallery').items)
+    unwritten = [item['id'] for item in e.value.items]
+    assert unwritten
+    assert sorted(written | set(unwritten)) == [item['id'] for item in items]
+    assert not written & set(unwritten)
+    assert fake.batch_writes == 3
+
+
+def test_backfill_gallery_keys(fake, db):
+    legacy = [{'id': 'legacy-1', 'created': '24-01-02 03:04:05'}, {'id': 'legacy-2', 'created': 'not a date'}]
+    fake.Table('gallery').load([_item(0)] + legacy)
+
+    assert db.backfill_gallery_keys() == 2
+    assert db.backfill_gallery_keys() == 0
+
+    items = fake.Table('gallery').items
+    assert items['legacy-1']['gallery'] == GALLERY_PARTITION
+    assert items['legacy-1']['created_at'] > 0
+    assert items['legacy-2']['created_at'] == 0
+    assert items['image-000']['created_at'] == _item(0)['created_at']
+
+    page = db.query_page(limit=10, newest_first=False)
+    assert [item['id'] for item in page['Items']] == ['legacy-2', 'image-000', 'legacy-1']
+
+
+'''
+Conversion
+'''
+def test_to_dynamodb_converts_floats_to_decimal():
+    value = to_dynamodb({'cfgScale': 8.0, 'ratio': 0.1, 'seed': 42, 'tags': ['a', 1.5], 'size': (512, 0.5)})
+
+    assert value == {'cfgScale': Decimal('8.0'), 'ratio': Decimal('0.1'), 'seed': 42,
+                     'tags': ['a', Decimal('1.5')], 'size': [512, Decimal('0.5')]}
+    assert isinstance(value['seed'], int)
+
+
+def test_from_dynamodb_restores_ints_and_floats():
+    value = from_dynamodb({
+        'seed': Decimal('42'),
+        'cfgScale': Decimal('8.0'),
+        'ratio': Decimal('0.1'),
+        'config': {'imageGenerationConfig': {'width': Decimal('512'), 'colors': ['#ff0000', Decimal('2.5')]}},
+        'labels': {'a', 'b'},
+    })
+
+    assert value['seed'] == 42 and isinstance(value['seed'], int)
+    assert value['cfgScale'] == 8 and isinstance(value['cfgScale'], int)
+    assert value['ratio'] == 0.1 and isinstance(value['ratio'], float)
+    assert value['config'] == {'imageGenerationConfig': {'width': 512, 'colors': ['#ff0000', 2.5]}}
+    assert sorted(value['labels']) == ['a', 'b']
+
+
+def test_round_trip_keeps_bytes():
+    vector = b'\x00\x00\x80?' * 4
+    item = {'id': 'image-000', 'embedding': vector, 'config': {'cfgScale': 7.5}}
+
+    stored = to_dynamodb(item)
+    assert stored['embedding'] is vector
+
+    # boto3 reads binary attributes back as Binary
+    loaded = from_dynamodb({**stored, 'embedding': Binary(vector)})
+    assert loaded['embedding'].value == vector
+    assert loaded['config'] == {'cfgScale': 7.5}
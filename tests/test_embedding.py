@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from aws.client import register_client
+from aws.embedding import BedrockEmbedding, EmbeddingCache, EmbeddingError
+from benchmarks.fakes import FakeBedrockRuntime
+
+
+class NoEmbeddingRuntime(FakeBedrockRuntime):
+    def _embedding(self, request: dict) -> dict:
+        return {'inputTextTokenCount': 3}
+
+
+@pytest.fixture
+def runtime():
+    def register(fake: FakeBedrockRuntime = None) -> FakeBedrockRuntime:
+        fake = fake or FakeBedrockRuntime(embedding_dim=8)
+        register_client('bedrock-runtime', fake)
+        return fake
+    return register
+
+
+def test_embed_many_embeds_duplicates_once_in_input_order(runtime):
+    fake = runtime()
+    embedding = BedrockEmbedding()
+    texts = ['a red bicycle', 'a whale', 'a red bicycle', 'a fox', 'a whale']
+
+    vectors = embedding.embed_many(texts=texts)
+
+    assert fake.calls == 3
+    assert vectors.shape == (5, 8)
+    assert vectors.dtype == np.float32
+    for text, vector in zip(texts, vectors):
+        assert vector == pytest.approx(np.asarray(embedding.embedding_text(text), dtype=np.float32))
+    assert np.array_equal(vectors[0], vectors[2])
+    assert not np.array_equal(vectors[0], vectors[1])
+
+
+def test_embed_many_reuses_the_cache(runtime, tmp_path):
+    fake = runtime()
+    embedding = BedrockEmbedding(cache=EmbeddingCache(str(tmp_path)))
+
+    first = embedding.embed_many(texts=['a', 'b'])
+    second = embedding.embed_many(texts=['b', 'c', 'a'])
+
+    assert fake.calls == 3
+    assert np.array_equal(second[0], first[1])
+    assert np.array_equal(second[2], first[0])
+
+
+def test_embed_many_empty_input(runtime):
+    runtime()
+
+    assert BedrockEmbedding().embed_many(texts=[]).shape == (0, 0)
+
+
+def test_missing_embedding_raises(runtime):
+    runtime(NoEmbeddingRuntime())
+    embedding = BedrockEmbedding()
+
+    with pytest.raises(EmbeddingError):
+        embedding.embedding_text('a red bicycle')
+    with pytest.raises(EmbeddingError):
+        embedding.embedding_multimodal(text='a red bicycle')
+    with pytest.raises(EmbeddingError) as e:
+        embedding.embed_many(texts=['a', 'b', 'a'])
+    assert len(e.value.failures) == 2
+
+
+def test_failed_request_raises(runtime):
+    runtime(FakeBedrockRuntime(error_rate=1.0, error_code='ValidationException'))
+
+    with pytest.raises(EmbeddingError) as e:
+        BedrockEmbedding().embedding_multimodal(image='aW1hZ2U=')
+    assert 'ValidationException' in str(e.value)
@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+import generator
+from generator import _parse_batch_tags, gen_tags_batch
+
+
+def test_parse_batch_tags():
+    answer = json.dumps({'1': ['bicycle', 'red'], '2': ['whale'], '3': []})
+
+    assert _parse_batch_tags(answer, 3) == [['bicycle', 'red'], ['whale'], []]
+
+
+def test_parse_batch_tags_key_forms():
+    answer = json.dumps({'Image 1': ['a'], 'image2': ['b'], ' 3 ': ['c'], 'img4': ['d'], '5a': ['e'], '1.5': ['f']})
+
+    assert _parse_batch_tags(answer, 6) == [['a'], ['b'], ['c'], None, None, None]
+
+
+def test_parse_batch_tags_ignores_surrounding_prose():
+    answer = 'Here are the tags: {"1": ["red"], "2": ["blue"]}\nNote: {"1"} was hard to see.'
+
+    assert _parse_batch_tags(answer, 2) == [['red'], ['blue']]
+
+
+@pytest.mark.parametrize('answer', [
+    None,
+    '',
+    'I cannot tag these images.',
+    '{"1": ["red"], "2": ["blue"',
+    '["red", "blue"]',
+])
+def test_malformed_answer_falls_back_for_every_image(answer):
+    assert _parse_batch_tags(answer, 2) == [None, None]
+
+
+def test_partial_and_out_of_range_answers():
+    answer = json.dumps({'0': ['zero'], '1': ['red'], '3': 'not a list', '4': ['four'], '2': [7, 'blue']})
+
+    assert _parse_batch_tags(answer, 3) == [['red'], ['7', 'blue'], None]
+
+
+class FakeClaude:
+    '''
+    Answers a batch request with `batch_answer` and a single-image request
+    with that image's tags, or raises for the images in `failing`.
+    '''
+    def __init__(self, batch_answer: str, failing=()):
+        self.batch_answer = batch_answer
+        self.failing = set(failing)
+        self.single_calls = []
+
+    def invoke_llm_response(self, text: str, image=None):
+        if isinstance(image, list):
+            return self.batch_answer
+        self.single_calls.append(image)
+        if image in self.failing:
+            raise RuntimeError(f'cannot tag {image}')
+        return json.dumps([f'{image}-tag'])
+
+
+def test_missing_images_fall_back_one_at_a_time(monkeypatch):
+    claude = FakeClaude(json.dumps({'1': ['a-tag'], '3': ['c-tag'], '7': ['stray']}))
+    monkeypatch.setattr(generator, 'get_claude', lambda: claude)
+
+    tags = gen_tags_batch(['a', 'b', 'c', 'd'], batch_size=4)
+
+    assert tags == [['a-tag'], ['b-tag'], ['c-tag'], ['d-tag']]
+    assert claude.single_calls == ['b', 'd']
+
+
+def test_failed_fallback_leaves_that_image_untagged(monkeypatch):
+    claude = FakeClaude('not json', failing={'b'})
+    monkeypatch.setattr(generator, 'get_claude', lambda: claude)
+
+    tags = gen_tags_batch(['a', 'b', 'c'], batch_size=3)
+
+    assert tags == [['a-tag'], [], ['c-tag']]
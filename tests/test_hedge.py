@@ -0,0 +1,179 @@
+import json
+import time
+import asyncio
+
+import pytest
+from botocore.exceptions import ClientError
+
+from aws.hedge import RegionRouter
+from benchmarks.fakes import FakeBedrockRuntime, Latency
+
+
+MODEL_ID = 'amazon.titan-embed-text-v2:0'
+BODY = json.dumps({'inputText': 'a red bicycle'})
+REGIONS = ['us-east-1', 'us-west-2']
+
+
+def _router(**options) -> RegionRouter:
+    return RegionRouter(name='test', regions=REGIONS, **{'min_delay': 0.05, 'min_samples': 1000, **options})
+
+
+def _invoke(fakes: dict):
+    def invoke(region, body):
+        fakes[region].invoke_model(body=body, modelId=MODEL_ID)
+        return region
+    return invoke
+
+
+def _ainvoke(latency: dict, failing: tuple = (), cancelled: list = None):
+    async def invoke(region, body):
+        try:
+            await asyncio.sleep(latency.get(region, 0.0))
+        except asyncio.CancelledError:
+            cancelled.append(region)
+            raise
+        if region in failing:
+            raise ClientError({'Error': {'Code': 'ServiceUnavailableException', 'Message': 'fake'}}, 'InvokeModel')
+        return region
+    return invoke
+
+
+def test_single_region_runs_inline():
+    router = RegionRouter(name='test', regions=['us-east-1'])
+    fake = FakeBedrockRuntime()
+
+    assert router.call(_invoke({'us-east-1': fake}), BODY) == 'us-east-1'
+    assert router.hedges == router.failovers == 0
+
+
+def test_failover_on_regional_error():
+    router = _router()
+    fakes = {'us-east-1': FakeBedrockRuntime(error_rate=1.0), 'us-west-2': FakeBedrockRuntime()}
+
+    assert router.call(_invoke(fakes), BODY) == 'us-west-2'
+    assert router.failovers == 1
+    assert router.health['us-east-1'].failures == 1
+
+
+def test_failover_on_throttling():
+    router = _router()
+    fakes = {'us-east-1': FakeBedrockRuntime(throttle_rate=1.0), 'us-west-2': FakeBedrockRuntime()}
+
+    assert router.call(_invoke(fakes), BODY) == 'us-west-2'
+    assert router.failovers == 1
+
+
+def test_request_errors_are_not_failed_over():
+    router = _router()
+    fakes = {
+        'us-east-1': FakeBedrockRuntime(error_rate=1.0, error_code='ValidationException'),
+        'us-west-2': FakeBedrockRuntime(),
+    }
+
+    with pytest.raises(ClientError):
+        router.call(_invoke(fakes), BODY)
+    assert router.failovers == 0
+    assert fakes['us-west-2'].calls == 0
+    assert router.health['us-east-1'].consecutive_failures == 0
+
+
+def test_raises_when_every_region_fails():
+    router = _router()
+    fakes = {region: FakeBedrockRuntime(error_rate=1.0) for region in REGIONS}
+
+    with pytest.raises(ClientError):
+        router.call(_invoke(fakes), BODY)
+    assert router.failovers == 1
+
+
+def test_failing_region_cools_down():
+    router = _router(failure_threshold=2, cooldown=0.2)
+    fakes = {'us-east-1': FakeBedrockRuntime(error_rate=1.0), 'us-west-2': FakeBedrockRuntime()}
+
+    for _ in range(2):
+        router.call(_invoke(fakes), BODY)
+    assert router.ordered_regions() == ['us-west-2', 'us-east-1']
+    assert not router.stats()['regions']['us-east-1']['healthy']
+
+    # the primary sits out: calls go straight to the secondary
+    router.call(_invoke(fakes), BODY)
+    assert fakes['us-east-1'].calls == 2
+    assert router.failovers == 2
+
+    time.sleep(0.25)
+    assert router.ordered_regions() == REGIONS
+
+
+def test_success_resets_the_failure_streak():
+    router = _router(failure_threshold=2)
+    primary = FakeBedrockRuntime(error_rate=1.0)
+    fakes = {'us-east-1': primary, 'us-west-2': FakeBedrockRuntime()}
+
+    router.call(_invoke(fakes), BODY)
+    primary.error_rate = 0.0
+    router.call(_invoke(fakes), BODY)
+
+    assert router.health['us-east-1'].consecutive_failures == 0
+    assert router.ordered_regions() == REGIONS
+
+
+def test_hedges_a_slow_primary():
+    router = _router()
+    fakes = {
+        'us-east-1': FakeBedrockRuntime(latency={'embedding': Latency(0.5, 'fixed')}),
+        'us-west-2': FakeBedrockRuntime(latency={'embedding': Latency(0.01, 'fixed')}),
+    }
+
+    start = time.perf_counter()
+    assert router.call(_invoke(fakes), BODY) == 'us-west-2'
+    assert time.perf_counter() - start < 0.3
+    assert router.hedges == 1
+    assert router.failovers == 0
+
+
+def test_no_hedge_when_the_primary_is_fast():
+    router = _router()
+    fakes = {
+        'us-east-1': FakeBedrockRuntime(latency={'embedding': Latency(0.01, 'fixed')}),
+        'us-west-2': FakeBedrockRuntime(),
+    }
+
+    for _ in range(5):
+        assert router.call(_invoke(fakes), BODY) == 'us-east-1'
+    assert router.hedges == 0
+    assert fakes['us-west-2'].calls == 0
+
+
+def test_hedge_delay_follows_the_primary_percentile():
+    router = _router(min_samples=10, hedge_percentile=95.0)
+    for seconds in [0.1] * 19 + [2.0]:
+        router.health['us-east-1'].on_success(seconds)
+
+    assert router.hedge_delay('us-east-1') == pytest.approx(router.health['us-east-1'].percentile(95))
+    assert _router().hedge_delay('us-east-1') == 0.05
+
+
+def test_acall_hedges_and_cancels_the_slow_call():
+    router = _router()
+    cancelled = []
+
+    async def main():
+        start = time.perf_counter()
+        region = await router.acall(_ainvoke({'us-east-1': 5.0, 'us-west-2': 0.01}, cancelled=cancelled), BODY)
+        seconds = time.perf_counter() - start
+        await asyncio.sleep(0)
+        return region, seconds
+
+    region, seconds = asyncio.run(main())
+    assert region == 'us-west-2'
+    assert seconds < 0.5
+    assert cancelled == ['us-east-1']
+    assert router.hedges == 1
+
+
+def test_acall_fails_over():
+    router = _router()
+
+    assert asyncio.run(router.acall(_ainvoke({}, failing=('us-east-1',)), BODY)) == 'us-west-2'
+    assert router.failovers == 1
+    assert router.health['us-east-1'].failures == 1
@@ -0,0 +1,151 @@
+import socket
+import sqlite3
+import subprocess
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import jobs
+from jobs import JobQueue
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = SimpleNamespace(value=1000.0)
+    monkeypatch.setattr(jobs, 'time', SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+def _dead_pid() -> int:
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def test_each_job_is_claimed_once(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    submitted = {JobQueue(path).submit({'prompts': [str(n)]}) for n in range(40)}
+    claimed = []
+
+    def _claim(worker: str):
+        queue = JobQueue(path)  # one connection per worker, as in separate processes
+        while True:
+            job = queue.claim(worker)
+            if job is None:
+                return
+            claimed.append((job['id'], job['worker']))
+
+    threads = [threading.Thread(target=_claim, args=(f'host:{n}',)) for n in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(job_id for job_id, _ in claimed) == sorted(submitted)
+    queue = JobQueue(path)
+    for job_id, worker in claimed:
+        job = queue.get(job_id)
+        assert (job['status'], job['worker']) == ('running', worker)
+
+
+def test_claims_oldest_queued_job(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    first = queue.submit({'prompts': ['a']})
+    clock.value += 1
+    queue.submit({'prompts': ['b']})
+
+    job = queue.claim('host:1')
+
+    assert job['id'] == first
+    assert job['request'] == {'prompts': ['a'], 'id': first}
+    assert job['started_at'] == job['heartbeat_at'] == 1001.0
+
+
+def test_stale_claims_expire_on_any_host(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    job_id = queue.submit({'prompts': ['a']})
+    queue.claim('elsewhere:1234')
+
+    clock.value += 50
+    assert queue.recover(lease=60) == 0
+    assert queue.heartbeat(job_id, 'elsewhere:1234')
+
+    clock.value += 50
+    assert queue.recover(lease=60) == 0
+
+    clock.value += 61
+    assert queue.recover(lease=60) == 1
+    job = queue.get(job_id)
+    assert job['status'] == 'failed'
+    assert 'no heartbeat from elsewhere:1234' in job['error']
+
+
+def test_expired_claim_is_not_renewed_or_finished(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    job_id = queue.submit({'prompts': ['a']})
+    queue.claim('elsewhere:1234')
+    clock.value += 61
+    queue.recover(lease=60)
+
+    assert not queue.heartbeat(job_id, 'elsewhere:1234')
+    assert not queue.finish(job_id, result={'images': []}, worker='elsewhere:1234')
+    assert queue.get(job_id)['status'] == 'failed'
+
+
+def test_dead_local_worker_fails_its_job_before_the_lease_expires(tmp_path, clock):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    host = socket.gethostname()
+    lost = queue.submit({'prompts': ['a']})
+    queue.claim(f'{host}:{_dead_pid()}')
+    alive = queue.submit({'prompts': ['b']})
+    queue.claim(f'{host}:{jobs.os.getpid()}')
+
+    assert queue.recover(lease=60) == 1
+    assert queue.get(lost)['error'] == 'interrupted: worker exited while running the job'
+    assert queue.get(alive)['status'] == 'running'
+
+
+def test_finish_from_the_claiming_worker(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    job_id = queue.submit({'prompts': ['a']})
+    queue.claim('host:1')
+
+    assert not queue.finish(job_id, result={'images': []}, worker='host:2')
+    assert queue.finish(job_id, result={'images': ['a.png']}, worker='host:1')
+    job = queue.get(job_id)
+    assert (job['status'], job['result']) == ('done', {'images': ['a.png']})
+
+
+def test_heartbeat_thread_renews_the_claim(tmp_path):
+    queue = JobQueue(str(tmp_path / 'jobs.sqlite3'))
+    job_id = queue.submit({'prompts': ['a']})
+    queue.claim('host:1')
+    started = queue.get(job_id)['heartbeat_at']
+
+    with jobs._heartbeat(queue, job_id, 'host:1', interval=0.01):
+        threading.Event().wait(0.05)
+
+    assert queue.get(job_id)['heartbeat_at'] > started
+
+
+def test_opens_a_queue_created_without_heartbeats(tmp_path):
+    path = str(tmp_path / 'jobs.sqlite3')
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE jobs (id TEXT PRIMARY KEY, status TEXT, request TEXT, result TEXT, error TEXT, worker TEXT, '
+        'created_at REAL, started_at REAL, finished_at REAL)'
+    )
+    conn.execute(
+        "INSERT INTO jobs (id, status, request, worker, created_at, started_at) "
+        "VALUES ('old', 'running', '{}', 'elsewhere:1', 0, 0)"
+    )
+    conn.commit()
+    conn.close()
+
+    queue = JobQueue(path)
+
+    assert queue.get('old')['heartbeat_at'] is None
+    # falls back to started_at for claims made before the upgrade
+    assert queue.recover(lease=60) == 1
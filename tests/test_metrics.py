@@ -0,0 +1,105 @@
+import json
+import urllib.error
+import urllib.request
+
+import pytest
+
+import metrics as metrics_module
+from metrics import Histogram, Metrics, SECONDS_BUCKETS, metrics
+
+
+def test_histogram_percentiles():
+    histogram = Histogram(SECONDS_BUCKETS)
+    for value in range(1, 101):
+        histogram.observe(float(value))
+
+    assert histogram.percentiles() == {'p50': pytest.approx(50.5), 'p95': pytest.approx(95.05), 'p99': pytest.approx(99.01)}
+    assert histogram.percentiles(qs=(0, 100)) == {'p0': 1.0, 'p100': 100.0}
+    assert (histogram.count, histogram.sum) == (100, 5050.0)
+
+
+def test_histogram_percentiles_cover_the_window_only():
+    histogram = Histogram(SECONDS_BUCKETS, window=10)
+    for value in range(100):
+        histogram.observe(float(value))
+
+    assert histogram.percentiles(qs=(0, 50)) == {'p0': 90.0, 'p50': 94.5}
+    # buckets and totals still count every sample
+    assert histogram.count == sum(histogram.counts) == 100
+
+
+def test_empty_histogram_has_no_percentiles():
+    assert Histogram(SECONDS_BUCKETS).percentiles() == {'p50': None, 'p95': None, 'p99': None}
+
+
+def _metrics() -> Metrics:
+    m = Metrics(prefix='test')
+    m.observe('request_seconds', 0.25, stage='image')
+    m.observe('request_seconds', 0.3, stage='image')
+    m.observe('request_seconds', 100, stage='tag "batch"')
+    m.inc('stage_errors_total', stage='image', error='ClientError')
+    m.add_gauges(lambda: [('jobs', {'status': 'queued'}, 3)])
+    return m
+
+
+def test_prometheus_export():
+    lines = _metrics().to_prometheus().splitlines()
+
+    assert lines[:2] == ['# TYPE test_jobs gauge', 'test_jobs{status="queued"} 3']
+    assert '# TYPE test_request_seconds histogram' in lines
+    # buckets are cumulative, and a value on a bound falls in that bucket
+    assert 'test_request_seconds_bucket{stage="image",le="0.1"} 0' in lines
+    assert 'test_request_seconds_bucket{stage="image",le="0.25"} 1' in lines
+    assert 'test_request_seconds_bucket{stage="image",le="0.5"} 2' in lines
+    assert 'test_request_seconds_bucket{stage="image",le="+Inf"} 2' in lines
+    assert 'test_request_seconds_sum{stage="image"} 0.55' in lines
+    assert 'test_request_seconds_count{stage="image"} 2' in lines
+    assert 'test_request_seconds_bucket{stage="tag \\"batch\\"",le="120"} 1' in lines
+    assert lines[-2:] == [
+        '# TYPE test_stage_errors_total counter',
+        'test_stage_errors_total{error="ClientError",stage="image"} 1',
+    ]
+
+
+def test_json_export():
+    snapshot = json.loads(_metrics().to_json())
+
+    image, tag = snapshot['histograms']
+    assert image['name'] == 'request_seconds'
+    assert image['labels'] == {'stage': 'image'}
+    assert (image['count'], image['sum']) == (2, pytest.approx(0.55))
+    assert image['p50'] == pytest.approx(0.275)
+    assert tag['labels'] == {'stage': 'tag "batch"'}
+    assert snapshot['counters'] == [
+        {'name': 'stage_errors_total', 'labels': {'error': 'ClientError', 'stage': 'image'}, 'value': 1}
+    ]
+    assert snapshot['gauges'] == [{'name': 'jobs', 'labels': {'status': 'queued'}, 'value': 3}]
+
+
+def test_export_formats():
+    m = _metrics()
+
+    assert m.export('prometheus') == (m.to_prometheus(), 'text/plain; version=0.0.4')
+    assert m.export('json') == (m.to_json(), 'application/json')
+    with pytest.raises(ValueError):
+        m.export('csv')
+
+
+def test_serve(monkeypatch):
+    monkeypatch.setattr(metrics_module, '_server', None)
+    metrics.inc('test_serve_total')
+
+    server = metrics_module.serve(0, host='127.0.0.1')
+    try:
+        assert metrics_module.serve(0, host='127.0.0.1') is server
+        url = f'http://127.0.0.1:{server.server_address[1]}'
+        with urllib.request.urlopen(f'{url}/metrics') as response:
+            assert response.headers['Content-Type'] == 'text/plain; version=0.0.4'
+            assert 'imagegen_test_serve_total 1' in response.read().decode('utf8')
+        with urllib.request.urlopen(f'{url}/metrics.json') as response:
+            assert 'counters' in json.loads(response.read())
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(f'{url}/other')
+    finally:
+        server.shutdown()
+        server.server_close()
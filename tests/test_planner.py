@@ -0,0 +1,78 @@
+import json
+import time
+
+import pytest
+
+import planner
+from params import ImageParams
+from planner import MAX_SEED, derive_seed, gen_images, plan
+
+
+def _counts(shards) -> list:
+    return [shard.count for shard in shards]
+
+
+def test_plan_images_per_request():
+    assert _counts(plan(7, 42, policy='latency', max_shards=16)) == [1] * 7
+    assert _counts(plan(7, 42, policy='balanced', max_shards=16)) == [2, 2, 2, 1]
+    assert _counts(plan(7, 42, policy='requests', max_shards=16)) == [5, 2]
+    assert [shard.offset for shard in plan(7, 42, policy='balanced', max_shards=16)] == [0, 2, 4, 6]
+
+
+def test_default_policy_keeps_small_counts_in_one_request():
+    for total in range(1, 6):
+        shards = plan(total, 42, max_shards=16)
+
+        assert _counts(shards) == [total]
+        assert shards[0].seed == 42
+
+
+def test_plan_never_exceeds_max_shards():
+    assert _counts(plan(10, 42, policy='latency', max_shards=4)) == [3, 3, 3, 1]
+    # shards never grow past Titan's 5 images per request
+    assert _counts(plan(10, 42, policy='latency', max_shards=1)) == [5, 5]
+
+
+def test_plan_rejects_unknown_policy():
+    with pytest.raises(ValueError):
+        plan(4, 42, policy='fastest', max_shards=16)
+
+
+def test_derive_seed():
+    seeds = [derive_seed(42, offset) for offset in range(10)]
+
+    assert seeds[0] == 42
+    assert seeds == [derive_seed(42, offset) for offset in range(10)]
+    assert len(set(seeds)) == 10
+    assert all(0 <= seed <= MAX_SEED for seed in seeds)
+    assert derive_seed(43, 5) != derive_seed(42, 5)
+
+
+def test_shard_seeds_depend_on_the_first_image_index():
+    # the same image keeps its seed when the policy changes the shard sizes
+    balanced = {shard.offset: shard.seed for shard in plan(8, 42, policy='balanced', max_shards=16)}
+    latency = {shard.offset: shard.seed for shard in plan(8, 42, policy='latency', max_shards=16)}
+
+    assert all(latency[offset] == seed for offset, seed in balanced.items())
+
+
+def test_gen_images_merges_in_shard_order(monkeypatch):
+    shards = plan(7, 42, policy='balanced')
+    # earlier shards finish last
+    delays = {shard.seed: 0.01 * (len(shards) - n) for n, shard in enumerate(shards)}
+
+    def fake_gen_image(body: str, debug: bool = False) -> list:
+        cfg = json.loads(body)['imageGenerationConfig']
+        time.sleep(delays[cfg['seed']])
+        return [f"{cfg['seed']}-{n}" for n in range(cfg['numberOfImages'])]
+
+    monkeypatch.setattr(planner, 'gen_image', fake_gen_image)
+
+    results = gen_images(ImageParams(seed=42), 7, lambda params: params.text_to_image(text='a red bicycle'), policy='balanced')
+
+    expected = [(shard, n) for shard in shards for n in range(shard.count)]
+    assert [image for image, _ in results] == [f'{shard.seed}-{n}' for shard, n in expected]
+    for (_, cfg), (shard, n) in zip(results, expected):
+        assert cfg['imageGenerationConfig']['seed'] == shard.seed
+        assert cfg['imageGenerationConfig']['numberOfImages'] == shard.count
+        assert cfg['imageIndex'] == n
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from reuse import GenerationReuse, config_signature
+from vector_index import VectorIndex
+
+
+def _unit(angle: float) -> list:
+    # 3-dim vector whose cosine similarity with [1, 0, 0] is cos(angle)
+    return [float(np.cos(angle)), float(np.sin(angle)), 0.0]
+
+
+CFG = {'imageGenerationConfig': {'numberOfImages': 1, 'width': 512, 'height': 512, 'cfgScale': 8.0, 'seed': 1}}
+PROMPTS = {
+    'a red bicycle': _unit(0.0),
+    'a red bike': _unit(np.arccos(0.95)),
+    'a blue bicycle': _unit(np.arccos(0.85)),
+    'a whale': [0.0, 0.0, 1.0],
+}
+
+
+class FakeEmbedding:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, prompt: str) -> list:
+        self.calls += 1
+        return PROMPTS.get(prompt, [])
+
+
+def _reuse(threshold: float = 0.92) -> GenerationReuse:
+    reuse = GenerationReuse(VectorIndex(), FakeEmbedding(), threshold=threshold)
+    reuse.record('image-0', 'a red bicycle', CFG, {'url': 'https://cdn.example.com/0.png'})
+    return reuse
+
+
+def test_reuse_above_threshold():
+    matches = _reuse().find('a red bike', CFG)
+
+    assert [(id, meta['url']) for id, _, meta in matches] == [('image-0', 'https://cdn.example.com/0.png')]
+    assert matches[0][1] == pytest.approx(0.95, abs=1e-6)
+
+
+def test_no_reuse_below_threshold():
+    reuse = _reuse()
+
+    assert reuse.find('a blue bicycle', CFG) == []
+    assert reuse.find('a whale', CFG) == []
+    assert len(reuse.find('a blue bicycle', CFG, threshold=0.8)) == 1
+
+
+def test_threshold_is_inclusive():
+    assert len(_reuse(threshold=0.95 - 1e-6).find('a red bike', CFG)) == 1
+    assert _reuse(threshold=0.96).find('a red bike', CFG) == []
+
+
+def test_no_reuse_with_another_configuration():
+    reuse = _reuse()
+    larger = {'imageGenerationConfig': {**CFG['imageGenerationConfig'], 'width': 1024, 'height': 1024}}
+    colored = {**CFG, 'colorGuide': ['#ff0000']}
+    reseeded = {'imageGenerationConfig': {**CFG['imageGenerationConfig'], 'seed': 7, 'numberOfImages': 3}}
+
+    assert reuse.find('a red bicycle', larger) == []
+    assert reuse.find('a red bicycle', colored) == []
+    assert len(reuse.find('a red bicycle', reseeded)) == 1
+    assert config_signature(CFG) == config_signature(reseeded)
+
+
+def test_reuse_without_embedding():
+    reuse = _reuse()
+
+    assert reuse.find('unknown prompt', CFG) == []
+    assert reuse.stats()['lookups'] == 1
+
+
+def test_reuse_stats_and_embedding_cache():
+    reuse = _reuse()
+    for prompt in ('a red bike', 'a red bike', 'a whale'):
+        reuse.find(prompt, CFG)
+
+    assert reuse.stats()['hits'] == 2
+    assert reuse.stats()['hit_rate'] == pytest.approx(2 / 3)
+    assert reuse.embed_fn.calls == 3  # 'a red bicycle', 'a red bike' once, 'a whale'
@@ -0,0 +1,95 @@
+import pytest
+from boto3.s3.transfer import TransferConfig
+
+from aws.client import register_client
+from aws.s3 import S3
+from benchmarks.fakes import FakeS3
+from image_buffer import ImageBuffer
+
+
+THRESHOLD = 1024
+
+
+class RecordingS3(FakeS3):
+    '''
+    FakeS3 that records how each key was uploaded and fails the keys in
+    `failing`.
+    '''
+    def __init__(self, failing=()):
+        super().__init__()
+        self.failing = set(failing)
+        self.calls = {}
+
+    def put_object(self, Bucket: str, Key: str, Body, **kwargs):
+        self.calls.setdefault(Key, 'put_object')
+        if Key in self.failing:
+            raise OSError(f'cannot write {Key}')
+        return super().put_object(Bucket=Bucket, Key=Key, Body=Body, **kwargs)
+
+    def upload_fileobj(self, Fileobj, Bucket: str, Key: str, ExtraArgs=None, Config=None, **kwargs):
+        self.calls[Key] = 'upload_fileobj'
+        super().upload_fileobj(Fileobj, Bucket=Bucket, Key=Key, ExtraArgs=ExtraArgs, Config=Config)
+
+
+@pytest.fixture
+def storage():
+    def register(**options) -> RecordingS3:
+        fake = RecordingS3(**options)
+        register_client('s3', fake)
+        return fake
+    return register
+
+
+def _s3() -> S3:
+    return S3('test-bucket', transfer_config=TransferConfig(multipart_threshold=THRESHOLD), max_workers=4)
+
+
+def test_small_objects_use_put_object(storage):
+    fake = storage()
+    objects = [{'key': f'small-{n}', 'bytes': bytes([n]) * 100} for n in range(5)]
+
+    stats = _s3().upload_many(objects)
+
+    assert fake.calls == {f'small-{n}': 'put_object' for n in range(5)}
+    assert fake.objects[('test-bucket', 'small-3')] == bytes([3]) * 100
+    assert (stats.objects, stats.bytes, stats.errors) == (5, 500, [])
+
+
+def test_large_objects_use_managed_upload(storage):
+    fake = storage()
+    image = ImageBuffer(b'\x89PNG' + b'\0' * THRESHOLD)
+    objects = [
+        {'key': 'large.png', 'bytes': image, 'extra_args': {'ContentType': 'image/png'}},
+        {'key': 'large.bin', 'bytes': b'\1' * (THRESHOLD * 3)},
+        {'key': 'small.webp', 'bytes': b'\2' * (THRESHOLD - 1)},
+    ]
+
+    stats = _s3().upload_many(objects)
+
+    assert fake.calls == {'large.png': 'upload_fileobj', 'large.bin': 'upload_fileobj', 'small.webp': 'put_object'}
+    assert fake.objects[('test-bucket', 'large.png')] == image.data
+    assert stats.bytes == len(image.data) + THRESHOLD * 3 + THRESHOLD - 1
+
+
+def test_errors_are_collected_per_key(storage):
+    storage(failing={'b', 'd'})
+    objects = [{'key': key, 'bytes': b'data'} for key in 'abcde']
+
+    stats = _s3().upload_many(objects)
+
+    assert stats.objects == 3
+    assert stats.bytes == 12
+    assert [key for key, _ in stats.errors] == ['b', 'd']
+    assert all(isinstance(e, OSError) for _, e in stats.errors)
+
+
+def test_upload_pool_is_shared_per_instance(storage):
+    storage()
+    s3 = _s3()
+
+    s3.upload_many([{'key': 'a', 'bytes': b'a'}])
+    executor = s3._get_executor()
+    s3.upload_many([{'key': 'b', 'bytes': b'b'}])
+
+    assert s3._get_executor() is executor
+    assert executor._max_workers == 4
@@ -0,0 +1,245 @@
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from singleflight import SingleFlight
+
+
+class SlowCall:
+    '''
+    Blocks every call until `release` is set and counts the calls made.
+    '''
+    def __init__(self, result='image'):
+        self.result = result
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5.0)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+def _followers(group: SingleFlight, call: SlowCall, n: int, **options):
+    '''
+    Start a leader, then `n` callers that join its call.
+
+    Returns:
+        tuple: (executor, leader future, follower futures)
+    '''
+    executor = ThreadPoolExecutor(max_workers=n + 1)
+    leader = executor.submit(group.do, 'key', call)
+    assert call.started.wait(5.0)
+    followers = [executor.submit(group.do, 'key', call, **options) for _ in range(n)]
+    while group.saved < n:
+        time.sleep(0.001)
+    return executor, leader, followers
+
+
+def test_identical_calls_run_once():
+    group = SingleFlight('test')
+    call = SlowCall()
+
+    executor, leader, followers = _followers(group, call, 7)
+    call.release.set()
+
+    assert [f.result() for f in [leader] + followers] == ['image'] * 8
+    assert call.calls == 1
+    assert group.stats() == {'calls': 1, 'saved': 7, 'timeouts': 0, 'in_flight': 0}
+    executor.shutdown()
+
+
+def test_finished_calls_are_not_replayed():
+    group = SingleFlight('test')
+    call = SlowCall()
+    call.release.set()
+
+    group.do('key', call)
+    group.do('key', call)
+
+    assert call.calls == 2
+
+
+def test_follower_times_out_while_the_leader_keeps_running():
+    group = SingleFlight('test')
+    call = SlowCall()
+
+    executor, leader, followers = _followers(group, call, 1, timeout=0.01)
+
+    with pytest.raises(TimeoutError):
+        followers[0].result()
+    assert not leader.done()
+    assert group.timeouts == 1
+
+    call.release.set()
+    assert leader.result() == 'image'
+    executor.shutdown()
+
+
+def test_leader_exception_reaches_every_follower():
+    group = SingleFlight('test')
+    call = SlowCall(result=ValueError('model error'))
+
+    executor, leader, followers = _followers(group, call, 3)
+    call.release.set()
+
+    for future in [leader] + followers:
+        with pytest.raises(ValueError, match='model error'):
+            future.result()
+    assert call.calls == 1
+    assert group.stats()['in_flight'] == 0
+    executor.shutdown()
+
+
+'''
+Coroutines
+'''
+def test_ado_coalesces_identical_calls():
+    group = SingleFlight('test')
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'image'
+
+    async def main():
+        return await asyncio.gather(*(group.ado('key', fn) for _ in range(5)))
+
+    assert asyncio.run(main()) == ['image'] * 5
+    assert len(calls) == 1
+
+
+def test_ado_leader_exception_reaches_every_follower():
+    group = SingleFlight('test')
+
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise ValueError('model error')
+
+    async def main():
+        return await asyncio.gather(*(group.ado('key', fn) for _ in range(3)), return_exceptions=True)
+
+    errors = asyncio.run(main())
+
+    assert [type(e) for e in errors] == [ValueError] * 3
+
+
+def test_ado_follower_timeout_leaves_the_call_running():
+    group = SingleFlight('test')
+
+    async def fn():
+        await asyncio.sleep(0.05)
+        return 'image'
+
+    async def main():
+        leader = asyncio.ensure_future(group.ado('key', fn))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await group.ado('key', fn, timeout=0.01)
+        return await leader
+
+    assert asyncio.run(main()) == 'image'
+    assert group.timeouts == 1
+
+
+def test_ado_cancels_the_call_when_every_waiter_leaves():
+    group = SingleFlight('test')
+    cancelled = []
+
+    async def fn():
+        try:
+            await asyncio.sleep(5.0)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    async def main():
+        waiters = [asyncio.ensure_future(group.ado('key', fn)) for _ in range(3)]
+        await asyncio.sleep(0.01)
+        waiters[0].cancel()
+        await asyncio.sleep(0.01)
+        assert not cancelled  # two callers still wait on it
+
+        for waiter in waiters[1:]:
+            waiter.cancel()
+        await asyncio.gather(*waiters, return_exceptions=True)
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert cancelled == [True]
+
+
+'''
+Streams
+'''
+def test_do_stream_replays_the_leader_items_to_followers():
+    group = SingleFlight('test')
+    call = SlowCall()
+    streams = []
+
+    def fn():
+        streams.append(1)
+        yield 'first'
+        yield call()
+
+    leader = group.do_stream('key', fn)
+    assert next(leader) == 'first'
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        followers = [executor.submit(lambda: list(group.do_stream('key', fn))) for _ in range(2)]
+        while group.saved < 2:
+            time.sleep(0.001)
+        call.release.set()
+        assert list(leader) == ['image']
+
+        assert [f.result() for f in followers] == [['first', 'image']] * 2
+    assert len(streams) == 1
+
+
+def test_do_stream_error_reaches_followers():
+    group = SingleFlight('test')
+    call = SlowCall(result=ValueError('stream broke'))
+
+    def fn():
+        yield 'first'
+        yield call()
+
+    leader = group.do_stream('key', fn)
+    assert next(leader) == 'first'
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        follower = executor.submit(lambda: list(group.do_stream('key', fn)))
+        while group.saved < 1:
+            time.sleep(0.001)
+        call.release.set()
+
+        with pytest.raises(ValueError):
+            list(leader)
+        with pytest.raises(ValueError):
+            follower.result()
+
+
+def test_do_stream_closed_early_fails_followers():
+    group = SingleFlight('test')
+
+    def fn():
+        yield from ['a', 'b', 'c']
+
+    leader = group.do_stream('key', fn)
+    next(leader)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        follower = executor.submit(lambda: list(group.do_stream('key', fn)))
+        while group.saved < 1:
+            time.sleep(0.001)
+        leader.close()
+
+        with pytest.raises(RuntimeError):
+            follower.result()
+    assert group.stats()['in_flight'] == 0
@@ -0,0 +1,173 @@
+import json
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from botocore.exceptions import ClientError
+
+from aws.throttle import AdaptiveLimiter
+from benchmarks.fakes import FakeBedrockRuntime, Latency
+
+
+MODEL_ID = 'amazon.titan-embed-text-v2:0'
+BODY = json.dumps({'inputText': 'a red bicycle'})
+
+
+def _limiter(**options) -> AdaptiveLimiter:
+    limiter = AdaptiveLimiter(name='test', **{'rate': 1000.0, 'max_limit': 8, 'cooldown': 0.0, **options})
+    limiter._backoff = lambda attempt: 0.0
+    return limiter
+
+
+def _invoke(fake: FakeBedrockRuntime):
+    return lambda: fake.invoke_model(body=BODY, modelId=MODEL_ID)
+
+
+def test_throttling_halves_the_window():
+    limiter = _limiter(max_attempts=3)
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+
+    with pytest.raises(ClientError):
+        limiter.call(_invoke(fake))
+
+    # the last attempt raises without a retry, so two decreases
+    assert fake.throttles == 3
+    assert limiter.throttles == 2
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+def test_window_never_drops_below_min_limit():
+    limiter = _limiter(max_attempts=10, min_limit=2)
+    fake = FakeBedrockRuntime(throttle_rate=1.0)
+
+    with pytest.raises(ClientError):
+        limiter.call(_invoke(fake))
+
+    assert limiter.limit == 2
+
+
+def test_decrease_cooldown():
+    limiter = _limiter(cooldown=60.0)
+
+    limiter.on_throttle()
+    limiter.on_throttle()
+
+    assert limiter.throttles == 2
+    assert limiter.limit == 4
+
+
+def test_window_recovers_after_throttling():
+    limiter = _limiter(max_attempts=4)
+    with pytest.raises(ClientError):
+        limiter.call(_invoke(FakeBedrockRuntime(throttle_rate=1.0)))
+    assert limiter.limit == 1
+
+    fake = FakeBedrockRuntime()
+    limits = []
+    for _ in range(40):
+        limiter.call(_invoke(fake))
+        limits.append(limiter.limit)
+
+    assert limits == sorted(limits)
+    assert limiter.limit == limiter.max_limit
+
+
+def test_retries_throttled_calls_until_they_succeed():
+    limiter = _limiter(max_attempts=20, cooldown=60.0)
+    fake = FakeBedrockRuntime(throttle_rate=0.3, seed=7)
+
+    for _ in range(50):
+        response = limiter.call(_invoke(fake))
+        assert 'embedding' in json.loads(response['body'].read())
+
+    assert fake.throttles > 0
+    assert limiter.retries == fake.throttles
+    assert limiter.successes == 50
+
+
+def test_window_caps_requests_in_flight():
+    limiter = _limiter(max_limit=3)
+    fake = FakeBedrockRuntime(latency={'embedding': Latency(0.02, 'fixed')})
+
+    with ThreadPoolExecutor(max_workers=12) as executor:
+        list(executor.map(lambda _: limiter.call(_invoke(fake)), range(36)))
+
+    assert fake.peak_in_flight == 3
+    assert limiter.in_flight == 0
+
+
+'''
+Coroutines
+'''
+def test_acall_caps_requests_in_flight():
+    limiter = _limiter(max_limit=3)
+    in_flight = []
+
+    async def fn():
+        in_flight.append(1)
+        peak = len(in_flight)
+        await asyncio.sleep(0.01)
+        in_flight.pop()
+        return peak
+
+    async def main():
+        return await asyncio.gather(*(limiter.acall(fn) for _ in range(30)))
+
+    peaks = asyncio.run(main())
+
+    assert max(peaks) == 3
+    assert limiter.in_flight == 0
+    assert limiter.waiting == 0
+    assert not limiter._async_waiters
+
+
+def test_coroutine_wakes_when_a_thread_releases_its_slot():
+    limiter = _limiter(max_limit=1)
+    entered = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with limiter.slot():
+            entered.set()
+            release.wait()
+
+    async def main():
+        thread = threading.Thread(target=hold)
+        thread.start()
+        entered.wait()
+        task = asyncio.ensure_future(limiter.aslot_enter())
+        await asyncio.sleep(0.05)
+        assert not task.done()
+
+        start = time.perf_counter()
+        release.set()
+        await asyncio.wait_for(task, timeout=1.0)
+        limiter.aslot_exit()
+        thread.join()
+        return time.perf_counter() - start
+
+    assert asyncio.run(main()) < 0.5
+    assert limiter.in_flight == 0
+
+
+def test_cancelled_waiter_passes_its_wakeup_on():
+    limiter = _limiter(max_limit=1)
+
+    async def main():
+        await limiter.aslot_enter()
+        first = asyncio.ensure_future(limiter.aslot_enter())
+        second = asyncio.ensure_future(limiter.aslot_enter())
+        await asyncio.sleep(0)
+
+        limiter.aslot_exit()  # wakes `first`, which is cancelled before it runs
+        first.cancel()
+        await asyncio.wait_for(second, timeout=1.0)
+        assert first.cancelled()
+        limiter.aslot_exit()
+
+    asyncio.run(main())
+    assert limiter.in_flight == 0
+    assert limiter.waiting == 0
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from vector_index import VectorIndex
+
+
+def _unit(angle: float) -> list:
+    # 3-dim vector whose cosine similarity with [1, 0, 0] is cos(angle)
+    return [float(np.cos(angle)), float(np.sin(angle)), 0.0]
+
+
+def _index(path=None) -> VectorIndex:
+    index = VectorIndex(path=path)
+    index.add(
+        [f'image-{n}' for n in range(6)],
+        [_unit(n * 0.2) for n in range(6)],
+        [{'n': n} for n in range(6)],
+    )
+    return index
+
+
+def test_search_returns_top_k_best_first():
+    results = _index().search([1.0, 0.0, 0.0], k=3)
+
+    assert [id for id, _, _ in results] == ['image-0', 'image-1', 'image-2']
+    assert results[0][1] == pytest.approx(1.0)
+    assert results[1][1] == pytest.approx(np.cos(0.2))
+    assert results[2][2] == {'n': 2}
+
+
+def test_search_normalizes_the_query():
+    results = _index().search([10.0, 0.0, 0.0], k=1)
+
+    assert results[0][0] == 'image-0'
+    assert results[0][1] == pytest.approx(1.0)
+
+
+def test_search_k_larger_than_the_index():
+    assert len(_index().search([1.0, 0.0, 0.0], k=50)) == 6
+    assert VectorIndex().search([1.0, 0.0, 0.0], k=3) == []
+
+
+def test_search_exclude_still_returns_k():
+    results = _index().search([1.0, 0.0, 0.0], k=3, exclude=['image-0', 'image-2'])
+
+    assert [id for id, _, _ in results] == ['image-1', 'image-3', 'image-4']
+
+
+def test_add_skips_known_ids():
+    index = _index()
+    index.add(['image-0', 'image-9'], [_unit(3.0), _unit(0.0)])
+
+    assert len(index) == 7
+    assert index.get('image-0') == pytest.approx(np.array(_unit(0.0), dtype=np.float32))
+    assert {id for id, _, _ in index.search([1.0, 0.0, 0.0], k=2)} == {'image-0', 'image-9'}
+
+
+def test_add_rejects_other_dimensions():
+    with pytest.raises(ValueError):
+        _index().add(['other'], [[1.0, 0.0]])
+
+
+def test_persisted_rows_reload(tmp_path):
+    path = str(tmp_path / 'index')
+    _index(path)
+    other = VectorIndex(path=path)
+    other.add(['image-9'], [_unit(0.05)], [{'n': 9}])
+
+    index = VectorIndex(path=path)
+
+    assert len(index) == 7
+    assert [id for id, _, _ in index.search([1.0, 0.0, 0.0], k=2)] == ['image-0', 'image-9']
+
+
+def test_search_skips_duplicate_rows(tmp_path):
+    # two processes appended the same id before either reloaded
+    path = str(tmp_path / 'index')
+    first, second = VectorIndex(path=path), VectorIndex(path=path)
+    first.add(['image-0', 'image-1'], [_unit(0.0), _unit(0.2)])
+    second.add(['image-0'], [_unit(0.0)])
+
+    index = VectorIndex(path=path)
+
+    assert [id for id, _, _ in index.search([1.0, 0.0, 0.0], k=2)] == ['image-0', 'image-1']
@@ -1,30 +1,49 @@
-import base64
-import requests
+import time
+from contextlib import contextmanager
 from PIL import Image
 from io import BytesIO
 from datetime import datetime
-from IPython.display import display, HTML
+from image_buffer import ImageBuffer, to_base64
 
 
 def encode_image_bytes(image):
-    image = Image.open(image)
+    if not isinstance(image, ImageBuffer):
+        image = ImageBuffer.from_file(image)
+    return image.jpeg_base64(max_size=(1000, 1000))
 
-    max_size = (1000, 1000)
-    image.thumbnail(max_size, Image.Resampling.LANCZOS)
-    buffer = BytesIO()
-    image.convert("RGB").save(buffer, format="JPEG")
-    resized_image_data = buffer.getvalue()
 
-    encoded_image = base64.b64encode(resized_image_data)
-    decoded_image = encoded_image.decode('utf8')
-    return decoded_image
+RENDITIONS = {
+    'thumbnail': 256,
+    'preview': 768,
+}
+
+
+def make_renditions(image, renditions: dict = RENDITIONS, quality: int = 80) -> dict:
+    '''
+    Args:
+        image: ImageBuffer or encoded image bytes
+
+    Returns:
+        dict: rendition name -> WebP bytes no larger than the given edge length
+    '''
+    if not isinstance(image, ImageBuffer):
+        image = ImageBuffer(image)
+    image = image.pil.copy()
+
+    results = {}
+    for name, max_edge in sorted(renditions.items(), key=lambda kv: kv[1], reverse=True):
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+        buffer = BytesIO()
+        image.save(buffer, format="WEBP", quality=quality, method=4)
+        results[name] = buffer.getvalue()
+    return results
 
 
 def encode_image_base64(img_url):
     try:
+        import requests
         response = requests.get(img_url)
-        image_data = response.content
-        return encode_image_bytes(BytesIO(image_data))
+        return encode_image_bytes(ImageBuffer(response.content))
     except Exception as e:
         print(e)
     return None
@@ -32,22 +51,34 @@ def encode_image_base64(img_url):
 
 def encode_image_base64_from_file(file_path):
     try:
-        with open(file_path, 'rb') as img_file:
-            image_data = img_file.read()
-        return encode_image_bytes(BytesIO(image_data))
+        return encode_image_bytes(ImageBuffer.from_file(file_path))
     except Exception as e:
         print(e)
     return None
 
 
 def display_image(utf8):
-    if isinstance(utf8, str):
-        html = f'<img src="data:image/png;base64,{utf8}" height="300"/>'
+    # notebook-only helper; IPython is imported when it is actually used
+    from IPython.display import display, HTML
+
+    if isinstance(utf8, (str, ImageBuffer)):
+        html = f'<img src="data:image/png;base64,{to_base64(utf8)}" height="300"/>'
         display(HTML(html))
     elif isinstance(utf8, list):
         for img_str in utf8:
-            html = f'<img src="data:image/png;base64,{img_str}" height="300"/>'
+            html = f'<img src="data:image/png;base64,{to_base64(img_str)}" height="300"/>'
             display(HTML(html))
 
 def get_current_time():
-    return datetime.now().strftime('%y-%m-%d %H:%M:%S')
\ No newline at end of file
+    return datetime.now().strftime('%y-%m-%d %H:%M:%S')
+
+def get_current_timestamp():
+    return int(time.time() * 1000)
+
+@contextmanager
+def timer(timings: dict, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
@@ -0,0 +1,215 @@
+import os
+import json
+import threading
+import numpy as np
+from typing import Iterable, List, Optional, Tuple
+
+from cache import file_lock
+
+
+class VectorIndex:
+    '''
+    In-process cosine-similarity index over a contiguous float32 matrix.
+
+    Rows are L2-normalized on insert so a search is one matrix-vector product
+    plus a partial sort. When `path` is given the index is persisted
+    append-only: `vectors.f32` holds the raw rows (memory-mapped on load) and
+    `ids.jsonl` holds one `{"id", "meta"}` record per row. Both files are
+    written under one file lock, so processes sharing `path` cannot
+    interleave their rows; rows added by another process show up on the
+    next load.
+    '''
+    VECTORS_FILE = 'vectors.f32'
+    IDS_FILE = 'ids.jsonl'
+    META_FILE = 'meta.json'
+    LOCK_FILE = '.lock'
+
+    def __init__(self, dim: Optional[int] = None, path: Optional[str] = None, normalize: bool = True):
+        self.dim = dim
+        self.path = path
+        self.normalize = normalize
+        self.ids = []
+        self.metadata = []
+        self._positions = {}
+        self._buffer = np.zeros((0, dim or 0), dtype=np.float32)
+        self._lock = threading.Lock()
+
+        if path:
+            self._load()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id: str):
+        return id in self._positions
+
+    @property
+    def matrix(self) -> np.ndarray:
+        with self._lock:
+            return self._buffer[:len(self.ids)]
+
+    def add(self, ids: Iterable[str], vectors, metadata: Optional[Iterable[dict]] = None):
+        ids = list(ids)
+        vectors = np.ascontiguousarray(np.asarray(vectors, dtype=np.float32).reshape(len(ids), -1))
+        metadata = list(metadata) if metadata is not None else [None] * len(ids)
+
+        if self.normalize:
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors = vectors / np.where(norms == 0, 1, norms)
+
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                self._buffer = np.zeros((0, self.dim), dtype=np.float32)
+                self._save_meta()
+            if vectors.shape[1] != self.dim:
+                raise ValueError(f"expected {self.dim}-dim vectors, got {vectors.shape[1]}")
+
+            keep = [n for n, id in enumerate(ids) if id not in self._positions]
+            if not keep:
+                return
+            ids = [ids[n] for n in keep]
+            metadata = [metadata[n] for n in keep]
+            vectors = vectors[keep]
+
+            size = len(self.ids)
+            self._reserve(size + len(ids))
+            self._buffer[size:size + len(ids)] = vectors
+
+            for id in ids:
+                self._positions[id] = len(self.ids)
+                self.ids.append(id)
+            self.metadata.extend(metadata)
+            self._append(ids, vectors, metadata)
+
+    def get(self, id: str) -> Optional[np.ndarray]:
+        with self._lock:
+            position = self._positions.get(id)
+            if position is None:
+                return None
+            return np.array(self._buffer[position])
+
+    def get_many(self, ids: Iterable[str]) -> Tuple[np.ndarray, List[bool]]:
+        '''
+        Returns:
+            tuple: (contiguous matrix with one row per id, zeros where missing; found flags)
+        '''
+        ids = list(ids)
+        with self._lock:
+            positions = [self._positions.get(id) for id in ids]
+            found = [position is not None for position in positions]
+            result = np.zeros((len(ids), self.dim or 0), dtype=np.float32)
+            rows = [n for n, ok in enumerate(found) if ok]
+            if rows:
+                result[rows] = self._buffer[[positions[n] for n in rows]]
+        return result, found
+
+    def search(self, query, k: int = 10, exclude: Optional[Iterable[str]] = None) -> List[Tuple[str, float, Optional[dict]]]:
+        '''
+        Returns:
+            list: (id, cosine similarity, metadata) for the top-k rows, best first
+        '''
+        query = np.asarray(query, dtype=np.float32).ravel()
+        norm = np.linalg.norm(query)
+        if norm:
+            query = query / norm
+
+        with self._lock:
+            matrix = self._buffer[:len(self.ids)]
+            ids, metadata, positions = self.ids, self.metadata, self._positions
+            duplicates = len(ids) - len(positions)
+        if not len(matrix):
+            return []
+
+        exclude = set(exclude or [])
+        scores = matrix @ query
+        candidates = min(k + len(exclude) + duplicates, len(scores))
+        top = np.argpartition(-scores, candidates - 1)[:candidates]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (ids[n], float(scores[n]), metadata[n]) for n in top
+            if ids[n] not in exclude and positions.get(ids[n]) == n
+        ][:k]
+
+    '''
+    Persistence
+    '''
+    def _reserve(self, rows: int):
+        # grow geometrically; the first add after a load also moves the
+        # read-only memory map into a writable in-memory buffer
+        if rows <= len(self._buffer) and not isinstance(self._buffer, np.memmap):
+            return
+        capacity = max(rows, 2 * len(self._buffer), 64)
+        buffer = np.empty((capacity, self.dim), dtype=np.float32)
+        size = len(self.ids)
+        buffer[:size] = self._buffer[:size]
+        self._buffer = buffer
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    def _save_meta(self):
+        if not self.path:
+            return
+        with open(self._file(self.META_FILE), 'w') as f:
+            json.dump({'dim': self.dim}, f)
+
+    def _load(self):
+        os.makedirs(self.path, exist_ok=True)
+        with file_lock(self._file(self.LOCK_FILE)):
+            self._load_locked()
+
+    def _load_locked(self):
+        try:
+            with open(self._file(self.META_FILE)) as f:
+                self.dim = json.load(f)['dim']
+        except (OSError, ValueError, KeyError):
+            return
+
+        records = []
+        lines = 0
+        try:
+            with open(self._file(self.IDS_FILE)) as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except OSError:
+            pass
+
+        # a crash between the two appends can leave extra rows; drop them
+        row_bytes = self.dim * 4
+        vectors_file = self._file(self.VECTORS_FILE)
+        size = os.path.getsize(vectors_file) if os.path.exists(vectors_file) else 0
+        rows = min(len(records), size // row_bytes)
+        if size != rows * row_bytes:
+            with open(vectors_file, 'r+b' if size else 'wb') as f:
+                f.truncate(rows * row_bytes)
+        if rows != lines:
+            with open(self._file(self.IDS_FILE), 'w') as f:
+                for record in records[:rows]:
+                    f.write(json.dumps(record) + '\n')
+        records = records[:rows]
+
+        self.ids = [record['id'] for record in records]
+        self.metadata = [record.get('meta') for record in records]
+        # processes sharing the store can both append the same id; the first row wins
+        self._positions = {}
+        for n, id in enumerate(self.ids):
+            self._positions.setdefault(id, n)
+        self._buffer = (
+            np.memmap(vectors_file, dtype=np.float32, mode='r', shape=(rows, self.dim))
+            if rows else np.zeros((0, self.dim), dtype=np.float32)
+        )
+
+    def _append(self, ids: List[str], vectors: np.ndarray, metadata: List[Optional[dict]]):
+        if not self.path:
+            return
+        with file_lock(self._file(self.LOCK_FILE)):
+            with open(self._file(self.VECTORS_FILE), 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self._file(self.IDS_FILE), 'a') as f:
+                for id, meta in zip(ids, metadata):
+                    f.write(json.dumps({'id': id, 'meta': meta}) + '\n')